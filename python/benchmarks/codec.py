@@ -0,0 +1,100 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Compares encode/decode throughput and frame sizes of the wire codecs.
+
+Usage: python benchmarks/codec.py [rows] [iterations]
+"""
+
+import sys
+import time
+import uuid
+from datetime import datetime
+from freenas.dispatcher.codec import get_codec, supported_codecs
+
+
+def make_payload(rows):
+    return {
+        'namespace': 'rpc',
+        'name': 'fragment',
+        'id': str(uuid.uuid4()),
+        'args': {
+            'seqno': 1,
+            'fragment': [
+                {
+                    'id': i,
+                    'name': 'task.{0}'.format(i),
+                    'state': 'FINISHED',
+                    'created_at': datetime.utcnow(),
+                    'updated_at': datetime.utcnow(),
+                    'args': [i, 'tank/dataset{0}'.format(i), {'recursive': True}],
+                    'blob': b'\x00\x01\x02\x03' * 64,
+                }
+                for i in range(rows)
+            ]
+        }
+    }
+
+
+def bench(codec, payload, iterations):
+    frame = codec.dumps(payload)
+    if isinstance(frame, str):
+        frame = frame.encode('utf-8')
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.dumps(payload)
+
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        codec.loads(frame)
+
+    decode = time.perf_counter() - start
+    return len(frame), encode, decode
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = make_payload(rows)
+
+    print('{0:<10} {1:>12} {2:>12} {3:>12}'.format('codec', 'frame bytes', 'encode ms', 'decode ms'))
+    for name in supported_codecs():
+        size, encode, decode = bench(get_codec(name), payload, iterations)
+        print('{0:<10} {1:>12} {2:>12.2f} {3:>12.2f}'.format(
+            name, size,
+            encode * 1000 / iterations,
+            decode * 1000 / iterations
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Measures the memory held by decoded query results, as dictionaries and as records.
+
+Usage: python benchmarks/records.py [rows]
+"""
+
+import sys
+import gc
+import tracemalloc
+from freenas.dispatcher.jsonenc import dumps, loads
+from freenas.dispatcher.record import RecordFactory
+
+
+def make_rows(rows):
+    return [
+        {
+            'id': 'tank/dataset{0}'.format(i),
+            'name': 'dataset{0}'.format(i),
+            'pool': 'tank',
+            'type': 'FILESYSTEM',
+            'mounted': True,
+            'mountpoint': '/mnt/tank/dataset{0}'.format(i),
+            'permissions_type': 'PERM',
+            'temp_mountpoint': None,
+            'properties': {'compression': 'lz4', 'atime': 'off', 'quota': None},
+            'metadata': {'owner': 'root', 'group': 'wheel'},
+        }
+        for i in range(rows)
+    ]
+
+
+def measure(frame, convert=None):
+    gc.collect()
+    tracemalloc.start()
+    result = loads(frame)
+    if convert:
+        result = convert(result)
+
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    frame = dumps(make_rows(rows))
+
+    dicts, result = measure(frame)
+    del result
+    records, result = measure(frame, RecordFactory().convert)
+    del result
+
+    print('{0:<10} {1:>12} {2:>12}'.format('rows as', 'bytes', 'bytes/row'))
+    print('{0:<10} {1:>12} {2:>12.1f}'.format('dict', dicts, dicts / rows))
+    print('{0:<10} {1:>12} {2:>12.1f}'.format('record', records, records / rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+"""
+Measures how many small frames per second a socketpair endpoint can receive
+and send, comparing per-frame header and body reads and joined sends with the
+buffered frame reader and scatter-gather sends.
+
+Concurrent senders are measured writing through a lock, one frame per call, and
+through an OutboundQueue coalescing their frames.
+
+Each side is measured against a peer process that is never the bottleneck:
+it either writes all frames as one blob or drains the socket in large reads.
+
+Usage: python benchmarks/transport.py [frames] [size]
+"""
+
+import sys
+import array
+import socket
+import time
+import multiprocessing
+from freenas.utils import xrecvmsg, xsendmsg
+from threading import Lock, Thread
+from freenas.dispatcher.transport import FrameReader, OutboundQueue, HEADER, MAXFDS, frame_buffers, sendmsg_all
+
+
+ANCBUFSIZE = socket.CMSG_SPACE(MAXFDS * array.array('i').itemsize)
+
+
+def send_blob(sock, frames, body):
+    sock.sendall((HEADER.pack(0xdeadbeef, len(body)) + body) * frames)
+
+
+def drain(sock, frames, body):
+    remaining = frames * (HEADER.size + len(body))
+    buffer = bytearray(1024 * 1024)
+    while remaining:
+        remaining -= sock.recv_into(buffer, min(remaining, len(buffer)))
+
+
+def send_joined(sock, frames, body):
+    for _ in range(frames):
+        xsendmsg(sock, HEADER.pack(0xdeadbeef, len(body)) + body, [])
+
+
+def send_framed(sock, frames, body):
+    for _ in range(frames):
+        sendmsg_all(sock, frame_buffers(body))
+
+
+def send_concurrently(send, frames, body, threads=8):
+    workers = [
+        Thread(target=lambda: [send(frame_buffers(body)) for _ in range(frames // threads)])
+        for _ in range(threads)
+    ]
+
+    for i in workers:
+        i.start()
+
+    for i in workers:
+        i.join()
+
+
+def send_locked(sock, frames, body):
+    lock = Lock()
+
+    def send(buffers):
+        with lock:
+            sendmsg_all(sock, buffers)
+
+    send_concurrently(send, frames, body)
+
+
+def send_queued(sock, frames, body):
+    queue = OutboundQueue(lambda buffers, ancdata: sendmsg_all(sock, buffers, ancdata))
+
+    send_concurrently(queue.send, frames, body)
+
+
+def recv_unbuffered(sock, frames, body):
+    for _ in range(frames):
+        header, ancdata = xrecvmsg(sock, 8, ANCBUFSIZE)
+        magic, length = HEADER.unpack(header)
+        xrecvmsg(sock, length)
+
+
+def recv_buffered(sock, frames, body, ancbufsize=0):
+    reader = FrameReader(sock, ancbufsize)
+    for _ in range(frames):
+        header, ancdata = reader.read_header()
+        magic, length = HEADER.unpack(header)
+        reader.read(length)
+
+
+def recv_buffered_ancdata(sock, frames, body):
+    recv_buffered(sock, frames, body, ANCBUFSIZE)
+
+
+def measure(local, peer, frames, size):
+    a, b = socket.socketpair()
+    body = b'x' * size
+    process = multiprocessing.get_context('fork').Process(target=peer, args=(a, frames, body))
+    start = time.perf_counter()
+    process.start()
+    local(b, frames, body)
+    elapsed = time.perf_counter() - start
+    process.join()
+    a.close()
+    b.close()
+    return frames / elapsed
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print('{0:<40} {1:>12}'.format('{0} frames of {1} bytes'.format(frames, size), 'frames/s'))
+    for name, local, peer in (
+        ('recv: header and body reads', recv_unbuffered, send_blob),
+        ('recv: buffered, with ancillary data', recv_buffered_ancdata, send_blob),
+        ('recv: buffered, stream', recv_buffered, send_blob),
+        ('send: joined header and body', send_joined, drain),
+        ('send: frame_buffers()', send_framed, drain),
+        ('send: 8 threads, lock per frame', send_locked, drain),
+        ('send: 8 threads, outbound queue', send_queued, drain),
+    ):
+        print('{0:<40} {1:>12.0f}'.format(name, measure(local, peer, frames, size)))
+
+
+if __name__ == '__main__':
+    main()
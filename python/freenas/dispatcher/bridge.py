@@ -27,6 +27,7 @@
 
 from urllib.parse import urlparse
 from freenas.dispatcher.transport import ClientTransport
+from freenas.dispatcher.codec import is_json
 
 
 class Bridge(object):
@@ -34,6 +35,10 @@ class Bridge(object):
         def __init__(self, parent, index):
             self.opposite_transport = parent.transports[(index + 1) % 2]
 
+        def on_open(self):
+            """ Nothing to set up once a side of the bridge is connected. """
+            pass
+
         def on_message(self, msg, fds=None):
             """ Send a message to the other side.
 
@@ -41,7 +46,10 @@ class Bridge(object):
                 msg (string): The message to send.
                 fds (list): The file descriptors list.
             """
-            self.opposite_transport.send(msg.decode('utf-8'), fds or [])
+            if is_json(msg):
+                msg = msg.decode('utf-8')
+
+            self.opposite_transport.send(msg, fds or [])
 
         def on_close(self, reason):
             """ Close the other side upon closing the bridge.
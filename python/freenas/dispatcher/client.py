@@ -27,15 +27,28 @@
 
 from __future__ import print_function
 import os
+import re
 import enum
 import uuid
 import errno
 import time
 import logging
 import contextlib
-from .jsonenc import dumps, loads
-from threading import RLock, Event, Condition
+import fnmatch
+import functools
+import codecs
+import json
+from .codec import (
+    get_codec, supported_codecs, supported_features, encode, decode, peek_envelope,
+    StreamCompressor, FrameTooLarge, FRAME_COMPRESSED
+)
+from .jsonenc import decode_tagged, dumps
+from .record import RecordFactory
+from threading import RLock, Event, Condition, Timer
 from queue import Queue
+from types import MappingProxyType
+from collections import OrderedDict
+from collections.abc import MutableMapping
 from freenas.dispatcher import rpc
 from freenas.utils.spawn_thread import spawn_thread, kill_thread
 from freenas.dispatcher.transport import ClientTransport
@@ -153,14 +166,20 @@ class StreamingResultIterator(object):
     def __next__(self):
         with self.call.cv:
             # Wait for initial response
-            self.call.cv.wait_for(lambda: self.call.seqno > 0)
+            self.call.cv.wait_for(lambda: self.call.seqno > 0 or self.call.partial or not self.q.empty())
+            # A fragment still being received will either deliver more items or complete
+            self.call.cv.wait_for(lambda: not self.q.empty() or not self.call.partial)
+            request = self.q.empty()
 
-        if self.q.empty():
+        if request:
             # Request new fragment
             self.client.call_continue(self.call.id, True)
 
         v = self.q.get()
         if v is None:
+            if self.call.error:
+                raise rpc.RpcException(obj=self.call.error)
+
             raise StopIteration
 
         return v
@@ -200,11 +219,465 @@ class StreamingResultView(object):
         self.client.abort_call(self.call.id)
 
 
+class IncrementalMessage(object):
+    """ Receives a large frame as it arrives.
+
+    Items of an rpc.fragment frame for a streaming call are decoded and handed
+    to the call as soon as they are complete, so that the iterator can return
+    them while the rest of the frame is still in flight and the frame is never
+    held in memory as a whole. Any other frame is accumulated in a buffer sized
+    after the frame header and passed to Connection.on_message() once complete,
+    as a memoryview of that buffer.
+    """
+    PREFIX_LENGTH = 512
+    PREFIX = re.compile(
+        r'\{\s*"namespace"\s*:\s*"rpc"\s*,\s*"name"\s*:\s*"fragment"\s*,\s*"id"\s*:\s*"([^"\\]*)"\s*,'
+        r'\s*"args"\s*:\s*\{\s*"seqno"\s*:\s*(\d+)\s*,\s*"fragment"\s*:\s*\['
+    )
+    SEPARATORS = re.compile(r'[\s,]*')
+    SUFFIX = re.compile(r'\s*\}\s*\}\s*$')
+
+    def __init__(self, connection, fds, length=0):
+        self.connection = connection
+        self.fds = fds
+        self.buffer = bytearray(length)
+        self.size = 0
+        self.compression = None
+        self.started = False
+        self.call = None
+        self.seqno = None
+        self.text = None
+        self.utf8 = None
+        self.complete = False
+        self.failed = False
+        self.aborted = False
+        self.decoder = json.JSONDecoder()
+        self.fd_decoder = functools.partial(connection.channel_serializer.decode_fd, fds=fds)
+
+    def feed(self, data):
+        if not self.started:
+            self.started = True
+            if self.connection.compression and data[0] == FRAME_COMPRESSED:
+                self.compression = self.connection.compression
+                self.compression.begin_frame()
+                data = memoryview(data)[1:]
+
+        if self.aborted:
+            return
+
+        if self.compression:
+            try:
+                data = self.compression.decompress_chunk(data)
+            except FrameTooLarge as err:
+                self.aborted = True
+                self.connection.abort(str(err))
+                return
+
+        if self.text is not None:
+            if not self.failed:
+                try:
+                    self.text += self.utf8.decode(data)
+                except ValueError:
+                    self.failed = True
+                else:
+                    self.parse()
+
+            return
+
+        # Grows the buffer past the preallocated length if a compressed frame inflates beyond it
+        end = self.size + len(data)
+        self.buffer[self.size:end] = data
+        self.size = end
+        if self.call is None and self.size >= self.PREFIX_LENGTH:
+            self.start()
+
+    def start(self):
+        self.call = False
+        match = self.PREFIX.match(self.buffer[:self.PREFIX_LENGTH].decode('utf-8', 'replace'))
+        if not match:
+            return
+
+        call = self.connection.pending_calls.get(match.group(1))
+        if not call or call.view or call.callback:
+            return
+
+        self.call = call
+        self.seqno = int(match.group(2))
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = self.utf8.decode(memoryview(self.buffer)[:self.size])[match.end():]
+        self.buffer = None
+
+        with call.cv:
+            if not call.result:
+                call.result = StreamingResultIterator(self.connection, call)
+
+            call.partial = self.seqno
+            call.cv.notify_all()
+
+        call.ready.set()
+        self.parse()
+
+    def parse(self):
+        if self.complete:
+            return
+
+        text = self.text
+        items = []
+        pos = 0
+        while True:
+            pos = self.SEPARATORS.match(text, pos).end()
+            if pos == len(text):
+                break
+
+            if text[pos] == ']':
+                self.complete = True
+                pos += 1
+                break
+
+            try:
+                item, end = self.decoder.raw_decode(text, pos)
+            except ValueError:
+                break
+
+            # A number at the very end may continue in the next chunk
+            if end == len(text):
+                break
+
+            if text.find('"$', pos, end) != -1:
+                item = decode_tagged(item, self.fd_decoder)
+
+            if self.call.compact:
+                item = self.connection.records.convert(item)
+
+            items.append(item)
+            pos = end
+
+        self.text = text[pos:]
+        if items:
+            with self.call.cv:
+                for i in items:
+                    self.call.queue.put(i)
+
+                self.call.cv.notify_all()
+
+    def finish(self):
+        if self.aborted:
+            return
+
+        if not self.call:
+            self.connection.on_message(memoryview(self.buffer)[:self.size], fds=self.fds)
+            return
+
+        call = self.call
+        if self.failed or not self.complete or not self.SUFFIX.match(self.text):
+            # Items already delivered cannot be taken back, so fail the whole call
+            self.connection.send_error(None, errno.EINVAL, 'Request is not valid JSON')
+            self.connection.on_rpc_error(call.id, {
+                'code': errno.EBADMSG,
+                'message': 'Malformed fragment {0} received'.format(self.seqno)
+            })
+
+            with call.cv:
+                call.partial = 0
+                call.queue.put(None)
+                call.cv.notify_all()
+
+            return
+
+        with call.cv:
+            call.seqno = self.seqno
+            call.partial = 0
+            call.cv.notify_all()
+
+
+class EventWaiter(object):
+    __slots__ = ('name', 'predicate', 'event', 'error')
+
+    def __init__(self, name, predicate):
+        self.name = name
+        self.predicate = predicate
+        self.event = Event()
+        self.error = None
+
+    def wait(self, timeout=None):
+        return self.event.wait(timeout) and self.error is None
+
+
+class HandlerList(list):
+    """ The handlers registered under a mask. Changing it in place drops the routes of its router. """
+    __slots__ = ('router',)
+
+    def __init__(self, router, handlers=()):
+        super(HandlerList, self).__init__(handlers)
+        self.router = router
+
+
+def _invalidate_routes(name):
+    method = getattr(list, name)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.router.invalidate()
+
+    return wrapper
+
+
+for _name in (
+    'append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort', 'reverse',
+    '__setitem__', '__delitem__', '__iadd__', '__imul__'
+):
+    setattr(HandlerList, _name, _invalidate_routes(_name))
+
+
+class HandlerMap(MutableMapping):
+    """ Mutable view of the handler lists of an EventRouter, by mask. """
+    def __init__(self, router):
+        self.router = router
+
+    def __getitem__(self, mask):
+        return self.router.handlers[mask]
+
+    def __setitem__(self, mask, handlers):
+        self.router.set(mask, handlers)
+
+    def __delitem__(self, mask):
+        self.router.discard(mask)
+
+    def __iter__(self):
+        return iter(list(self.router.handlers))
+
+    def __len__(self):
+        return len(self.router.handlers)
+
+    def __repr__(self):
+        return repr(self.router.handlers)
+
+
+class EventRouter(object):
+    """ Routes event names to handlers registered under exact names or glob masks.
+
+    Wildcard masks are compiled once. The resolved handler list of every event name
+    is cached until the set of handlers changes, so a repeated event name costs
+    a single dictionary lookup.
+    """
+    MAX_ROUTES = 4096
+
+    def __init__(self):
+        self.handlers = {}
+        self.patterns = {}
+        self.routes = {}
+        self.lock = RLock()
+
+    @staticmethod
+    def is_wildcard(mask):
+        return any(c in mask for c in '*?[')
+
+    def invalidate(self):
+        with self.lock:
+            self.routes = {}
+
+    def set(self, mask, handlers):
+        with self.lock:
+            self.handlers[mask] = HandlerList(self, handlers)
+            if self.is_wildcard(mask) and mask not in self.patterns:
+                self.patterns[mask] = re.compile(fnmatch.translate(mask)).match
+
+            self.routes = {}
+
+    def discard(self, mask):
+        with self.lock:
+            del self.handlers[mask]
+            self.patterns.pop(mask, None)
+            self.routes = {}
+
+    def add(self, mask, handler):
+        with self.lock:
+            if mask not in self.handlers:
+                self.set(mask, [handler])
+                return
+
+            self.handlers[mask].append(handler)
+
+    def remove(self, mask, handler):
+        with self.lock:
+            self.handlers[mask].remove(handler)
+            if not self.handlers[mask]:
+                self.discard(mask)
+
+    def route(self, name):
+        try:
+            return self.routes[name]
+        except KeyError:
+            pass
+
+        with self.lock:
+            handlers = list(self.handlers.get(name, []))
+            for mask, match in self.patterns.items():
+                if match(name):
+                    handlers.extend(self.handlers[mask])
+
+            if len(self.routes) >= self.MAX_ROUTES:
+                self.routes = {}
+
+            self.routes[name] = tuple(handlers)
+            return self.routes[name]
+
+
+def subscription_key(mask, filter=None):
+    """ Identify an event subscription.
+
+    Subscriptions to the same mask with different filters are distinct, so
+    the filter is part of the key, in a canonical encoded form.
+    """
+    if not filter:
+        return mask
+
+    return mask, dumps(filter, sort_keys=True)
+
+
+class SubscriptionManager(object):
+    """ Refcounts event subscriptions of a connection.
+
+    Subscribe and unsubscribe messages are only sent when a subscription goes from zero
+    to one reference or back. Changes made within ``delay`` seconds are batched
+    into a single events.subscribe and a single events.unsubscribe message, which
+    are sent at the latest before the next outgoing message.
+    Subscriptions to a mask with a filter are counted apart from the plain mask.
+    The peer only answers an events.subscribe message when it refuses it, so the
+    ids of the last ``MAX_REQUESTS`` ones are kept to match rejections against.
+    """
+    MAX_REQUESTS = 64
+
+    def __init__(self, connection, delay=0.05):
+        self.connection = connection
+        self.delay = delay
+        self.refcounts = {}
+        self.specs = {}
+        self.subscribed = set()
+        self.requests = OrderedDict()
+        self.lock = RLock()
+        self.timer = None
+
+    @property
+    def masks(self):
+        return set(self.refcounts)
+
+    @property
+    def pending(self):
+        return self.timer is not None
+
+    def acquire(self, mask, flush=False, filter=None):
+        key = subscription_key(mask, filter)
+        with self.lock:
+            count = self.refcounts.get(key, 0)
+            self.refcounts[key] = count + 1
+            self.specs[key] = {'mask': mask, 'filter': filter} if filter else mask
+            if count == 0 or (flush and key not in self.subscribed):
+                self.schedule(flush)
+
+    def release(self, mask, flush=False, filter=None):
+        key = subscription_key(mask, filter)
+        with self.lock:
+            count = self.refcounts.get(key, 0) - 1
+            if count > 0:
+                self.refcounts[key] = count
+                return
+
+            self.refcounts.pop(key, None)
+            self.schedule(flush)
+
+    def schedule(self, flush=False):
+        if flush or not self.delay:
+            self.flush()
+            return
+
+        if self.timer is None:
+            self.timer = Timer(self.delay, self.flush_deferred)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            wanted = set(self.refcounts)
+            subscribe = wanted - self.subscribed
+            unsubscribe = self.subscribed - wanted
+
+            if subscribe:
+                id = str(uuid.uuid4())
+                self.requests[id] = subscribe
+                if len(self.requests) > self.MAX_REQUESTS:
+                    self.requests.popitem(last=False)
+
+                self.connection.send('events', 'subscribe', [self.specs[i] for i in subscribe], id=id)
+
+            if unsubscribe:
+                self.connection.send('events', 'unsubscribe', [self.specs[i] for i in unsubscribe])
+
+            for i in unsubscribe:
+                if i not in self.refcounts:
+                    self.specs.pop(i, None)
+
+            self.subscribed = wanted
+
+    def flush_deferred(self):
+        try:
+            self.flush()
+        except Exception as err:
+            self.connection.logger.warning('Cannot update event subscriptions: {0}'.format(str(err)))
+
+    def resume(self, masks, since, epoch):
+        """ Acquire the masks, subscribing to them through events.resume. """
+        with self.lock:
+            for i in masks:
+                self.refcounts[i] = self.refcounts.get(i, 0) + 1
+                self.specs[i] = i
+
+            self.subscribed.update(masks)
+            self.connection.send('events', 'resume', {'masks': list(masks), 'since': since, 'epoch': epoch})
+
+    def reject(self, id, spec=None):
+        """ Forget the subscriptions the peer refused in reply to an events.subscribe message.
+
+        Args:
+            id (str): The id of the events.subscribe message.
+            spec: The refused mask or ``{'mask': ..., 'filter': ...}`` entry, if the peer named it.
+
+        Returns:
+            The set of refused subscription keys, or None if ``id`` is not one of a subscribe message.
+        """
+        with self.lock:
+            keys = self.requests.pop(id, None)
+            if keys is None:
+                return None
+
+            if isinstance(spec, dict) and isinstance(spec.get('mask'), str):
+                spec = subscription_key(spec['mask'], spec.get('filter'))
+
+            if isinstance(spec, (str, tuple)) and spec in keys:
+                keys = {spec}
+
+            # Not subscribed after all, so the next flush asks for them again if still wanted
+            self.subscribed -= keys
+            return keys
+
+    def reset(self):
+        with self.lock:
+            self.subscribed = set()
+            self.requests.clear()
+
+
 class Connection(object):
     class PendingCall(object):
         __slots__ = (
             'id', 'method', 'args', 'closed', 'view', 'result', 'error',
-            'ready', 'callback', 'queue', 'seqno', 'cache', 'cv'
+            'ready', 'callback', 'queue', 'seqno', 'partial', 'cache', 'cv', 'compact'
         )
 
         def __init__(self, id, method, args=None):
@@ -219,8 +692,10 @@ class Connection(object):
             self.callback = None
             self.queue = Queue()
             self.seqno = 0
+            self.partial = 0
             self.cache = {}
             self.cv = Condition()
+            self.compact = False
 
     def __init__(self):
         self.transport = None
@@ -237,17 +712,37 @@ class Connection(object):
         self.call_queue_limit = None
         self.event_callback = None
         self.error_callback = None
+        self.resync_callback = None
         self.rpc_callback = None
         self.pending_events = []
-        self.event_handlers = {}
+        self.event_router = EventRouter()
+        self.waiter_router = EventRouter()
         self.event_distribution_lock = RLock()
+        self.subscriptions = SubscriptionManager(self)
         self.event_emission_lock = RLock()
         self.event_cv = Event()
         self.event_thread = None
         self.event_queue = Queue()
+        self.event_seqno = None
+        self.event_epoch = None
         self.streaming = False
         self.standalone_server = False
         self.channel_serializer = UnixChannelSerializer()
+        self.codec = get_codec('json')
+        self.features = set()
+        self.compression = None
+        self.records = RecordFactory()
+        self.lazy_decode = False
+
+    @property
+    def event_handlers(self):
+        """ Mutable view of the registered event handler lists, by mask. """
+        return HandlerMap(self.event_router)
+
+    @property
+    def event_waiters(self):
+        """ Read-only view of the registered event waiters, by mask. """
+        return MappingProxyType(self.waiter_router.handlers)
 
     def __process_events(self):
         while True:
@@ -256,7 +751,7 @@ class Connection(object):
                 return
 
             with self.event_distribution_lock:
-                for h in self.event_handlers.get(name, []):
+                for h in self.event_router.route(name):
                     if getattr(h, 'sync', False):
                         with h.lock:
                             with contextlib.suppress(BaseException):
@@ -268,11 +763,16 @@ class Connection(object):
                     with contextlib.suppress(BaseException):
                         self.event_callback(name, args)
 
+            for w in self.waiter_router.route(name):
+                with contextlib.suppress(BaseException):
+                    if w.predicate(args):
+                        w.event.set()
+
     def trace(self, msg):
         pass
 
     def pack(self, namespace, name, args=None, id=None):
-        """ Encodes the current call into JSON.
+        """ Encodes the current call using the codec negotiated for the connection.
 
         Args:
             namespace (str): The namespace the call comes from.
@@ -284,16 +784,18 @@ class Connection(object):
             UnicodeEncodeError
 
         Returns:
-            A tuple containing the result JSON and the file descriptors list.
+            A tuple containing the encoded message and the file descriptors list.
         """
-        fds = list(self.channel_serializer.collect_fds(args))
+        fds = []
         try:
-            result = dumps({
+            # The envelope comes first, so that receivers can look at it before the arguments arrive
+            result = encode(self.codec, {
                 'namespace': namespace,
                 'name': name,
-                'args': args,
-                'id': str(id) if id else None
-            })
+                'id': str(id) if id else None,
+                'args': args
+            }, fd_encoder=functools.partial(self.channel_serializer.encode_fd, fds=fds),
+                attachments='attachments' in self.features)
             return result, fds
         except UnicodeEncodeError:
             raise
@@ -325,12 +827,18 @@ class Connection(object):
             pending_call.id
         )
 
-    def send_event(self, name, params):
-        self.send(
-            'events',
-            'event',
-            {'name': name, 'args': params}
-        )
+    def event_payload(self, name, params, seqno=None, epoch=None):
+        # Name and sequence number go first, so that receivers can drop the event unseen
+        payload = {'name': name}
+        if seqno is not None:
+            payload['seqno'] = seqno
+            payload['epoch'] = epoch
+
+        payload['args'] = params
+        return payload
+
+    def send_event(self, name, params, seqno=None, epoch=None):
+        self.send('events', 'event', self.event_payload(name, params, seqno, epoch))
 
     def send_event_burst(self, events):
         self.send(
@@ -372,38 +880,128 @@ class Connection(object):
         self.send('rpc', 'close', id=id)
 
     def send(self, *args, **kwargs):
+        if self.subscriptions.pending:
+            # Batched subscriptions have to reach the peer before anything that may trigger their events
+            self.subscriptions.flush()
+
         self.send_raw(*self.pack(*args, **kwargs))
 
+    def offer(self, *args, key=None, **kwargs):
+        """ Send a message that may be dropped if the peer does not keep up with reading.
+
+        Transports with bounded send buffers queue the message without waiting for room
+        and write it off the caller's thread, applying their overflow policy when it
+        does not fit; other transports just send it.
+
+        Args:
+            key: Identifies the messages a newer one may replace under the ``conflate`` policy.
+
+        Returns:
+            True if the message was sent or queued, False if it was dropped.
+        """
+        if self.subscriptions.pending:
+            self.subscriptions.flush()
+
+        data, fds = self.pack(*args, **kwargs)
+        offer = getattr(self.transport, 'offer', None)
+        if not offer or fds:
+            self.send_raw(data, fds)
+            return True
+
+        debug_log('<- {0} [{1}]', data, fds)
+        if not self.compression:
+            return offer(data, key)
+
+        with self.rlock:
+            # A compressed frame cannot be left out of the stream without corrupting the ones after it
+            return offer(self.compression.compress(data), droppable=False)
+
     def send_raw(self, data, fds=None):
         if not fds:
             fds = []
 
         debug_log('<- {0} [{1}]', data, fds)
+        transport = self.transport
+        flush = getattr(transport, 'flush', None)
+        if flush and not self.compression:
+            # Transports with an outbound queue order and coalesce concurrent sends on their own
+            transport.send(data, fds)
+            return
+
         with self.rlock:
-            self.transport.send(data, fds)
+            if self.compression:
+                data = self.compression.compress(data)
+
+            if flush:
+                # Only the queueing has to follow the compression order, the write happens
+                # outside of the lock, coalesced with whatever else got queued meanwhile
+                transport.enqueue(data, fds)
+            else:
+                transport.send(data, fds)
+
+        if flush:
+            flush()
 
     def on_open(self):
-        self.event_thread = spawn_thread(self.__process_events)
+        pass
 
     def on_close(self, reason):
-        self.event_queue.put((None, None))
-        self.event_thread.join()
+        self.subscriptions.reset()
+        if self.event_thread:
+            self.event_queue.put((None, None))
+            self.event_thread.join()
+            self.event_thread = None
+
+    def queue_event(self, name, args):
+        # The event thread only starts with the first event, so connections that never
+        # receive any, like most server side ones, do not cost a thread
+        if not self.event_thread:
+            self.event_thread = spawn_thread(self.__process_events)
+
+        self.event_queue.put((name, args))
+
+    def abort(self, reason):
+        """ Close the connection after an unrecoverable protocol error. """
+        self.logger.warning('Closing connection: {0}'.format(reason))
+        with contextlib.suppress(OSError):
+            self.transport.close()
+
+    def begin_message(self, length, fds=None):
+        """ Start receiving a large frame incrementally.
+
+        Args:
+            length (int): The frame length.
+            fds (list): File descriptors received along with the frame.
+
+        Returns:
+            An object accepting the frame data through feed() and finish().
+        """
+        return IncrementalMessage(self, fds if fds is not None else [], length)
 
     def on_message(self, message, *args, **kwargs):
         fds = kwargs.pop('fds', [])
         debug_log('-> {0}', str(message))
 
-        if type(message) is bytes:
-            message = message.decode('utf-8')
-
         try:
-            message = loads(message)
+            if self.compression:
+                message = self.compression.decompress(message)
+
+            if self.lazy_decode:
+                envelope = peek_envelope(message)
+                if envelope is not None and not self.accepts(envelope):
+                    return
+
+            message = decode(
+                message,
+                fd_decoder=functools.partial(self.channel_serializer.decode_fd, fds=fds)
+            )
+        except FrameTooLarge as err:
+            self.abort(str(err))
+            return
         except ValueError:
             self.send_error(None, errno.EINVAL, 'Request is not valid JSON')
             return
 
-        self.channel_serializer.replace_fds(message, fds)
-
         if 'namespace' not in message or 'name' not in message:
             self.send_error(None, errno.EINVAL, 'Invalid request')
             return
@@ -416,6 +1014,49 @@ class Connection(object):
 
         method(message["id"], message["args"])
 
+    def accepts(self, envelope):
+        """ Tells whether a message is wanted, judging by its envelope alone.
+
+        Only consulted when lazy_decode is enabled. Rejected messages are dropped
+        before their arguments are decoded. Events are never dropped for subclasses
+        overriding on_events_event(); ones handling responses on their own should
+        override this.
+
+        Args:
+            envelope (Envelope): The envelope of the message.
+
+        Returns:
+            False if the message can be dropped, True otherwise.
+        """
+        if envelope.namespace == 'rpc' and envelope.name in ('response', 'fragment', 'end', 'error'):
+            if envelope.id is not None and envelope.id not in self.pending_calls and \
+                    envelope.id not in self.subscriptions.requests:
+                if self.error_callback is not None:
+                    self.error_callback(ClientError.SPURIOUS_RPC_RESPONSE, envelope.id)
+
+                return False
+
+        if envelope.namespace == 'events' and envelope.name == 'event' and envelope.event is not None:
+            if type(self).on_events_event is not Connection.on_events_event:
+                # A subclass consumes events its own way, so none of them can be judged here
+                return True
+
+            if envelope.seqno is None and self.event_seqno is not None:
+                # Cannot tell where the sequence number is, so let the full decode find it
+                return True
+
+            if self.event_callback or self.event_router.route(envelope.event) or \
+                    self.waiter_router.route(envelope.event):
+                return True
+
+            if envelope.seqno is not None:
+                self.event_seqno = envelope.seqno
+                self.event_epoch = envelope.epoch
+
+            return False
+
+        return True
+
     def on_rpc_response(self, id, data):
         self.trace('RPC response: id={0}, data={1}'.format(id, data))
         try:
@@ -426,6 +1067,9 @@ class Connection(object):
 
             return
 
+        if call.compact:
+            data = self.records.convert(data)
+
         call.result = data
         call.ready.set()
         if call.callback is not None:
@@ -447,6 +1091,9 @@ class Connection(object):
 
             return
 
+        if call.compact:
+            data = self.records.convert(data)
+
         if not call.result:
             call.result = StreamingResultView(self, call) if call.view else StreamingResultIterator(self, call)
 
@@ -505,6 +1152,9 @@ class Connection(object):
         try:
             call = self.pending_calls[id]
         except KeyError:
+            if id is not None and self.on_subscription_rejected(id, data):
+                return
+
             if self.error_callback is not None:
                 self.error_callback(ClientError.SPURIOUS_RPC_RESPONSE, id)
 
@@ -520,6 +1170,26 @@ class Connection(object):
         if self.error_callback is not None:
             self.error_callback(ClientError.RPC_CALL_ERROR)
 
+    def on_subscription_rejected(self, id, data):
+        extra = data.get('extra') if isinstance(data, dict) else None
+        keys = self.subscriptions.reject(id, extra)
+        if keys is None:
+            return False
+
+        self.logger.warning('Event subscription refused: {0}'.format(
+            data.get('message') if isinstance(data, dict) else data
+        ))
+
+        # Waiters would otherwise sleep until their timeout for events that are never going to come
+        with self.waiter_router.lock:
+            waiters = [w for k in keys if isinstance(k, str) for w in self.waiter_router.handlers.get(k, ())]
+
+        for w in waiters:
+            w.error = rpc.RpcException(obj=data)
+            w.event.set()
+
+        return True
+
     def on_rpc_call(self, id, data):
         if self.rpc is None:
             self.send_error(id, errno.EINVAL, 'Server functionality is not supported')
@@ -693,6 +1363,7 @@ class Connection(object):
     def call_async(self, name, callback, *args, **kwargs):
         call = self.PendingCall(uuid.uuid4(), name, args)
         call.callback = callback
+        call.compact = kwargs.pop('compact', False)
         self.pending_calls[str(call.id)] = call
         self.call(call)
         return call
@@ -701,6 +1372,7 @@ class Connection(object):
         timeout = kwargs.pop('timeout', self.default_timeout)
         call = self.PendingCall(uuid.uuid4(), name, args)
         call.view = kwargs.pop('view', False)
+        call.compact = kwargs.pop('compact', False)
         self.pending_calls[str(call.id)] = call
         self.call(call)
 
@@ -723,7 +1395,7 @@ class Connection(object):
 
             self.send_continue(id, seqno)
             if sync:
-                call.cv.wait_for(lambda: call.seqno == seqno or call.closed)
+                call.cv.wait_for(lambda: call.seqno == seqno or call.partial == seqno or call.closed)
 
     def abort_call(self, id):
         call = self.pending_calls[str(id)]
@@ -741,12 +1413,59 @@ class Connection(object):
                 if not self.standalone_server:
                     self.call_sync('plugin.register_service', name)
 
+    def negotiate_codec(self, *codecs, features=None):
+        """ Ask the peer to switch to the first codec from the list it supports.
+
+        Frames are self-describing, so each side switches its outgoing codec
+        independently: the peer after replying, and this side upon the reply.
+
+        Args:
+            codecs (tuple): Codec names, in order of preference.
+            features (list): Framing extensions ('attachments', 'compression')
+                to enable if the peer supports them too.
+        """
+        self.send('codec', 'negotiate', {'codecs': list(codecs), 'features': list(features or [])})
+
+    def on_codec_negotiate(self, id, data):
+        if not isinstance(data, dict):
+            data = {}
+
+        supported = supported_codecs()
+        name = next((i for i in data.get('codecs', []) if i in supported), 'json')
+        features = [i for i in data.get('features', []) if i in supported_features()]
+        with self.rlock:
+            self.send('codec', 'selected', {'codec': name, 'features': features})
+            self.set_codec(name, features)
+
+    def on_codec_selected(self, id, data):
+        with self.rlock:
+            self.set_codec(data['codec'], set(data.get('features', [])) & set(supported_features()))
+
+    def set_codec(self, name, features):
+        self.codec = get_codec(name)
+        self.features = set(features)
+        self.compression = StreamCompressor() if 'compression' in self.features else None
+
     def on_events_event(self, id, data):
-        self.event_queue.put((data['name'], data['args']))
+        if data.get('seqno') is not None:
+            self.event_seqno = data['seqno']
+            self.event_epoch = data.get('epoch')
+
+        self.queue_event(data['name'], data['args'])
 
     def on_events_event_burst(self, id, data):
         for i in data['events']:
-            self.event_queue.put((i['name'], i['args']))
+            if i.get('seqno') is not None:
+                self.event_seqno = i['seqno']
+                self.event_epoch = i.get('epoch')
+
+            self.queue_event(i['name'], i['args'])
+
+    def on_events_resync(self, id, data):
+        self.event_seqno = data['seqno']
+        self.event_epoch = data.get('epoch')
+        if self.resync_callback is not None:
+            self.resync_callback()
 
     def on_events_logout(self, id, data):
         self.error_callback(ClientError.LOGOUT)
@@ -760,11 +1479,52 @@ class Connection(object):
     def on_error(self, callback):
         self.error_callback = callback
 
-    def subscribe_events(self, *masks):
-        self.send('events', 'subscribe', masks)
+    def on_resync(self, callback):
+        self.resync_callback = callback
+
+    def subscribe_events(self, *masks, filter=None):
+        """ Subscribe to events matching the given masks.
 
-    def unsubscribe_events(self, *masks):
-        self.send('events', 'unsubscribe', masks)
+        Subscriptions are refcounted together with the ones made by event handlers
+        and waiters; each call has to be balanced by unsubscribe_events().
+
+        Args:
+            masks (tuple): Event name masks (glob syntax).
+            filter (list): Optional filter over the event args, in the ``freenas.utils.query``
+                tuple syntax. Evaluated on the server side, so non-matching events are not sent.
+                Filters only narrow what the server sends: events matching another subscription
+                to the same mask are still delivered.
+        """
+        for i in masks:
+            self.subscriptions.acquire(i, flush=True, filter=filter)
+
+    def unsubscribe_events(self, *masks, filter=None):
+        for i in masks:
+            self.subscriptions.release(i, flush=True, filter=filter)
+
+    def resume_events(self, *masks, since=None, epoch=None):
+        """ Subscribe to events and replay the ones missed since the given sequence number.
+
+        The server replays buffered events newer than ``since`` before any new event is
+        delivered. If its replay buffer no longer covers the gap, or the server was
+        restarted in the meantime, an ``events.resync`` message is sent instead and
+        the resync callback is invoked, so that the caller can fall back to a full re-query.
+
+        Args:
+            masks (tuple): Event name masks (glob syntax).
+            since (int): Last sequence number seen. Defaults to the last one received
+                on this connection.
+            epoch (str): Server epoch ``since`` belongs to. Defaults to the last one
+                received on this connection.
+        """
+        if since is None:
+            since, epoch = self.event_seqno, self.event_epoch
+
+        if since is None:
+            self.subscribe_events(*masks)
+            return
+
+        self.subscriptions.resume(masks, since, epoch)
 
     def register_service(self, name, impl):
         if self.rpc is None:
@@ -827,11 +1587,8 @@ class Connection(object):
         self.send_event_burst(events)
 
     def register_event_handler(self, name, handler):
-        if name not in self.event_handlers:
-            self.event_handlers[name] = []
-
-        self.event_handlers[name].append(handler)
-        self.subscribe_events(name)
+        self.event_router.add(name, handler)
+        self.subscriptions.acquire(name)
         return handler
 
     def drop_pending_calls(self):
@@ -861,39 +1618,55 @@ class Connection(object):
             del self.pending_calls[key]
 
     def unregister_event_handler(self, name, handler):
-        self.event_handlers[name].remove(handler)
+        self.event_router.remove(name, handler)
+        self.subscriptions.release(name)
 
-    def exec_and_wait_for_event(self, event, match_fn, fn, timeout=None):
-        done = Event()
-        self.subscribe_events(event)
-        with self.event_distribution_lock:
-            fn()
+    def add_event_waiter(self, event, match_fn):
+        """ Register a one-shot waiter woken up by the first event matching the predicate.
 
-            def handler(args):
-                if match_fn(args):
-                    done.set()
+        Subscriptions made on behalf of waiters are refcounted, so concurrent waiters
+        on the same event share a single server-side subscription. The subscription
+        is flushed right away, so that the caller cannot miss the event.
 
-            self.register_event_handler(event, handler)
+        Args:
+            event (str): The event name, or a mask (glob syntax).
+            match_fn (callable): Predicate called with the event args.
 
-        done.wait(timeout=timeout)
-        self.unregister_event_handler(event, handler)
+        Returns:
+            An EventWaiter instance. Must be released with remove_event_waiter().
+        """
+        waiter = EventWaiter(event, match_fn)
+        # Registered first, so that a refusal of the subscription finds the waiter to wake up
+        self.waiter_router.add(event, waiter)
+        try:
+            self.subscriptions.acquire(event, flush=True)
+        except BaseException:
+            self.remove_event_waiter(waiter)
+            raise
 
-    def test_or_wait_for_event(self, event, match_fn, initial_condition_fn, timeout=None):
-        done = Event()
-        self.subscribe_events(event)
-        with self.event_distribution_lock:
-            if initial_condition_fn():
-                return
+        return waiter
 
-            def handler(args):
-                if match_fn(args):
-                    done.set()
+    def remove_event_waiter(self, waiter):
+        self.waiter_router.remove(waiter.name, waiter)
+        self.subscriptions.release(waiter.name)
+
+    def exec_and_wait_for_event(self, event, match_fn, fn, timeout=None):
+        waiter = self.add_event_waiter(event, match_fn)
+        try:
+            fn()
+            return waiter.wait(timeout)
+        finally:
+            self.remove_event_waiter(waiter)
 
-            self.register_event_handler(event, handler)
+    def test_or_wait_for_event(self, event, match_fn, initial_condition_fn, timeout=None):
+        waiter = self.add_event_waiter(event, match_fn)
+        try:
+            if initial_condition_fn():
+                return True
 
-        ret = done.wait(timeout=timeout)
-        self.unregister_event_handler(event, handler)
-        return ret
+            return waiter.wait(timeout)
+        finally:
+            self.remove_event_waiter(waiter)
 
     def get_lock(self, name):
         self.call_sync('lock.init', name)
@@ -952,10 +1725,20 @@ class Client(Connection):
         if self.connected:
             self.disconnect()
 
+        codec = kwargs.pop('codec', None)
+        features = kwargs.pop('features', None)
+        self.set_codec('json', [])
         self.transport = ClientTransport(self.parsed_url.scheme)
         self.transport.connect(self.parsed_url, self, **kwargs)
         debug_log('Connection opened, local address {0}', self.transport.address)
 
+        if (codec and codec != 'json') or features:
+            self.negotiate_codec(codec or 'json', 'json', features=features)
+
+        # Resubscribe to everything still referenced after a reconnect
+        self.subscriptions.reset()
+        self.subscriptions.flush()
+
     def disconnect(self):
         debug_log('Closing connection, local address {0}', self.transport.address)
         if not self.connected:
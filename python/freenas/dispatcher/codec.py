@@ -0,0 +1,452 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import re
+import time
+import zlib
+import struct
+import functools
+import calendar
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from freenas.dispatcher import Password
+from freenas.dispatcher.fd import FileDescriptor
+from freenas.dispatcher.jsonenc import JsonEncoder, dumps, loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_codecs = {}
+_pattern_type = type(re.compile(''))
+_json_default = JsonEncoder().default
+_attachments_header = struct.Struct('!BI')
+
+FRAME_ATTACHMENTS = 0x01
+FRAME_COMPRESSED = 0x02
+FEATURES = ('attachments', 'compression')
+COMPRESSION_THRESHOLD = 1024
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+ENVELOPE_PEEK_LENGTH = 512
+
+Envelope = namedtuple('Envelope', ['namespace', 'name', 'id', 'event', 'seqno', 'epoch'])
+_envelope_pattern = re.compile(
+    r'\{\s*"namespace"\s*:\s*"(\w+)"\s*,\s*"name"\s*:\s*"(\w+)"\s*,\s*"id"\s*:\s*(?:null|"([^"\\]*)")\s*,'
+    r'\s*"args"\s*:\s*(?:\{\s*"name"\s*:\s*"([^"\\]*)"\s*'
+    r'(?:,\s*"seqno"\s*:\s*(\d+)\s*,\s*"epoch"\s*:\s*(?:null|"([^"\\]*)"))?)?'
+)
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def codec(*names):
+    def wrapper(c):
+        for i in names:
+            _codecs[i] = c
+
+        c.name = names[0]
+        return c
+
+    return wrapper
+
+
+def get_codec(name):
+    try:
+        return _codecs[name]()
+    except KeyError:
+        raise ValueError('Unknown codec {0}'.format(name))
+
+
+def supported_codecs():
+    return list(_codecs.keys())
+
+
+def is_json(data):
+    """ Tells whether an encoded frame is a JSON document.
+
+    JSON frames always start with an object, while binary codecs never
+    produce a printable first byte, so the check is a single byte comparison.
+    """
+    if isinstance(data, str):
+        return True
+
+    return len(data) > 0 and data[0] in b'{ \t\r\n'
+
+
+def supported_features():
+    return list(FEATURES)
+
+
+def pack_attachments(body, attachments):
+    """ Build a frame carrying binary attachments after the encoded message.
+
+    The layout is a marker byte, the number of attachments, their lengths
+    (all unsigned 32-bit big endian), the encoded message and finally the raw
+    attachment segments. The message refers to them with {'$att': n}.
+
+    Args:
+        body (bytes): The encoded message.
+        attachments (list): Bytes-like attachment segments.
+
+    Returns:
+        The frame payload.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+
+    header = _attachments_header.pack(FRAME_ATTACHMENTS, len(attachments))
+    lengths = struct.pack('!{0}I'.format(len(attachments)), *(len(i) for i in attachments))
+    return b''.join([header, lengths, body] + attachments)
+
+
+def unpack_attachments(data):
+    """ Split a frame built by pack_attachments().
+
+    Nothing is copied: the message and the attachments are memoryviews into
+    the received buffer, which is kept alive for as long as any of them is.
+
+    Returns:
+        A tuple containing the encoded message and the list of attachments.
+    """
+    view = memoryview(data)
+    try:
+        _, count = _attachments_header.unpack_from(view)
+        offset = _attachments_header.size
+        lengths = struct.unpack_from('!{0}I'.format(count), view, offset)
+    except struct.error:
+        raise ValueError('Truncated attachments header')
+
+    offset += 4 * count
+    end = len(view) - sum(lengths)
+    if end < offset:
+        raise ValueError('Truncated attachments')
+
+    body = view[offset:end]
+    attachments = []
+    for i in lengths:
+        attachments.append(view[end:end + i])
+        end += i
+
+    return body, attachments
+
+
+def encode(codec, obj, fd_encoder=None, attachments=False):
+    """ Encode a message into a frame payload.
+
+    Args:
+        codec (Codec): The codec to use.
+        obj: The message.
+        fd_encoder (callable): See Codec.dumps().
+        attachments (bool): Whether large binary values may be sent as attachments.
+
+    Returns:
+        The frame payload.
+    """
+    if not attachments:
+        return codec.dumps(obj, fd_encoder=fd_encoder)
+
+    segments = []
+    result = codec.dumps(obj, fd_encoder=fd_encoder, attachments=segments)
+    if segments:
+        return pack_attachments(result, segments)
+
+    return result
+
+
+def peek_envelope(data):
+    """ Extract the envelope of a JSON frame without decoding its arguments.
+
+    Connection.pack() emits namespace, name and id ahead of the arguments, and
+    send_event() puts the event name, seqno and epoch ahead of the event
+    arguments, so all of them can be read off the first few hundred bytes.
+
+    Args:
+        data: The frame payload, after decompression.
+
+    Returns:
+        An Envelope, or None if the frame does not start with a recognizable envelope.
+    """
+    if not isinstance(data, str):
+        if len(data) > 0 and data[0] == FRAME_ATTACHMENTS:
+            try:
+                _, count = _attachments_header.unpack_from(data)
+            except struct.error:
+                return None
+
+            data = memoryview(data)[_attachments_header.size + 4 * count:]
+
+        if not is_json(data):
+            return None
+
+        data = str(bytes(data[:ENVELOPE_PEEK_LENGTH]), 'utf-8', 'replace')
+
+    match = _envelope_pattern.match(data, 0, ENVELOPE_PEEK_LENGTH)
+    if not match:
+        return None
+
+    namespace, name, id, event, seqno, epoch = match.groups()
+    return Envelope(namespace, name, id, event, int(seqno) if seqno is not None else None, epoch)
+
+
+def decode(data, fd_decoder=None):
+    """ Decode a frame payload, whatever the codec and framing extensions used.
+
+    Args:
+        data (bytes): The frame payload.
+        fd_decoder (callable): See Codec.loads().
+
+    Returns:
+        The decoded message.
+    """
+    attachments = None
+    if not isinstance(data, str) and len(data) > 0:
+        if data[0] == FRAME_COMPRESSED:
+            raise ValueError('Compressed frame received, but compression was not negotiated')
+
+        if data[0] == FRAME_ATTACHMENTS:
+            data, attachments = unpack_attachments(data)
+
+    return detect_codec(data).loads(data, fd_decoder=fd_decoder, attachments=attachments)
+
+
+class StreamCompressor(object):
+    """ zlib streams compressing the large frames of a connection.
+
+    Each direction uses a single stream for the whole lifetime of the connection,
+    flushed at every frame, so later frames are compressed against the history
+    of earlier ones. Frames have to be compressed in the order they are sent
+    and decompressed in the order they are received.
+
+    Compressed frames are prefixed with a 0x02 marker byte. Frames smaller than
+    the threshold are sent as they are and are not part of the stream.
+    A frame inflating to more than ``max_size`` bytes raises FrameTooLarge;
+    the stream cannot be used any further after that.
+    """
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=6, max_size=MAX_DECOMPRESSED_SIZE):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.compressor = zlib.compressobj(level)
+        self.decompressor = zlib.decompressobj()
+        self.frame_size = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    @property
+    def ratio(self):
+        """ Compressed to uncompressed size ratio of the frames sent so far. """
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        if len(data) < self.threshold:
+            return data
+
+        start = time.thread_time()
+        ret = b''.join((
+            bytes((FRAME_COMPRESSED,)),
+            self.compressor.compress(data),
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        ))
+
+        self.compress_time += time.thread_time() - start
+        self.frames_sent += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(ret)
+        return ret
+
+    def decompress(self, data):
+        if isinstance(data, str) or len(data) == 0 or data[0] != FRAME_COMPRESSED:
+            return data
+
+        self.begin_frame()
+        return self.decompress_chunk(memoryview(data)[1:])
+
+    def begin_frame(self):
+        """ Start decompressing a new frame received in pieces. """
+        self.frames_received += 1
+        self.frame_size = 0
+
+    def decompress_chunk(self, data):
+        """ Decompress a piece of a compressed frame, without the marker byte. """
+        start = time.thread_time()
+        try:
+            ret = self.decompressor.decompress(data, self.max_size - self.frame_size + 1)
+        except zlib.error as err:
+            raise ValueError('Cannot decompress frame: {0}'.format(err))
+
+        self.decompress_time += time.thread_time() - start
+        self.frame_size += len(ret)
+        if self.frame_size > self.max_size or self.decompressor.unconsumed_tail:
+            raise FrameTooLarge('Decompressed frame exceeds {0} bytes'.format(self.max_size))
+
+        return ret
+
+
+def detect_codec(data):
+    """ Return the codec able to decode a received frame.
+
+    Args:
+        data (bytes): The frame payload.
+
+    Returns:
+        A Codec instance.
+    """
+    if is_json(data):
+        return _json_codec
+
+    return _binary_codec or _json_codec
+
+
+class Codec(object):
+    name = None
+    binary = False
+
+    def dumps(self, obj, fd_encoder=None, attachments=None):
+        """ Encode a message.
+
+        Args:
+            obj: The message.
+            fd_encoder (callable): Called for every FileDescriptor found in the message;
+                returns the placeholder to encode in its place.
+            attachments (list): If given, large binary values may be appended to it
+                and replaced by {'$att': n} references instead of being encoded inline.
+        """
+        raise NotImplementedError()
+
+    def loads(self, data, fd_decoder=None, attachments=None):
+        """ Decode a message.
+
+        Args:
+            data (bytes): The encoded message.
+            fd_decoder (callable): Called with the value of every file descriptor placeholder.
+            attachments (list): Attachment segments the message may refer to.
+        """
+        raise NotImplementedError()
+
+
+@codec('json')
+class JsonCodec(Codec):
+    def dumps(self, obj, fd_encoder=None, attachments=None):
+        if fd_encoder is None and attachments is None:
+            return dumps(obj)
+
+        return dumps(obj, fd_encoder=fd_encoder, attachments=attachments)
+
+    def loads(self, data, fd_decoder=None, attachments=None):
+        if not isinstance(data, str):
+            data = str(data, 'utf-8')
+
+        return loads(data, fd_decoder, attachments)
+
+
+if msgpack:
+    @codec('msgpack')
+    class MsgpackCodec(Codec):
+        EXT_DATE = 1
+        EXT_REGEX = 2
+        EXT_PASSWORD = 3
+        EXT_FD = 4
+        NAIVE = -0x8000
+
+        binary = True
+
+        @classmethod
+        def encode_date(cls, obj):
+            offset = obj.utcoffset()
+            offset = cls.NAIVE if offset is None else int(offset.total_seconds() // 60)
+            seconds = calendar.timegm(obj.replace(tzinfo=None).timetuple())
+            return struct.pack('!qIh', seconds, obj.microsecond, offset)
+
+        @classmethod
+        def decode_date(cls, data):
+            seconds, usec, offset = struct.unpack('!qIh', data)
+            ret = datetime(1970, 1, 1) + timedelta(seconds=seconds, microseconds=usec)
+            if offset != cls.NAIVE:
+                ret = ret.replace(tzinfo=timezone(timedelta(minutes=offset)))
+
+            return ret
+
+        def default(self, obj, fd_encoder=None):
+            if fd_encoder is not None and type(obj) is FileDescriptor:
+                return msgpack.ExtType(self.EXT_FD, struct.pack('!i', fd_encoder(obj)['$fd']))
+
+            if type(obj) is datetime:
+                return msgpack.ExtType(self.EXT_DATE, self.encode_date(obj))
+
+            if type(obj) is _pattern_type:
+                return msgpack.ExtType(self.EXT_REGEX, obj.pattern.encode('utf-8'))
+
+            if type(obj) is Password:
+                return msgpack.ExtType(self.EXT_PASSWORD, obj.secret.encode('utf-8'))
+
+            return _json_default(obj)
+
+        def ext_hook(self, code, data, fd_decoder=None):
+            if code == self.EXT_FD:
+                value, = struct.unpack('!i', data)
+                return fd_decoder(value) if fd_decoder else {'$fd': value}
+
+            if code == self.EXT_DATE:
+                return self.decode_date(data)
+
+            if code == self.EXT_REGEX:
+                return re.compile(data.decode('utf-8'))
+
+            if code == self.EXT_PASSWORD:
+                return Password(data.decode('utf-8'))
+
+            return msgpack.ExtType(code, data)
+
+        def dumps(self, obj, fd_encoder=None, attachments=None):
+            # Binary values are native to msgpack, attachments would not save anything
+            default = self.default
+            if fd_encoder is not None:
+                default = functools.partial(self.default, fd_encoder=fd_encoder)
+
+            return msgpack.packb(obj, default=default, use_bin_type=True)
+
+        def loads(self, data, fd_decoder=None, attachments=None):
+            ext_hook = self.ext_hook
+            if fd_decoder is not None:
+                ext_hook = functools.partial(self.ext_hook, fd_decoder=fd_decoder)
+
+            return msgpack.unpackb(data, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+_json_codec = JsonCodec()
+_binary_codec = _codecs['msgpack']() if 'msgpack' in _codecs else None
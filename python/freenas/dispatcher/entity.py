@@ -49,9 +49,16 @@ class CappedDict(OrderedDict):
 
 
 class EntitySubscriber(object):
-    def __init__(self, client, name, maxsize=1000):
+    """ Keeps a local copy of the entities of a service, updated from its change events.
+
+    Entities are plain dictionaries, as query() and viewport() match them with
+    ``freenas.utils.query`` and callers are free to modify them. The ``compact``
+    argument is accepted for compatibility, but results are never decoded into records.
+    """
+    def __init__(self, client, name, maxsize=1000, compact=False):
         self.client = client
         self.name = name
+        self.compact = compact
         self.event_handler = None
         self.items = CappedDict(maxsize)
         self.on_add = set()
@@ -47,30 +47,62 @@ class ChannelSerializer(object):
     def replace_fds(self, obj, fds):
         raise NotImplementedError
 
+    def encode_fd(self, fd, fds):
+        """ Called by the encoder for every FileDescriptor found in an outgoing message.
 
-class UnixChannelSerializer(ChannelSerializer):
-    def collect_fds(self, obj, start=0):
-        idx = start
+        Args:
+            fd (FileDescriptor): The descriptor being encoded.
+            fds (list): Descriptors collected so far for this message; fd gets appended.
 
-        if isinstance(obj, dict):
-            for k, v in list(obj.items()):
-                if isinstance(v, FileDescriptor):
-                    obj[k] = {'$fd': idx}
-                    idx += 1
-                    yield v
-                else:
-                    for x in self.collect_fds(v, idx):
-                        yield x
+        Returns:
+            The {'$fd': ...} placeholder sent in place of the descriptor.
+        """
+        raise NotImplementedError()
 
-        if isinstance(obj, (list, tuple)):
-            for i, o in enumerate(obj):
-                if isinstance(o, FileDescriptor):
-                    obj[i] = {'$fd': idx}
-                    idx += 1
-                    yield o
-                else:
-                    for x in self.collect_fds(o, idx):
-                        yield x
+    def decode_fd(self, value, fds):
+        """ Called by the decoder for every {'$fd': value} placeholder of an incoming message.
+
+        Args:
+            value (int): The placeholder value.
+            fds (list): Descriptors received along with the message.
+
+        Returns:
+            A FileDescriptor instance or None.
+        """
+        raise NotImplementedError()
+
+
+class UnixChannelSerializer(ChannelSerializer):
+    def collect_fds(self, obj, start=0):
+        idx = [start]
+
+        def collect(obj):
+            if isinstance(obj, dict):
+                for k, v in list(obj.items()):
+                    if isinstance(v, FileDescriptor):
+                        obj[k] = {'$fd': idx[0]}
+                        idx[0] += 1
+                        yield v
+                    else:
+                        yield from collect(v)
+
+            if isinstance(obj, (list, tuple)):
+                for i, o in enumerate(obj):
+                    if isinstance(o, FileDescriptor):
+                        obj[i] = {'$fd': idx[0]}
+                        idx[0] += 1
+                        yield o
+                    else:
+                        yield from collect(o)
+
+        return collect(obj)
+
+    def encode_fd(self, fd, fds):
+        fds.append(fd)
+        return {'$fd': len(fds) - 1}
+
+    def decode_fd(self, value, fds):
+        return FileDescriptor(fds[value]) if value < len(fds) else None
 
     def replace_fds(self, obj, fds):
         if isinstance(obj, dict):
@@ -103,6 +135,13 @@ class MSockChannelSerializer(ChannelSerializer):
 
         return id
 
+    def encode_fd(self, fd, fds):
+        fds.append(fd)
+        return {'$fd': self.__fd_to_channel(fd.fd)}
+
+    def decode_fd(self, value, fds):
+        return FileDescriptor(self.__channel_to_fd(value))
+
     def collect_fds(self, obj, start=0):
         if isinstance(obj, dict):
             for k, v in list(obj.items()):
@@ -29,7 +29,9 @@ import base64
 import uuid
 import re
 import enum
+from functools import lru_cache
 from freenas.dispatcher import Password
+from freenas.dispatcher.fd import FileDescriptor
 from datetime import datetime
 from dateutil.parser import parse
 
@@ -40,33 +42,87 @@ except ImportError:
     import json
 
 
-class JsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if type(obj) is uuid.UUID:
-            return str(obj)
+_pattern_type = type(re.compile(''))
+_fromisoformat = getattr(datetime, 'fromisoformat', None)
 
-        if type(obj) is datetime:
-            return {'$date': str(obj)}
 
-        if type(obj) is re._pattern_type:
-            return {'$regex': obj.pattern}
+ATTACHMENT_THRESHOLD = 1024
 
-        if type(obj) is bytes:
-            return {'$binary': base64.b64encode(obj).decode('ascii')}
-            
-        if type(obj) is set:
-            return list(obj)
 
-        if type(obj) is Password:
-            return {'$password': obj.secret}
+def encode_binary(obj):
+    return {'$binary': base64.b64encode(obj).decode('ascii')}
+
+
+def encode_enum(obj):
+    return obj.value
+
+
+def encode_state(obj):
+    return obj.__getstate__()
+
+
+_default_getstate = getattr(object, '__getstate__', None)
+_encoders = {
+    uuid.UUID: str,
+    datetime: lambda obj: {'$date': str(obj)},
+    _pattern_type: lambda obj: {'$regex': obj.pattern},
+    bytes: encode_binary,
+    bytearray: encode_binary,
+    memoryview: encode_binary,
+    set: list,
+    Password: lambda obj: {'$password': obj.secret},
+}
+
 
-        if isinstance(obj, enum.Enum):
-            return obj.value
+def register_encoder(type, encoder):
+    """ Register a function converting instances of exactly the given type to a JSON-serializable value.
+
+    Args:
+        type (type): The type to register.
+        encoder (callable): A function taking the object and returning its encoded form.
+    """
+    _encoders[type] = encoder
+
+
+def unregister_encoder(type):
+    """ Remove the encoder registered for the given type, if any. """
+    _encoders.pop(type, None)
+
+
+def resolve_encoder(type):
+    """ Find an encoder for a type without an exact table entry and remember it. """
+    if issubclass(type, enum.Enum):
+        encoder = encode_enum
+    elif getattr(type, '__getstate__', _default_getstate) is not _default_getstate:
+        encoder = encode_state
+    else:
+        encoder = str
+
+    _encoders[type] = encoder
+    return encoder
+
+
+class JsonEncoder(json.JSONEncoder):
+    def __init__(self, *args, fd_encoder=None, attachments=None, **kwargs):
+        super(JsonEncoder, self).__init__(*args, **kwargs)
+        self.fd_encoder = fd_encoder
+        self.attachments = attachments
+
+    def default(self, obj):
+        if self.fd_encoder is not None and type(obj) is FileDescriptor:
+            return self.fd_encoder(obj)
 
-        if hasattr(obj, '__getstate__'):
-            return obj.__getstate__()
+        if self.attachments is not None and type(obj) in (bytes, bytearray, memoryview):
+            if len(obj) >= ATTACHMENT_THRESHOLD:
+                self.attachments.append(obj)
+                return {'$att': len(self.attachments) - 1}
 
-        return str(obj)
+        try:
+            encoder = _encoders[type(obj)]
+        except KeyError:
+            encoder = resolve_encoder(type(obj))
+
+        return encoder(obj)
 
 
 class DebugJsonEncoder(JsonEncoder):
@@ -77,10 +133,27 @@ class DebugJsonEncoder(JsonEncoder):
         return super(DebugJsonEncoder, self).default(obj)
 
 
+@lru_cache(maxsize=1024)
+def parse_date(s):
+    """ Parse a $date value.
+
+    JsonEncoder emits str(datetime), which datetime.fromisoformat() parses
+    directly. Anything else goes through the generic (and much slower) dateutil
+    parser. Results are cached, since the same timestamp tends to appear many times.
+    """
+    if _fromisoformat:
+        try:
+            return _fromisoformat(s)
+        except ValueError:
+            pass
+
+    return parse(s)
+
+
 def decode_hook(obj):
     if len(obj) == 1:
         if '$date' in obj:
-            return parse(obj['$date'])
+            return parse_date(obj['$date'])
 
         if '$binary' in obj:
             return base64.b64decode(obj['$binary'])
@@ -94,12 +167,64 @@ def decode_hook(obj):
     return obj
 
 
+def decode_tagged(obj, fd_decoder=None, attachments=None):
+    """ Replace tagged sub-objects ({'$date': ...} and the like) of a decoded document.
+
+    Containers are modified in place; only dictionaries and lists are descended into.
+
+    Args:
+        obj: The decoded document.
+        fd_decoder (callable): Converts the value of {'$fd': ...} placeholders.
+            Placeholders are left alone if not given.
+        attachments (list): Attachment segments referenced by {'$att': n} placeholders.
+
+    Returns:
+        The document with tagged values converted.
+    """
+    if type(obj) is dict:
+        if len(obj) == 1:
+            if fd_decoder is not None and '$fd' in obj:
+                return fd_decoder(obj['$fd'])
+
+            if attachments is not None and '$att' in obj:
+                idx = obj['$att']
+                return attachments[idx] if type(idx) is int and 0 <= idx < len(attachments) else None
+
+            ret = decode_hook(obj)
+            if ret is not obj:
+                return ret
+
+        for k, v in obj.items():
+            if type(v) is dict or type(v) is list:
+                obj[k] = decode_tagged(v, fd_decoder, attachments)
+
+    elif type(obj) is list:
+        for i, v in enumerate(obj):
+            if type(v) is dict or type(v) is list:
+                obj[i] = decode_tagged(v, fd_decoder, attachments)
+
+    return obj
+
+
+def has_tags(s):
+    """ Cheaply tell whether an encoded document may contain tagged values.
+
+    Every tag is an object key starting with a dollar sign, so its encoded form
+    always contains a double quote immediately followed by a dollar sign.
+    """
+    return ('"$' if isinstance(s, str) else b'"$') in s
+
+
 def load(fp):
-    return json.load(fp, object_hook=decode_hook)
+    return loads(fp.read())
 
 
-def loads(s):
-    return json.loads(s, object_hook=decode_hook)
+def loads(s, fd_decoder=None, attachments=None):
+    obj = json.loads(s)
+    if has_tags(s):
+        return decode_tagged(obj, fd_decoder, attachments)
+
+    return obj
 
 
 def dump(obj, fp, **kwargs):
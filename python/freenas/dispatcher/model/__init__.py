@@ -27,7 +27,7 @@
 
 import sys
 from freenas.dispatcher.rpc import convert_schema
-from freenas.utils import extend, include
+from freenas.dispatcher.jsonenc import register_encoder, unregister_encoder
 import enum
 
 
@@ -60,6 +60,10 @@ class NamedObject(BaseObject):
         if ObjectRef in cls.__mro__:
             return
 
+        previous = context.type_enumerator.structures.get(cls.__name__)
+        if previous is not None:
+            unregister_encoder(previous)
+
         context.type_enumerator.structures[cls.__name__] = cls
 
     def __str__(self):
@@ -71,9 +75,33 @@ class ObjectRef(NamedObject):
         return "<ObjectRef '{0}'>".format(self.__class__.__name__)
 
 
+def struct_serializer(cls):
+    """ Build a function serializing instances of a BaseStruct subclass.
+
+    The field list is computed once from the class annotations, and the
+    serializer builds the resulting dictionary in a single pass.
+    """
+    name = cls.__name__
+    fields = tuple(getattr(cls, '__annotations__', {}).keys())
+
+    def serialize(obj):
+        values = obj._dict
+        ret = {k: values[k] for k in fields if k in values}
+        ret['%type'] = name
+        return ret
+
+    return serialize
+
+
 class BaseStruct(NamedObject):
     _additional_properties = False
 
+    def __init_subclass__(cls, *args, **kwargs):
+        super(BaseStruct, cls).__init_subclass__(*args, **kwargs)
+        cls._serializer = staticmethod(struct_serializer(cls))
+        if cls.__getstate__ is BaseStruct.__getstate__:
+            register_encoder(cls, cls._serializer)
+
     @classmethod
     def __named_json_schema__(cls):
         return cls.__name__, {
@@ -112,10 +140,7 @@ class BaseStruct(NamedObject):
         self._dict[key] = value
 
     def __getstate__(self):
-        return extend(
-            include(self._dict, *getattr(self, '__annotations__', {}).keys()),
-            {'%type': self.__class__.__name__}
-        )
+        return self._serializer(self)
 
     def __setstate__(self, state):
         self.__dict__['_dict'] = state
@@ -130,6 +155,9 @@ class BaseStruct(NamedObject):
         pass
 
 
+BaseStruct._serializer = staticmethod(struct_serializer(BaseStruct))
+
+
 class BaseEnum(NamedObject, enum.Enum):
     @classmethod
     def __named_json_schema__(cls):
@@ -246,7 +274,9 @@ class Context(object):
             self.type_enumerator.construct_type(name, definition)
 
     def unregister_schema(self, name):
-        self.type_enumerator.structures.pop(name, None)
+        cls = self.type_enumerator.structures.pop(name, None)
+        if cls is not None:
+            unregister_encoder(cls)
 
     @property
     def client(self):
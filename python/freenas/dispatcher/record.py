@@ -0,0 +1,120 @@
+#+
+# Copyright 2017 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import sys
+import copy
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """ Read-only mapping backed by a tuple of values.
+
+    Records of the same shape share a single subclass holding the key names
+    and their positions, so a record only stores its values. Use copy() to
+    get a mutable dictionary.
+    """
+    __slots__ = ('_values',)
+    _keys = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def get(self, key, default=None):
+        idx = self._index.get(key)
+        return default if idx is None else self._values[idx]
+
+    def copy(self):
+        return dict(zip(self._keys, self._values))
+
+    def __getstate__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.copy(), memo)
+
+
+class RecordFactory(object):
+    """ Converts decoded dictionaries into records, one record class per key set.
+
+    Key names are interned and the record classes are cached, so a factory kept
+    for the lifetime of a connection shares them across all the messages it receives.
+    Past ``max_shapes`` distinct key sets, dictionaries are left as they are.
+    """
+    def __init__(self, max_shapes=4096):
+        self.max_shapes = max_shapes
+        self.shapes = {}
+
+    def record_class(self, keys):
+        try:
+            return self.shapes[keys]
+        except KeyError:
+            pass
+
+        if len(self.shapes) >= self.max_shapes:
+            return None
+
+        keys = tuple(sys.intern(k) if type(k) is str else k for k in keys)
+        cls = type('Record', (Record,), {
+            '__slots__': (),
+            '_keys': keys,
+            '_index': {k: i for i, k in enumerate(keys)}
+        })
+
+        self.shapes[keys] = cls
+        return cls
+
+    def convert(self, obj):
+        """ Recursively replace the dictionaries of a decoded document with records. """
+        if type(obj) is dict:
+            cls = self.record_class(tuple(obj))
+            values = tuple(self.convert(v) if type(v) in (dict, list) else v for v in obj.values())
+            if cls is None:
+                return dict(zip(obj, values))
+
+            return cls(values)
+
+        if type(obj) is list:
+            return [self.convert(v) if type(v) in (dict, list) else v for v in obj]
+
+        return obj
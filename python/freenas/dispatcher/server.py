@@ -27,11 +27,15 @@
 
 import fnmatch
 import re
+import errno
+import uuid
 import contextlib
 import threading
+from collections import deque
 from urllib.parse import urlsplit
+from freenas.utils import query as q
 from freenas.dispatcher.rpc import RpcContext
-from freenas.dispatcher.client import Connection
+from freenas.dispatcher.client import Connection, subscription_key
 from freenas.dispatcher.transport import ServerTransport
 
 
@@ -43,13 +47,43 @@ def match_event(name, pat):
         return pat.match(name) is not None
 
 
+def compile_filter(rules):
+    """ Compile an event payload filter into a predicate.
+
+    Args:
+        rules (list): Filter expression in the ``freenas.utils.query`` tuple syntax.
+
+    Returns:
+        A callable taking event args and returning True when they match.
+
+    Raises:
+        ValueError: The filter is not a list of rules.
+    """
+    if not isinstance(rules, list) or not all(isinstance(r, (list, tuple)) for r in rules):
+        raise ValueError('Event filter must be a list of rules')
+
+    rules = [tuple(r) for r in rules]
+
+    def predicate(args):
+        try:
+            return q.matches(args, *rules)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return False
+
+    return predicate
+
+
 class ServerConnection(Connection):
     def __init__(self, parent):
         super(ServerConnection, self).__init__()
         self.parent = parent
         self.streaming = False
         self.event_masks = set()
+        self.event_filters = {}
         self.event_subscription_lock = threading.Lock()
+        self.event_order_lock = threading.Lock()
+        self.event_replayed = None
+        self.events_lost = False
 
     def on_open(self):
         if self.parent.channel_serializer:
@@ -69,23 +103,114 @@ class ServerConnection(Connection):
         if not isinstance(event_masks, list):
             return
 
+        masks = set()
+        filters = {}
+        for i in event_masks:
+            if isinstance(i, str):
+                masks.add(i)
+                continue
+
+            if isinstance(i, dict) and isinstance(i.get('mask'), str):
+                if i.get('filter'):
+                    try:
+                        predicate = compile_filter(i['filter'])
+                    except ValueError as err:
+                        self.send_error(id, errno.EINVAL, 'Invalid filter for {0}: {1}'.format(i['mask'], err), i)
+                        continue
+
+                    filters[subscription_key(i['mask'], i['filter'])] = (i['mask'], predicate)
+                else:
+                    masks.add(i['mask'])
+
         with self.event_subscription_lock:
-            self.event_masks = set.union(self.event_masks, set(event_masks))
+            self.event_masks = set.union(self.event_masks, masks)
+            self.event_filters = dict(self.event_filters)
+            self.event_filters.update(filters)
 
     def on_events_unsubscribe(self, id, event_masks):
         if not isinstance(event_masks, list):
             return
 
+        masks = set()
+        filters = set()
+        for i in event_masks:
+            if isinstance(i, str):
+                masks.add(i)
+            elif isinstance(i, dict) and isinstance(i.get('mask'), str):
+                if i.get('filter'):
+                    filters.add(subscription_key(i['mask'], i['filter']))
+                else:
+                    masks.add(i['mask'])
+
         with self.event_subscription_lock:
-            self.event_masks = set.difference(self.event_masks, set(event_masks))
+            self.event_masks = set.difference(self.event_masks, masks)
+            self.event_filters = {k: v for k, v in self.event_filters.items() if k not in filters}
+
+    def match_event(self, name, params):
+        if any(match_event(name, i) for i in self.event_masks):
+            return True
+
+        for mask, predicate in list(self.event_filters.values()):
+            if match_event(name, mask) and predicate(params):
+                return True
+
+        return False
+
+    def on_events_resume(self, id, args):
+        if not isinstance(args, dict) or not isinstance(args.get('since'), int):
+            return
+
+        # Live events broadcast while the replay is being sent wait for it on
+        # event_order_lock, and the ones already covered by the replay are skipped
+        with self.event_order_lock:
+            with self.parent.event_lock:
+                self.on_events_subscribe(id, args.get('masks', []))
+                epoch = self.parent.event_epoch
+                seqno = self.parent.event_seqno
+                events = None
+                if args.get('epoch') == epoch:
+                    events = self.parent.replay_events(args['since'])
+
+            self.event_replayed = seqno
+            if events is None:
+                self.send('events', 'resync', {'seqno': seqno, 'epoch': epoch})
+                return
+
+            events = [
+                {'name': name, 'args': params, 'seqno': seqno, 'epoch': epoch}
+                for seqno, name, params in events if self.match_event(name, params)
+            ]
+
+            if events:
+                self.send_event_burst(events)
+
+    def emit_event(self, name, params, seqno=None, epoch=None):
+        with self.event_order_lock:
+            if seqno is not None and self.event_replayed is not None and seqno <= self.event_replayed:
+                return
+
+            if not self.match_event(name, params):
+                return
+
+            if self.events_lost and seqno is not None:
+                # Tell the client about the events it missed, so that it can re-query
+                self.events_lost = not self.offer('events', 'resync', {'seqno': seqno - 1, 'epoch': epoch})
+                if self.events_lost:
+                    return
 
-    def emit_event(self, name, params):
-        if any(match_event(name, i) for i in list(self.event_masks)):
-            super(ServerConnection, self).emit_event(name, params)
+            key = (name, params.get('id')) if isinstance(params, dict) and 'id' in params else None
+            if not self.offer('events', 'event', self.event_payload(name, params, seqno, epoch), key=key):
+                self.events_lost = True
+
+    @property
+    def send_buffer_stats(self):
+        """ Send buffer usage of the connection, or None if its transport has no bounded buffer. """
+        outbound = getattr(self.transport, 'outbound', None)
+        return outbound.stats if outbound else None
 
 
 class Server(object):
-    def __init__(self, context=None, connection_class=ServerConnection):
+    def __init__(self, context=None, connection_class=ServerConnection, replay_size=1000):
         self.server_transport = None
         self.connection_class = connection_class
         self.parsed_url = None
@@ -96,6 +221,11 @@ class Server(object):
         self.channel_serializer = None
         self.context = context or RpcContext()
         self.connections = []
+        self.event_seqno = 0
+        self.event_epoch = str(uuid.uuid4())
+        self.event_replay = deque(maxlen=replay_size)
+        self.event_lock = threading.RLock()
+        self.broadcast_lock = threading.Lock()
 
     def parse_url(self, url):
         self.parsed_url = urlsplit(url)
@@ -126,6 +256,36 @@ class Server(object):
 
         return conn
 
+    def replay_events(self, since):
+        """ Return events broadcast after the given sequence number.
+
+        Sequence numbers are only meaningful within the same event_epoch,
+        which changes every time the server is restarted.
+
+        Args:
+            since (int): The last sequence number seen by the client.
+
+        Returns:
+            A list of (seqno, name, args) tuples, or None if the gap cannot be filled
+            from the replay buffer and the client has to resynchronize.
+        """
+        with self.event_lock:
+            if since > self.event_seqno:
+                return None
+
+            if since < self.event_seqno and (not self.event_replay or self.event_replay[0][0] > since + 1):
+                return None
+
+            return [i for i in self.event_replay if i[0] > since]
+
     def broadcast_event(self, event, args):
-        for i in self.connections:
-            i.emit_event(event, args)
+        # Fanning out under the lock that orders sequence numbers delivers events in that order.
+        # event_lock cannot be it, as resuming connections take it within their event_order_lock.
+        with self.broadcast_lock:
+            with self.event_lock:
+                self.event_seqno += 1
+                seqno = self.event_seqno
+                self.event_replay.append((seqno, event, args))
+
+            for i in list(self.connections):
+                i.emit_event(event, args, seqno, self.event_epoch)
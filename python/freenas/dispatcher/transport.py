@@ -28,6 +28,9 @@
 from __future__ import print_function
 import array
 import os
+import mmap
+import fcntl
+import tempfile
 import errno
 import paramiko
 import socket
@@ -36,10 +39,15 @@ import time
 import logging
 import contextlib
 import struct
+import itertools
+import functools
+import hashlib
+import selectors
+from collections import deque
 from freenas.utils.url import wrap_address
-from threading import RLock, Event
-from freenas.utils import xrecvmsg, xsendmsg
+from threading import Lock, RLock, Event, Condition
 from freenas.utils.spawn_thread import spawn_thread
+from freenas.dispatcher.codec import FrameTooLarge
 from ws4py.client.threadedclient import WebSocketClient
 
 # if we have py-wsaccel (accelerator) use it to hotpatch ws4py's
@@ -52,7 +60,35 @@ except:
     pass
 
 MAXFDS = 128
+INCREMENTAL_THRESHOLD = 1024 * 1024
+INCREMENTAL_CHUNK_SIZE = 256 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+SCATTER_THRESHOLD = 32 * 1024
+REACTOR_THREADS = 2
+INBOX_LIMIT = 64
+HEADER = struct.Struct('II')
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+SEND_BUFFER_LIMIT = 4 * 1024 * 1024
+LISTEN_BACKLOG = 128
+CONNECT_ATTEMPT_DELAY = 0.25
+TCP_OPTIONS = {
+    'nodelay': True,
+    'keepalive': False,
+    'keepalive_idle': None,
+    'keepalive_interval': None,
+    'keepalive_count': None,
+    'sndbuf': None,
+    'rcvbuf': None
+}
+OVERFLOW_POLICIES = ('drop', 'conflate', 'disconnect')
 CMSGCRED_SIZE = struct.calcsize('iiiih16i')
+SCM_CREDS = getattr(socket, 'SCM_CREDS', None)
+SHM_RING_SIZE = 4 * 1024 * 1024
+SHM_MAX_RING_SIZE = 256 * 1024 * 1024
+SHM_MAGIC = 0x73686d31
+SHM_HELLO = struct.Struct('II')
+SHM_DESCRIPTORS = 0xfdfdfdfd
+SHM_SEALS = getattr(fcntl, 'F_SEAL_SHRINK', 0) | getattr(fcntl, 'F_SEAL_SEAL', 0)
 _debug_log_file = None
 _client_transports = {}
 _server_transports = {}
@@ -78,6 +114,918 @@ def debug_log(message, *args):
         _debug_log_file.flush()
 
 
+def encode_message(message):
+    if isinstance(message, str):
+        return message.encode('utf-8')
+
+    return message
+
+
+def check_frame_length(length, limit):
+    """ Reject a frame whose header announces a body larger than the limit.
+
+    It is called before anything is allocated for the body, so that a corrupt
+    or hostile header cannot make the receiver reserve up to 4 GiB of memory.
+
+    Args:
+        length (int): The body length from the frame header.
+        limit (int): The maximum body length, None for no limit.
+
+    Raises:
+        FrameTooLarge
+    """
+    if limit and length > limit:
+        raise FrameTooLarge('Frame of {0} bytes exceeds the limit of {1} bytes'.format(length, limit))
+
+
+def recv_body(reader, length, parent, fds=None):
+    """ Receive a frame body.
+
+    Large bodies are fed chunk by chunk to the receiver if it is able to parse
+    them incrementally, in which case the message is already delivered upon return.
+    The chunks are slices of a single buffer reused for the whole body.
+
+    Args:
+        reader (FrameReader): The reader to receive from.
+        length (int): The body length.
+        parent: The receiving connection.
+        fds (list): File descriptors received along with the frame.
+
+    Returns:
+        The body, None if it was delivered incrementally or b'' on a short read.
+    """
+    begin = getattr(parent, 'begin_message', None)
+    sink = begin(length, fds) if begin and length >= INCREMENTAL_THRESHOLD else None
+    if not sink:
+        message = reader.read(length)
+        return message if len(message) == length else b''
+
+    chunk = memoryview(bytearray(INCREMENTAL_CHUNK_SIZE))
+    remaining = length
+    while remaining:
+        view = chunk[:min(remaining, len(chunk))]
+        if reader.readinto(view) != len(view):
+            return b''
+
+        sink.feed(view)
+        remaining -= len(view)
+
+    sink.finish()
+
+
+class FrameReader(object):
+    """ Splits the byte stream of a socket into frames.
+
+    Data is read in large chunks into a reusable buffer, so a burst of small
+    frames costs a single syscall instead of two per frame. When ancillary data
+    is expected, a read never extends past the header of the following frame,
+    so that received file descriptors unambiguously belong to the frame whose
+    header came along with them.
+
+    Args:
+        source: A socket, or for streams without ancillary data, anything with recv_into() or readinto().
+        ancbufsize (int): Room for ancillary data in each read, 0 if none is expected.
+        bufsize (int): The size of the reusable buffer.
+    """
+    def __init__(self, source, ancbufsize=0, bufsize=READ_BUFFER_SIZE):
+        self.source = source
+        self.ancbufsize = ancbufsize
+        self.recv_into = getattr(source, 'recv_into', None) or source.readinto
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.ancdata = []
+
+    def recv(self, view):
+        if not self.ancbufsize:
+            return self.recv_into(view) or 0
+
+        nbytes, ancdata, flags, addr = self.source.recvmsg_into([view], self.ancbufsize)
+        if ancdata:
+            self.ancdata.extend(ancdata)
+
+        return nbytes
+
+    def fill(self, needed, readahead=0):
+        """ Buffer at least the requested number of bytes.
+
+        Returns:
+            False if the stream ended first.
+        """
+        while self.end - self.start < needed:
+            if not self.fill_once(needed, readahead):
+                return False
+
+        return True
+
+    def fill_once(self, needed, readahead=0):
+        """ Perform a single read towards buffering the requested number of bytes.
+
+        On a non-blocking socket, BlockingIOError propagates with the buffer intact.
+
+        Returns:
+            The number of bytes read, 0 if the stream ended.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.start < needed:
+            length = self.end - self.start
+            self.buffer[:length] = self.view[self.start:self.end].tobytes()
+            self.start, self.end = 0, length
+
+        limit = len(self.buffer) - self.end
+        if self.ancbufsize:
+            limit = min(limit, needed - (self.end - self.start) + readahead)
+
+        nbytes = self.recv(self.view[self.end:self.end + limit])
+        self.end += nbytes
+        return nbytes
+
+    def consume(self, length):
+        start = self.start
+        self.start = min(start + length, self.end)
+        return self.view[start:self.start].tobytes()
+
+    def read_header(self):
+        """ Read a frame header.
+
+        Returns:
+            A tuple containing the header, which is short if the stream ended, and
+            the ancillary data received along with it.
+        """
+        if self.end - self.start < HEADER.size:
+            self.fill(HEADER.size)
+
+        ancdata = self.ancdata or ()
+        if ancdata:
+            self.ancdata = []
+
+        return self.consume(HEADER.size), ancdata
+
+    def read(self, length):
+        """ Read exactly the requested number of bytes, unless the stream ends first.
+
+        Lengths exceeding the buffer are read directly into a buffer of their own,
+        which is handed over instead of being copied.
+        """
+        if length <= len(self.buffer):
+            if self.end - self.start < length:
+                self.fill(length, HEADER.size)
+
+            return self.consume(length)
+
+        result = bytearray(length)
+        nbytes = self.readinto(memoryview(result))
+        return result if nbytes == length else result[:nbytes]
+
+    def readinto(self, view):
+        """ Fill a caller provided buffer, unless the stream ends first.
+
+        Data already buffered is copied over; the rest is received in place.
+
+        Returns:
+            The number of bytes stored.
+        """
+        done = min(self.end - self.start, len(view))
+        view[:done] = self.view[self.start:self.start + done]
+        self.start += done
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        while done < len(view):
+            nbytes = self.recv(view[done:])
+            if not nbytes:
+                break
+
+            done += nbytes
+
+        return done
+
+
+def frame_buffers(data):
+    """ Build the buffers of a frame carrying an encoded message.
+
+    The header and body are passed to sendmsg() separately, unless the body
+    is small enough for joining them to be cheaper than an extra iovec.
+    """
+    header = HEADER.pack(0xdeadbeef, len(data))
+    if len(data) < SCATTER_THRESHOLD:
+        return [header + data]
+
+    return [header, data]
+
+
+def wait_writable(sock, deadline):
+    """ Wait until a socket can be written to, or raise ETIMEDOUT once the deadline passed. """
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT)
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not poller.poll(remaining * 1000):
+        raise OSError(errno.ETIMEDOUT, 'Operation timed out')
+
+
+def sendmsg_all(sock, buffers, ancdata=None, timeout=None):
+    """ Send a list of buffers with a single sendmsg() call in the common case.
+
+    Ancillary data goes along with the first call only; partial sends are resumed
+    from where they stopped, without joining the buffers.
+
+    Args:
+        sock (socket): The socket to send to.
+        buffers (list): Bytes-like objects.
+        ancdata (list): Ancillary data, as accepted by socket.sendmsg().
+        timeout (float): If set, every write is attempted without blocking, and only
+            when the socket buffer is full, the socket is polled until it is writable
+            again, for at most this many seconds overall.
+
+    Raises:
+        OSError: ETIMEDOUT if the timeout expired before everything was sent.
+    """
+    ancdata = ancdata or []
+    flags = 0 if timeout is None else socket.MSG_DONTWAIT
+    try:
+        sent = sock.sendmsg(buffers, ancdata, flags)
+    except BlockingIOError:
+        sent = 0
+
+    if sent == sum(len(i) for i in buffers):
+        return
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        if sent:
+            ancdata = []
+
+        buffers = unsent(buffers, sent)
+        if not buffers:
+            return
+
+        if deadline is not None:
+            wait_writable(sock, deadline)
+
+        try:
+            sent = sock.sendmsg(buffers, ancdata, flags)
+        except BlockingIOError:
+            sent = 0
+
+
+def unsent(buffers, sent):
+    """ Return what is left of a list of buffers after a partial write of the given number of bytes. """
+    buffers = list(buffers)
+    while buffers and sent >= len(buffers[0]):
+        sent -= len(buffers.pop(0))
+
+    if buffers and sent:
+        buffers[0] = memoryview(buffers[0])[sent:]
+
+    return buffers
+
+
+def writev_all(fd, buffers):
+    """ Write a list of buffers to a file descriptor, resuming partial writes without joining the buffers. """
+    while buffers:
+        buffers = unsent(buffers, os.writev(fd, buffers))
+
+
+def close_fds(fds):
+    """ Close the descriptors that were passed on with close=True, once they were sent. """
+    for i in fds:
+        if i.close:
+            with contextlib.suppress(OSError):
+                os.close(i.fd)
+
+
+def pop_tcp_options(kwargs):
+    """ Take the TCP socket options out of transport keyword arguments.
+
+    Returns:
+        A dict with every option of TCP_OPTIONS, the ones not given set to their defaults.
+    """
+    return {k: kwargs.pop(k, v) for k, v in TCP_OPTIONS.items()}
+
+
+def set_tcp_options(sock, nodelay=True, keepalive=False, keepalive_idle=None,
+                    keepalive_interval=None, keepalive_count=None, sndbuf=None, rcvbuf=None):
+    """ Apply TCP options to a socket.
+
+    Args:
+        sock (socket): The socket.
+        nodelay (bool): Disable Nagle's algorithm, so that small requests and responses go out at once.
+        keepalive (bool): Enable keepalive probes.
+        keepalive_idle (int): Seconds of idleness before the first probe.
+        keepalive_interval (int): Seconds between probes.
+        keepalive_count (int): Unanswered probes before the connection is dropped.
+        sndbuf (int): Socket send buffer size.
+        rcvbuf (int): Socket receive buffer size.
+    """
+    if nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    if keepalive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (
+            ('TCP_KEEPIDLE', keepalive_idle),
+            ('TCP_KEEPINTVL', keepalive_interval),
+            ('TCP_KEEPCNT', keepalive_count)
+        ):
+            # Not every platform lets the probes be tuned per socket
+            if value is not None and hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+
+def interleave_addresses(addrinfo):
+    """ Reorder getaddrinfo() results so that address families alternate, as RFC 8305 recommends. """
+    families = {}
+    for i in addrinfo:
+        families.setdefault(i[0], []).append(i)
+
+    return [i for i in itertools.chain.from_iterable(itertools.zip_longest(*families.values())) if i]
+
+
+def connect_parallel(addrinfo, timeout=None, delay=CONNECT_ATTEMPT_DELAY):
+    """ Connect to the first address that answers, Happy Eyeballs style.
+
+    A new attempt starts whenever the previous one failed or has not succeeded within
+    the delay, without abandoning the ones still in progress; the first connection
+    established wins and the others are closed.
+
+    Args:
+        addrinfo (list): getaddrinfo() results, tried in order.
+        timeout (float): Seconds to wait for a connection overall, or None to wait
+            for the attempts to succeed or fail on their own.
+        delay (float): Seconds between the start of two attempts.
+
+    Returns:
+        A connected, blocking socket.
+
+    Raises:
+        OSError: ETIMEDOUT if the timeout expired, or the error of the last attempt.
+    """
+    addrinfo = list(addrinfo)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    attempts = []
+    error = OSError(errno.EHOSTUNREACH, 'No address to connect to')
+    result = None
+    try:
+        next_attempt = time.monotonic()
+        while result is None and (addrinfo or attempts):
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise OSError(errno.ETIMEDOUT, 'Operation timed out')
+
+            if addrinfo and now >= next_attempt:
+                af, type, proto, canonname, sockaddr = addrinfo.pop(0)
+                next_attempt = now + delay
+                try:
+                    s = socket.socket(af, type, proto)
+                except OSError as err:
+                    error = err
+                    next_attempt = now
+                    continue
+
+                s.setblocking(False)
+                code = s.connect_ex(sockaddr)
+                if code == 0:
+                    result = s
+                    break
+
+                if code not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    error = OSError(code, os.strerror(code))
+                    next_attempt = now
+                    s.close()
+                    continue
+
+                attempts.append(s)
+                selector.register(s, selectors.EVENT_WRITE)
+
+            wait = [i - now for i in (deadline, next_attempt if addrinfo else None) if i is not None]
+            for key, _ in selector.select(max(0, min(wait)) if wait else None):
+                s = key.fileobj
+                selector.unregister(s)
+                attempts.remove(s)
+                code = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    result = s
+                    break
+
+                error = OSError(code, os.strerror(code))
+                next_attempt = now
+                s.close()
+
+        if result is None:
+            raise error
+
+        result.setblocking(True)
+        return result
+    finally:
+        for s in attempts:
+            s.close()
+
+        selector.close()
+
+
+def create_shm(size):
+    """ Create an anonymous shared memory object that cannot be shrunk once mapped.
+
+    Returns:
+        Its file descriptor.
+    """
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('dispatcher', os.MFD_CLOEXEC | getattr(os, 'MFD_ALLOW_SEALING', 0))
+    else:
+        with tempfile.TemporaryFile() as f:
+            fd = os.dup(f.fileno())
+
+    try:
+        os.ftruncate(fd, size)
+        if SHM_SEALS and hasattr(os, 'memfd_create'):
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, SHM_SEALS)
+    except OSError:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+class ShmRing(object):
+    """ Single producer, single consumer byte ring in shared memory.
+
+    The head and tail are ever increasing byte counts, kept on cache lines of their
+    own at the start of the mapping and written by the producer and the consumer
+    respectively, each with a single aligned store; struct.pack_into() would zero
+    them first, for the peer to see. Ordering these stores after the data they
+    publish is left to the hardware, as on amd64. The peer is trusted with neither
+    position, so inconsistent ones are rejected rather than followed out of the ring.
+
+    Args:
+        fd (int): The shared memory object, which stays mapped after it is closed.
+        size (int): The size of the mapping.
+    """
+    HEAD = 0
+    TAIL = 8
+    SLEEPING = 72
+    DATA = 128
+
+    def __init__(self, fd, size):
+        self.map = mmap.mmap(fd, size)
+        self.view = memoryview(self.map)
+        self.position = self.view[:self.DATA].cast('Q')
+        self.capacity = size - self.DATA
+
+    @property
+    def head(self):
+        return self.position[self.HEAD]
+
+    @property
+    def tail(self):
+        return self.position[self.TAIL]
+
+    @property
+    def sleeping(self):
+        """ Whether the consumer is waiting for a wakeup. """
+        return self.map[self.SLEEPING] != 0
+
+    @sleeping.setter
+    def sleeping(self, value):
+        self.map[self.SLEEPING] = 1 if value else 0
+
+    def positions(self):
+        head, tail = self.head, self.tail
+        if not 0 <= head - tail <= self.capacity:
+            raise ValueError('Inconsistent shared memory ring positions')
+
+        return head, tail
+
+    def write(self, data):
+        """ Copy as much of the data as there is room for.
+
+        Returns:
+            The number of bytes written.
+        """
+        head, tail = self.positions()
+        nbytes = min(len(data), self.capacity - (head - tail))
+        start = head % self.capacity
+        first = min(nbytes, self.capacity - start)
+        self.view[self.DATA + start:self.DATA + start + first] = data[:first]
+        if nbytes > first:
+            self.view[self.DATA:self.DATA + nbytes - first] = data[first:nbytes]
+
+        self.position[self.HEAD] = head + nbytes
+        return nbytes
+
+    def readinto(self, view):
+        """ Move as many bytes as fit into the view out of the ring.
+
+        Returns:
+            The number of bytes read, 0 if the ring is empty.
+        """
+        head, tail = self.positions()
+        nbytes = min(len(view), head - tail)
+        start = tail % self.capacity
+        first = min(nbytes, self.capacity - start)
+        view[:first] = self.view[self.DATA + start:self.DATA + start + first]
+        if nbytes > first:
+            view[first:nbytes] = self.view[self.DATA:self.DATA + nbytes - first]
+
+        self.position[self.TAIL] = tail + nbytes
+        return nbytes
+
+
+class ShmChannel(object):
+    """ A pair of shared memory rings, one per direction, along with the unix socket they were passed over.
+
+    The rings carry the same byte stream as a socket would, read through a FrameReader,
+    and the socket only carries wakeups and file descriptors. Descriptors are announced
+    in the stream by a pseudo-frame preceding the frame they go with, with SHM_DESCRIPTORS
+    as the magic and their count as the length.
+
+    A consumer finding its ring empty spins briefly on multiprocessors, then flags
+    itself as sleeping before it waits, and producers only send a wakeup when they
+    see the flag, so a busy consumer costs no syscalls. Nothing orders the flag against the ring positions across processes,
+    so the wait is bounded, and a missed wakeup only delays delivery. A producer
+    finding the ring full polls for room.
+
+    Args:
+        sock (socket): The unix socket.
+        rx (ShmRing): The ring written by the peer.
+        tx (ShmRing): The ring read by the peer.
+    """
+    ancbufsize = socket.CMSG_SPACE(MAXFDS * array.array('i').itemsize)
+    SLEEP_TIMEOUT = 0.05
+    SPIN_TIME = 0.00005 if (os.cpu_count() or 1) > 1 else 0
+
+    def __init__(self, sock, rx, tx):
+        self.sock = sock
+        self.rx = rx
+        self.tx = tx
+        self.fds = deque()
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+
+    @staticmethod
+    def frame(data, nfds=0):
+        """ Build the buffers of a frame, preceded by the announcement of its descriptors if it has any. """
+        buffers = frame_buffers(data)
+        if nfds:
+            buffers[0] = HEADER.pack(SHM_DESCRIPTORS, nfds) + buffers[0]
+
+        return buffers
+
+    def wakeup(self, ancdata=None):
+        if ancdata:
+            sendmsg_all(self.sock, [b'\0'], ancdata)
+            return
+
+        if not self.tx.sleeping:
+            return
+
+        try:
+            self.sock.send(b'\0', socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            # The socket buffer is full of wakeups the peer has yet to read
+            pass
+
+    def wait(self, timeout=None):
+        """ Wait for a wakeup from the peer, collecting the descriptors it carries.
+
+        Returns:
+            False if the peer is gone.
+        """
+        if timeout is not None and not self.poller.poll(timeout * 1000):
+            return True
+
+        data, ancdata, flags, addr = self.sock.recvmsg(4096, self.ancbufsize)
+        for cmsg_level, cmsg_type, cmsg_data in ancdata:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                fds = array.array('i')
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+                self.fds.extend(fds)
+
+        return bool(data)
+
+    def write(self, buffers, ancdata=None, timeout=None):
+        """ Write frames to the ring and wake the peer up.
+
+        Raises:
+            OSError: ETIMEDOUT if the peer did not make room within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for buf in buffers:
+            view = memoryview(buf)
+            delay = 0.0001
+            while view:
+                nbytes = self.tx.write(view)
+                view = view[nbytes:]
+                if not view:
+                    break
+
+                self.wakeup()
+                if nbytes:
+                    delay = 0.0001
+                elif deadline is not None and time.monotonic() > deadline:
+                    raise OSError(errno.ETIMEDOUT, 'Operation timed out')
+
+                time.sleep(delay)
+                delay = min(delay * 2, 0.01)
+
+        self.wakeup(ancdata)
+
+    def recv_into(self, view):
+        """ Read from the ring, waiting for data if it is empty.
+
+        Returns:
+            The number of bytes read, 0 if the peer is gone.
+        """
+        while True:
+            nbytes = self.rx.readinto(view)
+            if nbytes:
+                return nbytes
+
+            # Spin a little first, as the producer is likely in the middle of a burst
+            deadline = time.perf_counter() + self.SPIN_TIME
+            while self.rx.head == self.rx.tail and time.perf_counter() < deadline:
+                pass
+
+            nbytes = self.rx.readinto(view)
+            if nbytes:
+                return nbytes
+
+            self.rx.sleeping = True
+            try:
+                # Data written before the flag was seen gets no wakeup
+                nbytes = self.rx.readinto(view)
+                if nbytes:
+                    return nbytes
+
+                if not self.wait(self.SLEEP_TIMEOUT):
+                    return 0
+            finally:
+                self.rx.sleeping = False
+
+    def take_fds(self, count):
+        """ Take the given number of received descriptors, waiting for them if needed. """
+        while len(self.fds) < count and self.wait():
+            pass
+
+        return array.array('i', [self.fds.popleft() for _ in range(min(count, len(self.fds)))])
+
+
+class OutboundQueue(object):
+    """ Outbound frames of a connection, written by a single writer at a time.
+
+    A sender finding no write in progress writes its frame itself, and then keeps
+    draining whatever other senders queued in the meantime, coalescing it into
+    single sendmsg() calls; those other senders return as soon as their frame is
+    queued. put() and flush() split these two steps for callers that have to
+    queue frames in a given order under a lock of their own.
+    A frame with ancillary data always starts a new call, so that its descriptors
+    reach the peer along with the header of their own frame.
+
+    The queue holds at most ``limit`` bytes. Senders wait for room while it is full,
+    except for frames passed to offer(), such as events, which are never written on
+    the caller's thread and are never waited for. Those are handled according to the
+    overflow policy instead when they do not fit:
+
+    - ``drop``: the frame is discarded.
+    - ``conflate``: the frame replaces the queued one offered with the same key,
+      and is discarded if there is none.
+    - ``disconnect``: the connection is closed.
+
+    Args:
+        write (callable): Sends a list of buffers, the ancillary data going with the first one.
+        limit (int): The number of bytes the queue may hold, or None for no limit.
+        policy (str): The overflow policy.
+        overflow (callable): Closes the connection, for the ``disconnect`` policy.
+    """
+    MAX_BATCH = 128
+    MAX_BATCH_SIZE = 256 * 1024
+
+    def __init__(self, write, limit=None, policy='disconnect', overflow=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {0}'.format(policy))
+
+        self.write = write
+        self.limit = limit
+        self.policy = policy
+        self.overflow = overflow
+        self.frames = deque()
+        self.keys = {}
+        self.lock = Lock()
+        self.room = Condition(self.lock)
+        self.writing = False
+        self.closed = False
+        self.size = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.overflowed = False
+
+    @property
+    def stats(self):
+        """ A dict with the queued and high-water byte counts and the number of frames dropped and conflated. """
+        return {
+            'limit': self.limit,
+            'queued': self.size,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'conflated': self.conflated
+        }
+
+    def full(self, size=0):
+        return self.limit is not None and bool(self.frames) and self.size + size > self.limit
+
+    def append(self, buffers, ancdata, done, key=None):
+        size = sum(len(i) for i in buffers)
+        frame = [buffers, ancdata, done, size, key]
+        self.frames.append(frame)
+        if key is not None:
+            self.keys[key] = frame
+
+        self.size += size
+        if self.size > self.high_water:
+            self.high_water = self.size
+
+    def wait_room(self):
+        # Only wait for a writer that is going to make room; put() callers flush right afterwards
+        while self.writing and not self.closed and self.full():
+            self.room.wait()
+
+    def put(self, buffers, ancdata=None, done=None):
+        """ Enqueue a frame.
+
+        Args:
+            buffers (list): The buffers of the frame.
+            ancdata (list): Ancillary data to send along with the frame.
+            done (callable): Called after the frame was written, or failed to be.
+        """
+        with self.lock:
+            self.wait_room()
+            if not self.closed:
+                self.append(buffers, ancdata, done)
+                return
+
+        if done:
+            done()
+
+    def offer(self, buffers, key=None, droppable=True):
+        """ Enqueue a frame without waiting for room, and have it written off the caller's thread.
+
+        Args:
+            buffers (list): The buffers of the frame.
+            key: Identifies the frames that may replace each other under the ``conflate`` policy.
+            droppable (bool): False if the frame cannot be left out of the stream, in which
+                case overflowing the queue closes the connection, whatever the policy.
+
+        Returns:
+            True if the frame was queued, False if it was dropped.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+
+            if self.full(sum(len(i) for i in buffers)):
+                return self.overflowing(buffers, key, droppable)
+
+            self.append(buffers, None, None, key)
+            if self.writing:
+                return True
+
+            self.writing = True
+
+        spawn_thread(self.resume, threadpool=True)
+        return True
+
+    def overflowing(self, buffers, key, droppable):
+        frame = self.keys.get(key) if key is not None else None
+        if droppable and self.policy == 'conflate' and frame:
+            size = sum(len(i) for i in buffers)
+            self.size += size - frame[3]
+            frame[0] = buffers
+            frame[3] = size
+            self.high_water = max(self.high_water, self.size)
+            self.conflated += 1
+            return True
+
+        self.dropped += 1
+        if (self.policy == 'disconnect' or not droppable) and not self.overflowed:
+            self.overflowed = True
+            if self.overflow:
+                self.overflow()
+
+        return False
+
+    def take(self):
+        buffers, ancdata, done, size, key = self.pop()
+        if not self.frames:
+            return buffers, ancdata, (done,)
+
+        buffers = list(buffers)
+        callbacks = [done]
+        while self.frames and len(callbacks) < self.MAX_BATCH and size < self.MAX_BATCH_SIZE:
+            if self.frames[0][1]:
+                break
+
+            frame, _, done, length, _ = self.pop()
+            buffers.extend(frame)
+            callbacks.append(done)
+            size += length
+
+        return buffers, ancdata, callbacks
+
+    def pop(self):
+        frame = self.frames.popleft()
+        self.size -= frame[3]
+        if frame[4] is not None and self.keys.get(frame[4]) is frame:
+            del self.keys[frame[4]]
+
+        return frame
+
+    def send(self, buffers, ancdata=None, done=None):
+        """ Enqueue a frame and flush, writing it right away if no write is in progress. """
+        with self.lock:
+            self.wait_room()
+            if self.closed:
+                if done:
+                    done()
+
+                return
+
+            if self.writing:
+                self.append(buffers, ancdata, done)
+                return
+
+            self.writing = True
+
+        self.drain((buffers, ancdata, (done,)))
+
+    def flush(self):
+        with self.lock:
+            if self.writing or not self.frames:
+                return
+
+            self.writing = True
+            batch = self.take()
+
+        self.drain(batch)
+
+    def resume(self):
+        with self.lock:
+            if not self.frames:
+                self.writing = False
+                return
+
+            batch = self.take()
+
+        self.drain(batch)
+
+    def drain(self, batch):
+        try:
+            while True:
+                buffers, ancdata, callbacks = batch
+                try:
+                    self.write(buffers, ancdata)
+                finally:
+                    for done in callbacks:
+                        if done:
+                            done()
+
+                with self.lock:
+                    self.room.notify_all()
+                    if not self.frames or self.closed:
+                        self.writing = False
+                        return
+
+                    batch = self.take()
+        except BaseException:
+            with self.lock:
+                self.writing = False
+                self.room.notify_all()
+
+            raise
+
+    def close(self):
+        """ Discard the queued frames and release the senders waiting for room. """
+        with self.lock:
+            self.closed = True
+            frames = list(self.frames)
+            self.frames.clear()
+            self.keys.clear()
+            self.size = 0
+            self.room.notify_all()
+
+        for frame in frames:
+            if frame[2]:
+                frame[2]()
+
+
 def _patched_exec_command(
     self, command, bufsize=-1,
     timeout=None, get_pty=False, stdin_binary=True,
@@ -118,6 +1066,8 @@ def server_transport(*schemas):
 
 
 class ClientTransport(object):
+    max_frame_size = MAX_FRAME_SIZE
+
     def __new__(cls, *args, **kwargs):
         if cls is ClientTransport:
             scheme = args[0]
@@ -146,6 +1096,14 @@ class ClientTransport(object):
 
 
 class ServerTransport(object):
+    """ Base class of the server transports.
+
+    Kwargs:
+        send_buffer_limit (int): The number of bytes queued for a connection before it overflows.
+        overflow_policy (str): How events overflowing a connection are handled,
+            'drop', 'conflate' or 'disconnect'; see OutboundQueue.
+        max_frame_size (int): The largest frame accepted from a client; larger ones close the connection.
+    """
     def __new__(cls, *args, **kwargs):
         if cls is ServerTransport:
             scheme = args[0]
@@ -159,8 +1117,14 @@ class ServerTransport(object):
         else:
             super(ServerTransport, cls).__new__(cls)
 
-    def __init__(self):
+    def __init__(self, send_buffer_limit=SEND_BUFFER_LIMIT, overflow_policy='disconnect', max_frame_size=MAX_FRAME_SIZE):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {0}'.format(overflow_policy))
+
         self.connections = []
+        self.send_buffer_limit = send_buffer_limit
+        self.overflow_policy = overflow_policy
+        self.max_frame_size = max_frame_size
 
     def broadcast_event(self, event, args):
         for i in self.connections:
@@ -262,7 +1226,8 @@ class ClientTransportWS(ClientTransport):
 
     def send(self, message, fds):
         try:
-            self.ws.send(message)
+            # Binary codecs and framing extensions produce bytes, which are not valid text frames
+            self.ws.send(message, binary=not isinstance(message, str))
         except OSError as err:
             if err.errno == errno.EPIPE:
                 debug_log('Socket is closed. Closing connection')
@@ -292,10 +1257,86 @@ class ClientTransportWS(ClientTransport):
         return self.ws.sock.getpeername()
 
 
+class SSHConnectionPool(object):
+    """ SSH connections shared by the clients talking to the same host.
+
+    Connections are keyed by host, port, user and credentials, so that a client
+    never rides on a session authenticated with credentials other than its own.
+    Each client runs its own channel on the shared connection, which is closed
+    once the last client using it is gone.
+    """
+    class Entry(object):
+        def __init__(self):
+            self.lock = Lock()
+            self.ssh = None
+            self.refs = 0
+
+        @property
+        def active(self):
+            transport = self.ssh.get_transport() if self.ssh else None
+            return transport is not None and transport.is_active()
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    def acquire(self, key, connect):
+        """ Take a reference to the connection for the key.
+
+        Args:
+            key (tuple): Identifies the host and credentials.
+            connect (callable): Opens a new connection, called if there is none alive for the key.
+
+        Returns:
+            A connected paramiko.SSHClient.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = self.Entry()
+
+            entry.refs += 1
+
+        try:
+            # Connecting holds the lock of this entry only, so other hosts are not held up
+            with entry.lock:
+                if not entry.active:
+                    if entry.ssh:
+                        entry.ssh.close()
+
+                    entry.ssh = None
+                    entry.ssh = connect()
+
+                return entry.ssh
+        except BaseException:
+            self.release(key)
+            raise
+
+    def release(self, key):
+        """ Drop a reference taken with acquire(), closing the connection with the last one. """
+        with self.lock:
+            entry = self.entries[key]
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+
+            del self.entries[key]
+
+        with entry.lock:
+            if entry.ssh:
+                entry.ssh.close()
+
+
+_ssh_pool = SSHConnectionPool()
+
+
 @client_transport('ssh', 'ws+ssh')
 class ClientTransportSSH(ClientTransport):
+    CATCHER = 'sh /usr/local/libexec/dispatcher/ssh_transport_catcher'
+
     def __init__(self, scheme):
         self.ssh = None
+        self.pool_key = None
         self.channel = None
         self.url = None
         self.parent = None
@@ -307,16 +1348,39 @@ class ClientTransportSSH(ClientTransport):
         self.timeout = None
         self.key_filename = None
         self.terminated = False
-        self.stdin = None
-        self.stdout = None
         self.stderr = None
         self.host_key_file = None
         self.look_for_keys = True
+        self.compress = False
         self.connected = False
+        self.close_lock = Lock()
+        self.outbound = OutboundQueue(self.write)
 
     def connect(self, url, parent, **kwargs):
+        """ Open a connection.
+
+        Clients connecting to the same host with the same credentials share a single
+        SSH connection, each of them talking to the dispatcher over a channel of its own.
+
+        Args:
+            url (ParseResult): The url to open.
+            parent (Connection): The connection wrapper class object.
+
+        Kwargs:
+            username (str): The user to log in as, unless given in the url.
+            hostname (str): The host to connect to, unless given in the url.
+            port (int): The SSH port, unless given in the url.
+            password (str): The password to authenticate with.
+            pkey (paramiko.PKey): The private key to authenticate with.
+            key_filename (str): The file holding the private key to authenticate with.
+            host_key_file (str): Known host keys; any host key is accepted if not given.
+            timeout (float): Seconds to wait for the connection to be established.
+            compress (bool): Whether to compress the SSH connection.
+            max_frame_size (int): The largest frame accepted from the server.
+        """
         self.url = url
         self.parent = parent
+        self.max_frame_size = kwargs.get('max_frame_size', MAX_FRAME_SIZE)
         self.username = url.username
         self.port = url.port
 
@@ -361,26 +1425,50 @@ class ClientTransportSSH(ClientTransport):
             raise ValueError('No password, key_filename nor pkey for authentication declared.')
 
         self.host_key_file = kwargs.get('host_key_file', None)
-
+        self.compress = kwargs.get('compress', False)
         self.timeout = kwargs.get('timeout', 30)
+        self.terminated = False
+
+        # Only a digest of the password, so that it does not linger in the pool
+        key = (
+            self.hostname, self.port, self.username,
+            hashlib.sha256(self.password.encode('utf-8')).hexdigest() if self.password else None,
+            self.pkey.get_fingerprint() if self.pkey else None,
+            self.key_filename, self.host_key_file, self.compress
+        )
+
+        self.ssh = _ssh_pool.acquire(key, self.open_ssh)
+        self.pool_key = key
+        try:
+            self.channel = self.ssh.get_transport().open_session(timeout=self.timeout)
+            self.channel.exec_command(self.CATCHER)
+        except (paramiko.SSHException, socket.error) as err:
+            debug_log('Cannot start the transport catcher: {0}', err)
+            self.release()
+            raise
+
+        self.stderr = self.channel.makefile_stderr('rb')
+        self.connected = True
+        self.parent.on_open()
+        spawn_thread(self.recv)
 
+    def open_ssh(self):
         debug_log('Trying to connect to {0}', self.hostname)
 
         try:
-            self.ssh = paramiko.SSHClient()
+            ssh = paramiko.SSHClient()
             logging.getLogger("paramiko").setLevel(logging.WARNING)
             if self.host_key_file:
                 self.look_for_keys = False
                 try:
-                    self.ssh.load_host_keys(self.host_key_file)
+                    ssh.load_host_keys(self.host_key_file)
                 except IOError:
                     debug_log('Cannot read host key file: {0}. SSH transport is closing.', self.host_key_file)
-                    self.close()
                     raise
             else:
-                self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-            self.ssh.connect(
+            ssh.connect(
                 self.hostname,
                 port=self.port,
                 username=self.username,
@@ -388,11 +1476,12 @@ class ClientTransportSSH(ClientTransport):
                 pkey=self.pkey,
                 look_for_keys=self.look_for_keys,
                 key_filename=self.key_filename,
-                timeout=self.timeout
+                timeout=self.timeout,
+                compress=self.compress
             )
 
-            self.connected = True
             debug_log('Connected to {0}', self.hostname)
+            return ssh
 
         except paramiko.AuthenticationException as err:
             debug_log('Authentication exception: {0}', err)
@@ -410,63 +1499,97 @@ class ClientTransportSSH(ClientTransport):
             debug_log('Socket exception: {0}', err)
             raise
 
-        self.stdin, self.stdout, self.stderr = self.ssh.exec_command(
-            "sh /usr/local/libexec/dispatcher/ssh_transport_catcher",
-            bufsize=0
-        )
-
-        self.channel = self.ssh.get_transport().open_session()
+    def enqueue(self, message, fds=None):
+        if not self.terminated:
+            self.outbound.put(frame_buffers(encode_message(message)))
 
-        self.parent.on_open()
-        spawn_thread(self.recv)
+    def flush(self):
+        self.outbound.flush()
 
-    def send(self, message, fds):
+    def send(self, message, fds=None):
         if not self.terminated:
-            header = struct.pack('II', 0xdeadbeef, len(message))
-            message = header + message.encode('utf-8')
-            try:
-                self.stdin.write(message)
-                self.stdin.flush()
-                debug_log("Sent data: {0}", message)
-            except OSError:
-                self.closed()
+            self.outbound.send(frame_buffers(encode_message(message)))
+
+    def write(self, buffers, ancdata):
+        try:
+            for i in buffers:
+                self.channel.sendall(i)
+        except (OSError, paramiko.SSHException) as err:
+            debug_log("Send failed: {0}".format(err))
+            self.closed()
+
+    def recv_into(self, view):
+        """ Receive whatever the channel has to offer, for the FrameReader. """
+        data = self.channel.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
 
     def recv(self):
+        reader = FrameReader(self)
         while not self.terminated:
-            header = self.stdout.read(8)
-            if header == b'' or len(header) != 8:
-                self.closed()
-                break
+            try:
+                header, _ = reader.read_header()
+                if len(header) != HEADER.size:
+                    self.closed()
+                    break
 
-            magic, length = struct.unpack('II', header)
-            if magic == 0xbadbeef0:
-                self.close()
-                raise PermissionError('Permission denied')
-            if magic != 0xdeadbeef:
-                debug_log('Message with wrong magic dropped')
-                continue
+                magic, length = HEADER.unpack(header)
+                if magic == 0xbadbeef0:
+                    self.close()
+                    raise PermissionError('Permission denied')
+                if magic != 0xdeadbeef:
+                    debug_log('Message with wrong magic dropped')
+                    continue
 
-            message = self.stdout.read(length)
-            if message == b'' or len(message) != length:
+                check_frame_length(length, self.max_frame_size)
+                message = recv_body(reader, length, self.parent)
+                if message == b'':
+                    self.closed()
+                    break
+            except FrameTooLarge as err:
+                debug_log('{0}; closing connection', err)
                 self.closed()
-            else:
+                break
+            except PermissionError:
+                # Refused by the transport catcher; an OSError, but not a broken connection
+                raise
+            except (OSError, paramiko.SSHException):
+                self.closed()
+                break
+
+            if message is not None:
                 debug_log("Received data: {0}", message)
                 self.parent.on_message(message, None)
 
+    def release(self):
+        """ Close the channel and give the shared SSH connection back to the pool. """
+        with self.close_lock:
+            key, self.pool_key = self.pool_key, None
+
+        if key is None:
+            return
+
+        with contextlib.suppress(OSError, EOFError, paramiko.SSHException):
+            self.channel.close()
+
+        _ssh_pool.release(key)
+
     def closed(self):
+        if self.pool_key is None:
+            return
+
         debug_log("Transport connection has been closed abnormally.")
         self.terminated = True
         self.connected = False
-        self.ssh.close()
+        self.release()
+        out = self.stderr.readlines()
 
         self.parent.drop_pending_calls()
         if self.parent.error_callback is not None:
             from freenas.dispatcher.client import ClientError
             self.parent.error_callback(ClientError.CONNECTION_CLOSED)
-        out = self.stderr.readlines()
         if len(out):
             debug_log('Error in transport catcher')
-            self.closed()
             raise RuntimeError(out)
 
         self.parent.on_close('Connection terminated')
@@ -474,7 +1597,8 @@ class ClientTransportSSH(ClientTransport):
     def close(self):
         debug_log("Transport connection closed by client.")
         self.terminated = True
-        self.ssh.close()
+        self.connected = False
+        self.release()
         self.parent.on_close('Going away')
 
     @property
@@ -487,79 +1611,116 @@ class ClientTransportSSH(ClientTransport):
 
     @property
     def local_address(self):
-        return self.ssh._transport.sock.getsockname()
+        return self.ssh.get_transport().sock.getsockname()
 
     @property
     def peer_address(self):
-        return self.ssh._transport.sock.getpeername()
+        return self.ssh.get_transport().sock.getpeername()
 
 
 @client_transport('fd')
 class ClientTransportFD(ClientTransport):
     def __init__(self, scheme):
-        self.wlock = RLock()
         self.parent = None
         self.fd = -1
         self.fobj = None
         self.connected = True
+        self.close_lock = Lock()
+        self.outbound = OutboundQueue(self.write)
 
     @property
     def address(self):
         return str(self.fd)
 
+    @property
+    def source(self):
+        """ What frames are read from. """
+        return self.fobj
+
     def connect(self, url, parent, **kwargs):
         self.parent = parent
+        self.max_frame_size = kwargs.get('max_frame_size', MAX_FRAME_SIZE)
         if 'fobj' in kwargs:
             self.fobj = kwargs.pop('fobj')
+            self.fd = self.fobj.fileno()
         else:
             self.fd = int(url.hostname)
             self.fobj = os.fdopen(self.fd, 'w+b', 0)
 
+        self.parent.on_open()
         spawn_thread(self.recv)
 
-    def send(self, message, fds):
-        with self.wlock:
-            try:
-                header = struct.pack('II', 0xdeadbeef, len(message))
-                message = message.encode('utf-8')
-                self.fobj.write(header + message)
-                self.fobj.flush()
-            except (OSError, ValueError) as err:
-                debug_log("Send failed: {0}".format(err))
-                self.doclose()
-            else:
-                debug_log("Sent data: {0}", message)
+    def enqueue(self, message, fds=None):
+        self.outbound.put(frame_buffers(encode_message(message)))
+
+    def flush(self):
+        self.outbound.flush()
+
+    def send(self, message, fds=None):
+        self.outbound.send(frame_buffers(encode_message(message)))
+
+    def write(self, buffers, ancdata):
+        try:
+            self.write_buffers(buffers)
+        except (OSError, ValueError) as err:
+            debug_log("Send failed: {0}".format(err))
+            self.doclose()
+
+    def write_buffers(self, buffers):
+        writev_all(self.fd, buffers)
 
     def recv(self):
+        reader = FrameReader(self.source)
         while True:
             try:
-                header = self.fobj.read(8)
-                if header == b'' or len(header) != 8:
+                header, _ = reader.read_header()
+                if len(header) != HEADER.size:
                     break
 
-                magic, length = struct.unpack('II', header)
+                magic, length = HEADER.unpack(header)
                 if magic != 0xdeadbeef:
                     debug_log('Message with wrong magic dropped (magic {0:x})'.format(magic))
                     continue
 
-                message = self.fobj.read(length)
-                if message == b'' or len(message) != length:
+                check_frame_length(length, self.max_frame_size)
+                message = recv_body(reader, length, self.parent)
+                if message == b'':
                     break
 
-                debug_log("Received data: {0}", message)
-                self.parent.on_message(message)
-            except OSError:
+                if message is not None:
+                    debug_log("Received data: {0}", message)
+                    self.parent.on_message(message)
+            except FrameTooLarge as err:
+                debug_log('{0}; closing connection', err)
+                break
+            except (OSError, ValueError):
                 break
 
         self.doclose()
 
     def doclose(self):
+        with self.close_lock:
+            fd, self.fd = self.fd, -1
+
+        self.connected = False
+        if fd == -1:
+            # Already closed; the descriptor number may belong to somebody else by now
+            return
+
         try:
-            os.close(self.fd)
+            sock = socket.socket(fileno=fd)
         except OSError:
             pass
-        finally:
-            self.connected = False
+        else:
+            # Closing the descriptor would neither wake up a reader blocked on the
+            # socket nor let the peer see the connection end while it is blocked
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+
+            sock.detach()
+
+        with contextlib.suppress(OSError):
+            self.fobj.close()
 
     def close(self):
         self.doclose()
@@ -583,20 +1744,24 @@ class ClientTransportUnix(ClientTransport):
         self.creds_sent = False
         self.connected = False
         self.close_lock = RLock()
-        self.wlock = RLock()
+        self.outbound = OutboundQueue(self.write)
 
     def connect(self, url, parent, **kwargs):
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.parent = parent
+        self.max_frame_size = kwargs.get('max_frame_size', MAX_FRAME_SIZE)
         self.terminated = False
         if not self.parent:
             raise RuntimeError('ClientTransportUnix can be only created inside of a class')
 
-        timeout = kwargs.get('timeout', 30)
-
         if url.path:
             self.path = url.path
 
+        self.connect_socket(kwargs.get('timeout', 30))
+        self.parent.on_open()
+        spawn_thread(self.recv)
+
+    def connect_socket(self, timeout):
         try:
             while True:
                 try:
@@ -622,50 +1787,54 @@ class ClientTransportUnix(ClientTransport):
             self.sock.close()
             raise
 
-        self.parent.on_open()
-        spawn_thread(self.recv)
-
     @property
     def address(self):
         return self.path
 
-    def send(self, message, fds):
-        if not self.terminated:
-            with self.wlock:
-                try:
-                    header = struct.pack('II', 0xdeadbeef, len(message))
-                    message = message.encode('utf-8')
-                    ancdata = []
+    def frame(self, message, fds):
+        message = encode_message(message)
+        debug_log("Sending data: {0}", message)
+        if not fds:
+            return frame_buffers(message), None, None
+
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds]))]
+        return frame_buffers(message), ancdata, functools.partial(close_fds, fds)
 
-                    if not self.creds_sent:
-                        ancdata.append((socket.SOL_SOCKET, socket.SCM_CREDS, bytearray(CMSGCRED_SIZE)))
+    def enqueue(self, message, fds):
+        if not self.terminated:
+            self.outbound.put(*self.frame(message, fds))
 
-                    if fds:
-                        ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds])))
+    def flush(self):
+        self.outbound.flush()
 
-                    xsendmsg(self.sock, header + message, ancdata)
-                    self.creds_sent = True
+    def send(self, message, fds):
+        if not self.terminated:
+            self.outbound.send(*self.frame(message, fds))
 
-                    for i in fds:
-                        if i.close:
-                            os.close(i.fd)
+    def write(self, buffers, ancdata):
+        if not self.creds_sent:
+            # Only the first write carries credentials, whichever frames it holds
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_CREDS, bytearray(CMSGCRED_SIZE))] + (ancdata or [])
+            self.creds_sent = True
 
-                except (OSError, ValueError) as err:
-                    debug_log("Send failed: {0}".format(err))
-                    self.connected = False
-                    with contextlib.suppress(OSError):
-                        self.sock.shutdown(socket.SHUT_RDWR)
-                else:
-                    debug_log("Sent data: {0}", message)
+        try:
+            sendmsg_all(self.sock, buffers, ancdata)
+        except (OSError, ValueError) as err:
+            debug_log("Send failed: {0}".format(err))
+            self.connected = False
+            with contextlib.suppress(OSError):
+                self.sock.shutdown(socket.SHUT_RDWR)
 
     def recv(self):
+        reader = FrameReader(
+            self.sock,
+            socket.CMSG_SPACE(MAXFDS * array.array('i').itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
+        )
+
         while not self.terminated:
             try:
                 fds = array.array('i')
-                header, ancdata = xrecvmsg(
-                    self.sock, 8,
-                    socket.CMSG_SPACE(MAXFDS * fds.itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
-                )
+                header, ancdata = reader.read_header()
 
                 if header == b'' or len(header) != 8:
                     break
@@ -675,11 +1844,7 @@ class ClientTransportUnix(ClientTransport):
                     debug_log('Message with wrong magic dropped (magic {0:x})'.format(magic))
                     continue
 
-                message, _, = xrecvmsg(self.sock, length)
-                if message == b'' or len(message) != length:
-                    break
-
-                debug_log("Received data: {0}", message)
+                check_frame_length(length, self.max_frame_size)
                 for cmsg_level, cmsg_type, cmsg_data in ancdata:
                     if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_CREDS:
                         pid, uid, euid, gid = struct.unpack('iiii', cmsg_data[:struct.calcsize('iiii')])
@@ -693,7 +1858,16 @@ class ClientTransportUnix(ClientTransport):
                     if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
                         fds.fromstring(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
 
-                self.parent.on_message(message, fds=fds)
+                message = recv_body(reader, length, self.parent, fds)
+                if message == b'':
+                    break
+
+                if message is not None:
+                    debug_log("Received data: {0}", message)
+                    self.parent.on_message(message, fds=fds)
+            except FrameTooLarge as err:
+                debug_log('{0}; closing connection', err)
+                break
             except OSError:
                 break
 
@@ -741,56 +1915,76 @@ class ServerTransportUnix(ServerTransport):
             self.client_address = ("unix", 0)
             self.conn = None
             self.creds_sent = False
-            self.wlock = RLock()
+            self.send_timeout = 30
+            self.outbound = OutboundQueue(self.write, server.send_buffer_limit, server.overflow_policy, self.overflow)
 
-        def send(self, message, fds=None):
-            if fds is None:
-                fds = []
+        def frame(self, message, fds):
+            data = encode_message(message)
+            if not fds:
+                return frame_buffers(data), None, None
 
-            with self.wlock:
-                data = message.encode('utf-8')
-                header = struct.pack('II', 0xdeadbeef, len(data))
-                try:
-                    fd = self.connfd.fileno()
-                    ancdata = []
-                    if fd == -1:
-                        return
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds]))]
+            return frame_buffers(data), ancdata, functools.partial(close_fds, fds)
 
-                    if not self.creds_sent:
-                        ancdata.append((socket.SOL_SOCKET, socket.SCM_CREDS, bytearray(CMSGCRED_SIZE)))
+        def enqueue(self, message, fds=None):
+            self.outbound.put(*self.frame(message, fds))
 
-                    if fds:
-                        ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds])))
+        def flush(self):
+            self.outbound.flush()
 
-                    r, w, x = select.select([], [fd], [], 30)
-                    if fd not in w:
-                        raise OSError(errno.ETIMEDOUT, 'Operation timed out')
+        def send(self, message, fds=None):
+            self.outbound.send(*self.frame(message, fds))
+
+        def offer(self, message, key=None, droppable=True):
+            return self.outbound.offer(frame_buffers(encode_message(message)), key, droppable)
 
-                    xsendmsg(self.connfd, header + data, ancdata)
-                    self.creds_sent = True
+        def overflow(self):
+            self.server.logger.info('Send buffer overflow; closing connection')
+            with contextlib.suppress(OSError):
+                self.connfd.shutdown(socket.SHUT_RDWR)
 
-                    for i in fds:
-                        if i.close:
-                            try:
-                                os.close(i.fd)
-                            except OSError:
-                                pass
+        def write(self, buffers, ancdata):
+            if not self.creds_sent:
+                ancdata = [(socket.SOL_SOCKET, socket.SCM_CREDS, bytearray(CMSGCRED_SIZE))] + (ancdata or [])
+                self.creds_sent = True
+
+            try:
+                if self.connfd.fileno() == -1:
+                    return
 
-                except (OSError, ValueError, socket.timeout) as err:
-                    self.server.logger.info('Send failed: {0}; closing connection'.format(str(err)))
-                    if err.errno not in (errno.EBADF, errno.EPIPE):
+                sendmsg_all(self.connfd, buffers, ancdata, self.send_timeout)
+            except (OSError, ValueError, socket.timeout) as err:
+                self.server.logger.info('Send failed: {0}; closing connection'.format(str(err)))
+                if getattr(err, 'errno', None) not in (errno.EBADF, errno.EPIPE):
+                    with contextlib.suppress(OSError):
                         self.connfd.shutdown(socket.SHUT_RDWR)
 
+        def parse_ancdata(self, ancdata, fds):
+            for cmsg_level, cmsg_type, cmsg_data in ancdata:
+                if cmsg_level == socket.SOL_SOCKET and cmsg_type == SCM_CREDS:
+                    pid, uid, euid, gid = struct.unpack('iiii', cmsg_data[:struct.calcsize('iiii')])
+                    self.client_address = ('unix', pid)
+                    self.conn.credentials = {
+                        'pid': pid,
+                        'uid': uid,
+                        'euid': euid,
+                        'gid': gid
+                    }
+
+                if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
         def handle_connection(self):
             self.conn.on_open()
+            reader = FrameReader(
+                self.connfd,
+                socket.CMSG_SPACE(MAXFDS * array.array('i').itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
+            )
 
             while True:
                 try:
                     fds = array.array('i')
-                    header, ancdata = xrecvmsg(
-                        self.connfd, 8,
-                        socket.CMSG_SPACE(MAXFDS * fds.itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
-                    )
+                    header, ancdata = reader.read_header()
 
                     if header == b'' or len(header) != 8:
                         if len(header) > 0:
@@ -802,25 +1996,17 @@ class ServerTransportUnix(ServerTransport):
                         self.server.logger.info('Message with wrong magic dropped (magic {0:x})'.format(magic))
                         break
 
-                    msg, _ = xrecvmsg(self.connfd, length)
-                    if msg == b'' or len(msg) != length:
+                    check_frame_length(length, self.server.max_frame_size)
+
+                    self.parse_ancdata(ancdata, fds)
+                    msg = recv_body(reader, length, self.conn, fds)
+                    if msg == b'':
                         self.server.logger.info('Message with wrong length dropped; closing connection')
                         break
 
-                    for cmsg_level, cmsg_type, cmsg_data in ancdata:
-                        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_CREDS:
-                            pid, uid, euid, gid = struct.unpack('iiii', cmsg_data[:struct.calcsize('iiii')])
-                            self.client_address = ('unix', pid)
-                            self.conn.credentials = {
-                                'pid': pid,
-                                'uid': uid,
-                                'euid': euid,
-                                'gid': gid
-                            }
-
-                        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
-                            fds.fromstring(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
-
+                except FrameTooLarge as err:
+                    self.server.logger.info('{0}; closing connection'.format(str(err)))
+                    break
                 except (OSError, ValueError) as err:
                     if getattr(err, 'errno', None) == errno.EBADF:
                         # in gevent, shutdown() on a socket from other greenlets results in recv*() returning
@@ -830,11 +2016,13 @@ class ServerTransportUnix(ServerTransport):
                     self.server.logger.info('Receive failed: {0}; closing connection'.format(str(err)), exc_info=True)
                     break
 
-                self.conn.on_message(msg, fds=fds)
+                if msg is not None:
+                    self.conn.on_message(msg, fds=fds)
 
             self.close()
 
         def close(self):
+            self.outbound.close()
             if self.conn:
                 self.conn.on_close('Bye bye')
                 self.conn = None
@@ -845,8 +2033,9 @@ class ServerTransportUnix(ServerTransport):
                 with contextlib.suppress(OSError):
                     self.connfd.close()
 
-    def __init__(self, scheme, parsed_url, permissions=0o775):
-        super(ServerTransportUnix, self).__init__()
+    def __init__(self, scheme, parsed_url, permissions=0o775, backlog=LISTEN_BACKLOG, **kwargs):
+        super(ServerTransportUnix, self).__init__(**kwargs)
+        self.backlog = backlog
         self.path = parsed_url.path
         self.sockfd = None
         self.permissions = permissions
@@ -860,7 +2049,7 @@ class ServerTransportUnix(ServerTransport):
             self.sockfd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             self.sockfd.bind(self.path)
             os.chmod(self.path, self.permissions)
-            self.sockfd.listen(10)
+            self.sockfd.listen(self.backlog)
         except OSError as err:
             self.logger.error('Cannot start socket server: {0}'.format(str(err)))
             return
@@ -877,10 +2066,13 @@ class ServerTransportUnix(ServerTransport):
 
             handler = self.UnixSocketHandler(self, fd, addr)
             handler.conn = server.on_connection(handler)
-            spawn_thread(handler.handle_connection)
+            self.start_connection(handler)
 
         self.sockfd.close()
 
+    def start_connection(self, handler):
+        spawn_thread(handler.handle_connection)
+
     def close(self):
         self.sockfd.shutdown(socket.SHUT_RDWR)
 
@@ -897,30 +2089,63 @@ class ClientTransportTCP(ClientTransportFD):
         return str(self.fd)
 
     def connect(self, url, parent, **kwargs):
-        self.parent = parent
-        s = None
+        """ Open a connection.
 
-        for item in socket.getaddrinfo(url.hostname, url.port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP):
-            af, type, proto, canonname, sockaddr = item
-            try:
-                s = socket.socket(af, type, proto)
-                s.connect(sockaddr)
-            except socket.error:
-                continue
-            else:
-                break
+        The addresses the host name resolves to are tried in parallel, alternating address families.
+
+        Args:
+            url (ParseResult): The url to open.
+            parent (Connection): The connection wrapper class object.
+
+        Kwargs:
+            connect_timeout (float): Seconds to wait for the connection to be established.
+            max_frame_size (int): The largest frame accepted from the server.
+            Any of TCP_OPTIONS, see set_tcp_options().
 
-        if s is None:
-            raise RuntimeError('Cannot connect to {0}'.format(url.hostname))
+        Raises:
+            RuntimeError
+        """
+        self.parent = parent
+        self.max_frame_size = kwargs.get('max_frame_size', MAX_FRAME_SIZE)
+        options = pop_tcp_options(kwargs)
+
+        try:
+            addrinfo = socket.getaddrinfo(url.hostname, url.port, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP)
+            s = connect_parallel(interleave_addresses(addrinfo), kwargs.get('connect_timeout'))
+        except OSError as err:
+            raise RuntimeError('Cannot connect to {0}: {1}'.format(url.hostname, str(err)))
 
-        self.fobj = s.makefile('rwb')
+        set_tcp_options(s, **options)
+        self.socket = s
+        self.fd = s.fileno()
         self.parent.on_open()
         spawn_thread(self.recv)
 
+    @property
+    def source(self):
+        return self.socket
+
+    def write_buffers(self, buffers):
+        sendmsg_all(self.socket, buffers)
+
+    def doclose(self):
+        self.connected = False
+        with contextlib.suppress(OSError):
+            self.socket.shutdown(socket.SHUT_RDWR)
+
+        with contextlib.suppress(OSError):
+            self.socket.close()
+
 
 @server_transport('tcp')
 @server_transport('tcp6')
 class ServerTransportTCP(ServerTransport):
+    """ TCP server transport.
+
+    Kwargs:
+        backlog (int): The listen backlog.
+        Any of TCP_OPTIONS, applied to accepted connections; see set_tcp_options().
+    """
     class TCPSocketHandler(object):
         def __init__(self, server, connfd, address):
             self.connfd = connfd
@@ -928,33 +2153,45 @@ class ServerTransportTCP(ServerTransport):
             self.server = server
             self.client_address = None
             self.conn = None
-            self.wlock = RLock()
+            self.send_timeout = 10
+            self.outbound = OutboundQueue(self.write, server.send_buffer_limit, server.overflow_policy, self.overflow)
+
+        def enqueue(self, message, fds=None):
+            self.outbound.put(frame_buffers(encode_message(message)))
+
+        def flush(self):
+            self.outbound.flush()
 
         def send(self, message, fds=None):
-            with self.wlock:
-                data = message.encode('utf-8')
-                header = struct.pack('II', 0xdeadbeef, len(data))
-                try:
-                    fd = self.connfd.fileno()
-                    if fd == -1:
-                        return
+            self.outbound.send(frame_buffers(encode_message(message)))
+
+        def offer(self, message, key=None, droppable=True):
+            return self.outbound.offer(frame_buffers(encode_message(message)), key, droppable)
 
-                    r, w, x = select.select([], [fd], [], 10)
-                    if fd not in w:
-                        raise OSError(errno.ETIMEDOUT, 'Operation timed out')
+        def overflow(self):
+            self.server.logger.info('Send buffer overflow; closing connection')
+            with contextlib.suppress(OSError):
+                self.connfd.shutdown(socket.SHUT_RDWR)
+
+        def write(self, buffers, ancdata):
+            try:
+                if self.connfd.fileno() == -1:
+                    return
 
-                    xsendmsg(self.connfd, header + data, [])
-                except (OSError, ValueError, socket.timeout) as err:
-                    self.server.logger.info('Send failed: {0}; closing connection'.format(str(err)))
-                    if err.errno not in (errno.EBADF, errno.EPIPE):
+                sendmsg_all(self.connfd, buffers, timeout=self.send_timeout)
+            except (OSError, ValueError, socket.timeout) as err:
+                self.server.logger.info('Send failed: {0}; closing connection'.format(str(err)))
+                if getattr(err, 'errno', None) not in (errno.EBADF, errno.EPIPE):
+                    with contextlib.suppress(OSError):
                         self.connfd.shutdown(socket.SHUT_RDWR)
 
         def handle_connection(self):
             self.conn.on_open()
+            reader = FrameReader(self.connfd)
 
             while True:
                 try:
-                    header, _ = xrecvmsg(self.connfd, 8)
+                    header, _ = reader.read_header()
 
                     if header == b'' or len(header) != 8:
                         if len(header) > 0:
@@ -966,11 +2203,16 @@ class ServerTransportTCP(ServerTransport):
                         self.server.logger.info('Message with wrong magic dropped (magic {0:x})'.format(magic))
                         break
 
-                    msg, _ = xrecvmsg(self.connfd, length)
-                    if msg == b'' or len(msg) != length:
+                    check_frame_length(length, self.server.max_frame_size)
+
+                    msg = recv_body(reader, length, self.conn)
+                    if msg == b'':
                         self.server.logger.info('Message with wrong length dropped; closing connection')
                         break
 
+                except FrameTooLarge as err:
+                    self.server.logger.info('{0}; closing connection'.format(str(err)))
+                    break
                 except (OSError, ValueError) as err:
                     if getattr(err, 'errno', None) == errno.EBADF:
                         # in gevent, shutdown() on a socket from other greenlets results in recv*() returning
@@ -980,11 +2222,13 @@ class ServerTransportTCP(ServerTransport):
                     self.server.logger.info('Receive failed: {0}; closing connection'.format(str(err)), exc_info=True)
                     break
 
-                self.conn.on_message(msg)
+                if msg is not None:
+                    self.conn.on_message(msg)
 
             self.close()
 
         def close(self):
+            self.outbound.close()
             if self.conn:
                 self.conn.on_close('Bye bye')
                 self.conn = None
@@ -995,10 +2239,12 @@ class ServerTransportTCP(ServerTransport):
                 with contextlib.suppress(OSError):
                     self.connfd.close()
 
-    def __init__(self, scheme, parsed_url):
-        super(ServerTransportTCP, self).__init__()
+    def __init__(self, scheme, parsed_url, backlog=LISTEN_BACKLOG, **kwargs):
+        self.tcp_options = pop_tcp_options(kwargs)
+        super(ServerTransportTCP, self).__init__(**kwargs)
+        self.backlog = backlog
         self.logger = logging.getLogger('TCPTransport')
-        self.af = socket.AF_INET6 if scheme == 'tcp6' else socket.AF_INET
+        self.af = socket.AF_INET6 if scheme.startswith('tcp6') else socket.AF_INET
         self.hostname = parsed_url.hostname
         self.port = parsed_url.port
         self.sockfd = None
@@ -1006,8 +2252,10 @@ class ServerTransportTCP(ServerTransport):
     def serve_forever(self, server):
         self.sockfd = socket.socket(self.af, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         self.sockfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Buffer sizes are inherited by accepted sockets, and the receive window scale is negotiated on SYN
+        set_tcp_options(self.sockfd, sndbuf=self.tcp_options['sndbuf'], rcvbuf=self.tcp_options['rcvbuf'], nodelay=False)
         self.sockfd.bind((self.hostname, self.port))
-        self.sockfd.listen(10)
+        self.sockfd.listen(self.backlog)
 
         while True:
             try:
@@ -1019,8 +2267,499 @@ class ServerTransportTCP(ServerTransport):
                 self.logger.error('accept() failed: {0}'.format(str(err)))
                 break
 
+            with contextlib.suppress(OSError):
+                set_tcp_options(fd, **self.tcp_options)
+
             handler = self.TCPSocketHandler(self, fd, addr)
             handler.conn = server.on_connection(handler)
-            spawn_thread(handler.handle_connection)
+            self.start_connection(handler)
 
         self.sockfd.close()
+
+    def start_connection(self, handler):
+        spawn_thread(handler.handle_connection)
+
+
+class Reactor(object):
+    """ Multiplexes the sockets of server connections across a fixed number of I/O threads.
+
+    Connections are spread over the threads round-robin. Complete messages are
+    handed to the thread pool, with every connection processing its messages in
+    order, one at a time, just like a reader thread of its own would.
+    """
+    class Loop(object):
+        def __init__(self):
+            self.selector = selectors.DefaultSelector()
+            self.wakeup, self.waker = socket.socketpair()
+            self.wakeup.setblocking(False)
+            self.waker.setblocking(False)
+            self.selector.register(self.wakeup, selectors.EVENT_READ)
+            self.calls = deque()
+            self.running = True
+
+        def call_soon(self, fn, *args):
+            """ Run a function on the loop thread, which owns the selector. """
+            self.calls.append((fn, args))
+            with contextlib.suppress(OSError):
+                self.waker.send(b'\0')
+
+        def stop(self):
+            self.running = False
+
+        def run(self):
+            while self.running:
+                for key, events in self.selector.select():
+                    if key.data is None:
+                        with contextlib.suppress(OSError):
+                            self.wakeup.recv(4096)
+
+                        continue
+
+                    key.data.on_readable()
+
+                while self.calls:
+                    fn, args = self.calls.popleft()
+                    fn(*args)
+
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None:
+                    key.data.hangup()
+
+            self.selector.close()
+            self.wakeup.close()
+            self.waker.close()
+
+    def __init__(self, threads=REACTOR_THREADS):
+        self.loops = [self.Loop() for _ in range(threads)]
+        self.counter = itertools.count()
+
+    def start(self):
+        for i in self.loops:
+            spawn_thread(i.run)
+
+    def stop(self):
+        for i in self.loops:
+            i.call_soon(i.stop)
+
+    def add(self, handler):
+        loop = self.loops[next(self.counter) % len(self.loops)]
+        handler.loop = loop
+        loop.call_soon(handler.register)
+
+
+class ReactorHandler(object):
+    """ Mixin reading the frames of a server connection from a reactor loop.
+
+    It replaces handle_connection() of the socket handler it is mixed into; sends
+    are unchanged, as the handlers already write without blocking.
+    """
+    ancbufsize = 0
+
+    def __init__(self, *args, **kwargs):
+        super(ReactorHandler, self).__init__(*args, **kwargs)
+        self.loop = None
+        self.reader = FrameReader(self.connfd, self.ancbufsize)
+        self.length = None
+        self.body = None
+        self.done = 0
+        self.fds = None
+        self.inbox = deque()
+        self.inbox_lock = Lock()
+        self.scheduled = False
+        self.paused = False
+        self.registered = False
+        self.hung_up = False
+
+    def attach(self, reactor):
+        self.conn.on_open()
+        self.connfd.setblocking(False)
+        reactor.add(self)
+
+    def register(self):
+        if not self.registered and not self.hung_up:
+            self.loop.selector.register(self.connfd, selectors.EVENT_READ, self)
+            self.registered = True
+
+    def unregister(self):
+        if self.registered:
+            self.loop.selector.unregister(self.connfd)
+            self.registered = False
+
+    def on_readable(self):
+        try:
+            if self.body is not None:
+                nbytes = self.reader.recv(self.body[self.done:])
+                self.done += nbytes
+            elif self.length is None:
+                nbytes = self.reader.fill_once(HEADER.size)
+            else:
+                nbytes = self.reader.fill_once(self.length, HEADER.size)
+
+            if not nbytes:
+                self.hangup()
+                return
+
+            self.parse()
+        except BlockingIOError:
+            return
+        except Exception as err:
+            # Whatever goes wrong with one connection must not take the loop down with it
+            self.server.logger.info('Receive failed: {0}; closing connection'.format(str(err)), exc_info=True)
+            self.hangup()
+
+    def parse(self):
+        reader = self.reader
+        while not self.hung_up:
+            if self.body is not None:
+                if self.done < self.length:
+                    return
+
+                self.deliver(self.body.obj)
+                continue
+
+            if self.length is None:
+                if reader.end - reader.start < HEADER.size:
+                    return
+
+                header, ancdata = reader.read_header()
+                magic, length = HEADER.unpack(header)
+                if magic != 0xdeadbeef:
+                    self.server.logger.info('Message with wrong magic dropped (magic {0:x})'.format(magic))
+                    self.hangup()
+                    return
+
+                try:
+                    check_frame_length(length, self.server.max_frame_size)
+                except FrameTooLarge as err:
+                    self.server.logger.info('{0}; closing connection'.format(str(err)))
+                    self.hangup()
+                    return
+
+                self.fds = array.array('i')
+                if ancdata:
+                    self.parse_ancdata(ancdata, self.fds)
+
+                self.length = length
+                if length > len(reader.buffer):
+                    # Too large for the shared buffer, so it gets one of its own
+                    self.body = memoryview(bytearray(length))
+                    self.done = reader.end - reader.start
+                    self.body[:self.done] = reader.consume(self.done)
+                    continue
+
+            if reader.end - reader.start < self.length:
+                return
+
+            self.deliver(reader.consume(self.length))
+
+    def deliver(self, message):
+        self.post((message, self.fds))
+        self.length = None
+        self.body = None
+        self.fds = None
+
+    def post(self, item):
+        with self.inbox_lock:
+            self.inbox.append(item)
+            pause = not self.paused and len(self.inbox) >= INBOX_LIMIT
+            if pause:
+                self.paused = True
+
+            schedule = not self.scheduled
+            self.scheduled = True
+
+        if pause:
+            # Stop reading until the workers catch up, rather than queueing without bounds
+            self.unregister()
+
+        if schedule:
+            spawn_thread(self.process, threadpool=True)
+
+    def process(self):
+        while True:
+            with self.inbox_lock:
+                if not self.inbox:
+                    self.scheduled = False
+                    return
+
+                item = self.inbox.popleft()
+                if self.paused and len(self.inbox) <= INBOX_LIMIT // 2:
+                    self.paused = False
+                    self.loop.call_soon(self.register)
+
+            if item is None:
+                self.close()
+                return
+
+            message, fds = item
+            try:
+                self.conn.on_message(message, fds=fds)
+            except Exception as err:
+                self.server.logger.warning('Message handling failed: {0}'.format(str(err)), exc_info=True)
+
+    def hangup(self):
+        """ Stop reading and close the connection after the messages already received. """
+        if not self.hung_up:
+            self.unregister()
+            self.hung_up = True
+            self.post(None)
+
+
+class ReactorTransport(object):
+    """ Mixin serving the connections of a server transport from a Reactor.
+
+    Kwargs:
+        io_threads (int): The number of I/O threads.
+    """
+    def __init__(self, *args, **kwargs):
+        io_threads = kwargs.pop('io_threads', REACTOR_THREADS)
+        super(ReactorTransport, self).__init__(*args, **kwargs)
+        self.reactor = Reactor(io_threads)
+
+    def serve_forever(self, server):
+        self.reactor.start()
+        try:
+            super(ReactorTransport, self).serve_forever(server)
+        finally:
+            self.reactor.stop()
+
+    def start_connection(self, handler):
+        handler.attach(self.reactor)
+
+
+@server_transport('unix+reactor')
+class ServerTransportUnixReactor(ReactorTransport, ServerTransportUnix):
+    class UnixSocketHandler(ReactorHandler, ServerTransportUnix.UnixSocketHandler):
+        ancbufsize = socket.CMSG_SPACE(MAXFDS * array.array('i').itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
+
+
+@server_transport('tcp+reactor')
+@server_transport('tcp6+reactor')
+class ServerTransportTCPReactor(ReactorTransport, ServerTransportTCP):
+    class TCPSocketHandler(ReactorHandler, ServerTransportTCP.TCPSocketHandler):
+        pass
+
+
+@client_transport('shm')
+class ClientTransportShm(ClientTransportUnix):
+    """ Client transport exchanging frames with a server on the same host through shared memory.
+
+    It connects to the unix socket of the server and passes it a pair of rings; see ShmChannel.
+
+    Kwargs:
+        ring_size (int): The size of each ring.
+    """
+    def __init__(self, scheme):
+        super(ClientTransportShm, self).__init__(scheme)
+        self.ring_size = SHM_RING_SIZE
+        self.channel = None
+
+    def connect(self, url, parent, **kwargs):
+        self.ring_size = kwargs.get('ring_size', SHM_RING_SIZE)
+        super(ClientTransportShm, self).connect(url, parent, **kwargs)
+
+    def connect_socket(self, timeout):
+        super(ClientTransportShm, self).connect_socket(timeout)
+        try:
+            self.handshake()
+        except (OSError, ValueError) as err:
+            self.sock.close()
+            raise RuntimeError('Cannot set up shared memory with {0}: {1}'.format(self.path, str(err)))
+
+    def handshake(self):
+        fds = []
+        try:
+            fds = [create_shm(self.ring_size) for _ in range(2)]
+            # The first ring is the one the server reads
+            self.channel = ShmChannel(self.sock, ShmRing(fds[1], self.ring_size), ShmRing(fds[0], self.ring_size))
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+            if SCM_CREDS is not None:
+                ancdata.append((socket.SOL_SOCKET, SCM_CREDS, bytearray(CMSGCRED_SIZE)))
+
+            sendmsg_all(self.sock, [SHM_HELLO.pack(SHM_MAGIC, self.ring_size)], ancdata)
+            self.creds_sent = True
+            if self.sock.recv(1) != b'\1':
+                raise ValueError('Refused by the server')
+        finally:
+            for i in fds:
+                os.close(i)
+
+    def frame(self, message, fds):
+        message = encode_message(message)
+        debug_log("Sending data: {0}", message)
+        if not fds:
+            return ShmChannel.frame(message), None, None
+
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds]))]
+        return ShmChannel.frame(message, len(fds)), ancdata, functools.partial(close_fds, fds)
+
+    def write(self, buffers, ancdata):
+        try:
+            self.channel.write(buffers, ancdata)
+        except (OSError, ValueError) as err:
+            debug_log("Send failed: {0}".format(err))
+            self.connected = False
+            with contextlib.suppress(OSError):
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+    def recv(self):
+        reader = FrameReader(self.channel)
+        fds = array.array('i')
+        while not self.terminated:
+            try:
+                header, _ = reader.read_header()
+                if len(header) != HEADER.size:
+                    break
+
+                magic, length = HEADER.unpack(header)
+                if magic == SHM_DESCRIPTORS:
+                    fds = self.channel.take_fds(length)
+                    continue
+
+                if magic != 0xdeadbeef:
+                    # Unlike on a socket, a bad frame cannot be skipped
+                    debug_log('Message with wrong magic (magic {0:x}); closing connection'.format(magic))
+                    break
+
+                check_frame_length(length, self.max_frame_size)
+
+                message = recv_body(reader, length, self.parent, fds)
+                if message == b'':
+                    break
+
+                if message is not None:
+                    debug_log("Received data: {0}", message)
+                    self.parent.on_message(message, fds=fds)
+
+                fds = array.array('i')
+            except FrameTooLarge as err:
+                debug_log('{0}; closing connection', err)
+                break
+            except (OSError, ValueError):
+                break
+
+        with contextlib.suppress(OSError):
+            self.sock.close()
+
+        if not self.terminated:
+            self.closed()
+
+
+@server_transport('shm')
+class ServerTransportShm(ServerTransportUnix):
+    """ Server transport exchanging frames with clients on the same host through shared memory.
+
+    Clients connect to a unix socket, just like with the unix transport, and pass
+    it the rings they created; see ShmChannel.
+    """
+    class UnixSocketHandler(ServerTransportUnix.UnixSocketHandler):
+        def __init__(self, server, connfd, address):
+            super(ServerTransportShm.UnixSocketHandler, self).__init__(server, connfd, address)
+            self.channel = None
+
+        def frame(self, message, fds):
+            data = encode_message(message)
+            if not fds:
+                return ShmChannel.frame(data), None, None
+
+            ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [i.fd for i in fds]))]
+            return ShmChannel.frame(data, len(fds)), ancdata, functools.partial(close_fds, fds)
+
+        def offer(self, message, key=None, droppable=True):
+            return self.outbound.offer(ShmChannel.frame(encode_message(message)), key, droppable)
+
+        def write(self, buffers, ancdata):
+            try:
+                self.channel.write(buffers, ancdata, self.send_timeout)
+            except (OSError, ValueError) as err:
+                self.server.logger.info('Send failed: {0}; closing connection'.format(str(err)))
+                with contextlib.suppress(OSError):
+                    self.connfd.shutdown(socket.SHUT_RDWR)
+
+        def handshake(self):
+            data, ancdata, flags, addr = self.connfd.recvmsg(
+                SHM_HELLO.size,
+                socket.CMSG_SPACE(2 * array.array('i').itemsize) + socket.CMSG_SPACE(CMSGCRED_SIZE)
+            )
+
+            fds = array.array('i')
+            self.parse_ancdata(ancdata, fds)
+            try:
+                if len(data) != SHM_HELLO.size or len(fds) != 2:
+                    raise ValueError('Invalid handshake')
+
+                magic, size = SHM_HELLO.unpack(data)
+                if magic != SHM_MAGIC or not ShmRing.DATA < size <= SHM_MAX_RING_SIZE:
+                    raise ValueError('Invalid handshake')
+
+                for i in fds:
+                    if os.fstat(i).st_size < size:
+                        raise ValueError('Shared memory too small')
+
+                    # Memory shrunk under the mapping would crash the server with SIGBUS
+                    if SHM_SEALS and hasattr(fcntl, 'F_GET_SEALS'):
+                        if fcntl.fcntl(i, fcntl.F_GET_SEALS) & SHM_SEALS != SHM_SEALS:
+                            raise ValueError('Shared memory is not sealed')
+
+                self.channel = ShmChannel(self.connfd, ShmRing(fds[0], size), ShmRing(fds[1], size))
+            finally:
+                for i in fds:
+                    os.close(i)
+
+            self.connfd.send(b'\1')
+
+        def handle_connection(self):
+            try:
+                self.handshake()
+            except (OSError, ValueError) as err:
+                self.server.logger.info('Shared memory handshake failed: {0}; closing connection'.format(str(err)))
+                self.conn = None
+                self.close()
+                with contextlib.suppress(OSError):
+                    self.connfd.close()
+
+                return
+
+            self.conn.on_open()
+            reader = FrameReader(self.channel)
+            fds = array.array('i')
+            while True:
+                try:
+                    header, _ = reader.read_header()
+                    if len(header) != HEADER.size:
+                        if len(header) > 0:
+                            self.server.logger.info('Short read (len {0})'.format(len(header)))
+                        break
+
+                    magic, length = HEADER.unpack(header)
+                    if magic == SHM_DESCRIPTORS:
+                        fds = self.channel.take_fds(length)
+                        continue
+
+                    if magic != 0xdeadbeef:
+                        self.server.logger.info('Message with wrong magic (magic {0:x}); closing connection'.format(magic))
+                        break
+
+                    check_frame_length(length, self.server.max_frame_size)
+
+                    msg = recv_body(reader, length, self.conn, fds)
+                    if msg == b'':
+                        self.server.logger.info('Message with wrong length dropped; closing connection')
+                        break
+
+                except FrameTooLarge as err:
+                    self.server.logger.info('{0}; closing connection'.format(str(err)))
+                    break
+                except (OSError, ValueError) as err:
+                    if getattr(err, 'errno', None) == errno.EBADF:
+                        break
+
+                    self.server.logger.info('Receive failed: {0}; closing connection'.format(str(err)), exc_info=True)
+                    break
+
+                if msg is not None:
+                    self.conn.on_message(msg, fds=fds)
+
+                fds = array.array('i')
+
+            self.close()
@@ -52,5 +52,8 @@ setup(
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
     ],
-    install_requires=install_requires
+    install_requires=install_requires,
+    extras_require={
+        'msgpack': ['msgpack>=1.0']
+    }
 )
@@ -0,0 +1,109 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import re
+import enum
+import uuid
+import unittest
+from datetime import datetime, timezone
+from freenas.dispatcher import Password
+from freenas.dispatcher.jsonenc import dumps, loads, parse_date, _encoders
+from freenas.dispatcher.model import BaseStruct, context
+
+
+class Color(enum.Enum):
+    RED = 'red'
+
+
+class Point(BaseStruct):
+    x: int
+    y: int
+
+
+class TestJsonEncoding(unittest.TestCase):
+    def test_plain_document(self):
+        doc = {'id': 1, 'name': 'price: "$5"', 'items': [{'a': None}, [1, 2.5, True]]}
+        self.assertEqual(loads(dumps(doc)), doc)
+
+    def test_tagged_values(self):
+        doc = {
+            'date': datetime(2017, 1, 2, 3, 4, 5, 6),
+            'nested': [{'binary': b'\x00\x01', 'regex': re.compile('^a.*')}],
+            'password': Password('secret'),
+            'not_a_tag': {'$date': '2017-01-01', 'extra': 1}
+        }
+
+        result = loads(dumps(doc))
+        self.assertEqual(result['date'], doc['date'])
+        self.assertEqual(result['nested'][0]['binary'], b'\x00\x01')
+        self.assertEqual(result['nested'][0]['regex'].pattern, '^a.*')
+        self.assertEqual(result['password'].secret, 'secret')
+        self.assertEqual(result['not_a_tag'], doc['not_a_tag'])
+
+    def test_types(self):
+        uid = uuid.uuid4()
+        result = loads(dumps({'uuid': uid, 'set': {1}, 'enum': Color.RED, 'other': 1j}))
+        self.assertEqual(result, {'uuid': str(uid), 'set': [1], 'enum': 'red', 'other': '1j'})
+
+    def test_struct(self):
+        point = Point({'x': 1, 'y': 2, 'z': 3})
+        self.assertEqual(loads(dumps([point])), [{'x': 1, 'y': 2, '%type': 'Point'}])
+        self.assertEqual(point.__getstate__(), {'x': 1, 'y': 2, '%type': 'Point'})
+
+    def test_struct_getstate_override(self):
+        class Custom(BaseStruct):
+            x: int
+
+            def __getstate__(self):
+                return {'custom': self.x}
+
+        self.assertEqual(loads(dumps(Custom({'x': 1}))), {'custom': 1})
+
+    def test_struct_unregister(self):
+        cls = context.type_enumerator.construct_struct('RemoteThing', {'properties': {'a': {'type': 'integer'}}})
+        self.assertIn(cls, _encoders)
+
+        replacement = context.type_enumerator.construct_struct('RemoteThing', {'properties': {'b': {'type': 'integer'}}})
+        self.assertNotIn(cls, _encoders)
+        self.assertIn(replacement, _encoders)
+
+        context.unregister_schema('RemoteThing')
+        self.assertNotIn(replacement, _encoders)
+
+    def test_parse_date(self):
+        for i in (datetime(2017, 1, 2, 3, 4, 5), datetime(2017, 1, 2, 3, 4, 5, 6, tzinfo=timezone.utc)):
+            self.assertEqual(parse_date(str(i)), i)
+
+        self.assertEqual(parse_date('Jan 2 2017 03:04:05'), datetime(2017, 1, 2, 3, 4, 5))
+
+    def test_bytes_input(self):
+        self.assertEqual(loads(dumps({'a': b'x'}).encode('utf-8')), {'a': b'x'})
+
+
+if __name__ == '__main__':
+    unittest.main()
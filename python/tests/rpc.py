@@ -26,17 +26,31 @@
 #####################################################################
 
 import os
+import time
+import errno
+import copy
+import json
 import socket
 import unittest
 import logging
-from freenas.dispatcher.rpc import RpcService, generator
-from freenas.dispatcher.client import Client, StreamingResultIterator
+from datetime import datetime
+from freenas.dispatcher.codec import supported_codecs, peek_envelope, StreamCompressor, FrameTooLarge
+from freenas.dispatcher.fd import FileDescriptor
+from freenas.dispatcher.jsonenc import dumps
+from freenas.dispatcher.record import Record
+from freenas.dispatcher.rpc import RpcService, RpcException, generator
+from freenas.dispatcher.client import Client, ClientError, StreamingResultIterator, EventRouter
+from freenas.dispatcher.server import Server, ServerConnection
+from freenas.dispatcher.entity import EntitySubscriber
 
 
 class TestService(RpcService):
     def hello(self, arg):
         return 'Hello World, {0}'.format(arg)
 
+    def echo(self, arg):
+        return arg
+
     @generator
     def iterator(self, count):
         return (i * 2 for i in range(0, count))
@@ -50,6 +64,17 @@ class TestService(RpcService):
         pass
 
 
+class EntityService(RpcService):
+    rows = [{'id': 'a', 'name': 'first', 'props': {'size': 1}}, {'id': 'b', 'name': 'second', 'props': {'size': 2}}]
+
+    @generator
+    def query(self, filter, params):
+        if params.get('count'):
+            return len(self.rows)
+
+        return iter(self.rows)
+
+
 class TestClientServer(unittest.TestCase):
     def setup_back_to_back(self, streaming=False):
         a, b = socket.socketpair()
@@ -93,6 +118,272 @@ class TestClientServer(unittest.TestCase):
         self.assertIsInstance(result, list)
         self.assertEqual(result, [0, 2, 4, 6, 8, 10, 12, 14, 16, 18])
 
+    @unittest.skipIf('msgpack' not in supported_codecs(), 'msgpack is not installed')
+    def test_msgpack_codec(self):
+        c1, c2 = self.setup_back_to_back()
+        c2.negotiate_codec('msgpack', 'json')
+        value = {'date': datetime(2017, 1, 1, 12, 30, 15, 500), 'binary': b'\x00\xff', 'list': [1, 'a', None]}
+        self.assertEqual(c2.call_sync('test.echo', value), value)
+        self.assertEqual(c1.codec.name, 'msgpack')
+        self.assertEqual(c2.call_sync('test.echo', value), value)
+        self.assertEqual(c2.codec.name, 'msgpack')
+
+    def test_attachments(self):
+        c1, c2 = self.setup_back_to_back()
+        c2.negotiate_codec('json', features=['attachments'])
+        blob = os.urandom(64 * 1024)
+        value = {'blob': blob, 'small': b'\x00\xff'}
+        self.assertEqual(c2.call_sync('test.echo', value), value)
+        self.assertEqual(c1.features, {'attachments'})
+
+        c = Client()
+        c.features = {'attachments'}
+        received = []
+        c.on_rpc_call = lambda id, data: received.append(data)
+        message, _ = c.pack('rpc', 'call', [value])
+        self.assertEqual(message[-len(blob):], blob)
+        c.on_message(message)
+        self.assertIsInstance(received[0][0]['blob'], memoryview)
+        self.assertEqual(received[0][0]['blob'], blob)
+        self.assertEqual(received[0][0]['small'], b'\x00\xff')
+
+    def test_compression(self):
+        c1, c2 = self.setup_back_to_back()
+        c2.negotiate_codec('json', features=['compression'])
+        value = [{'id': i, 'name': 'item{0}'.format(i), 'enabled': True} for i in range(1000)]
+        self.assertEqual(c2.call_sync('test.echo', value), value)
+        self.assertEqual(c2.call_sync('test.echo', value), value)
+        self.assertEqual(c2.call_sync('test.echo', 'short'), 'short')
+
+        self.assertEqual(c1.compression.frames_sent, 2)
+        self.assertEqual(c2.compression.frames_received, 2)
+        self.assertLess(c1.compression.ratio, 0.2)
+
+        frame = StreamCompressor().compress(b'0' * 100000)
+        with self.assertRaises(FrameTooLarge):
+            StreamCompressor(max_size=10000).decompress(frame)
+
+        self.assertEqual(len(StreamCompressor(max_size=100000).decompress(frame)), 100000)
+
+    def test_incremental_fragment(self):
+        c = Client()
+        call = c.PendingCall('abc', 'test.iterator')
+        c.pending_calls['abc'] = call
+        items = [{'id': i, 'name': 'item \u017c{0}'.format(i), 'date': datetime(2017, 1, 1)} for i in range(100)]
+        message, _ = c.pack('rpc', 'fragment', {'seqno': 1, 'fragment': items}, id='abc')
+        message = message.encode('utf-8')
+
+        sink = c.begin_message(len(message))
+        halfway = None
+        for i in range(0, len(message), 7):
+            sink.feed(message[i:i + 7])
+            if halfway is None and i >= len(message) // 2:
+                halfway = call.partial, call.queue.qsize()
+
+        sink.finish()
+        self.assertEqual(halfway[0], 1)
+        self.assertTrue(0 < halfway[1] < 100)
+        self.assertEqual((call.partial, call.seqno), (0, 1))
+        self.assertEqual([call.queue.get() for _ in range(100)], items)
+
+        errors = []
+        c.send_error = lambda *args: errors.append(args)
+        call = c.PendingCall('abc', 'test.iterator')
+        c.pending_calls['abc'] = call
+        sink = c.begin_message(len(message))
+        sink.feed(message[:len(message) // 2])
+        sink.feed(message[len(message) // 2 + 1:])
+        sink.finish()
+
+        result = StreamingResultIterator(c, call)
+        with self.assertRaises(RpcException):
+            list(result)
+
+        self.assertEqual(len(errors), 1)
+        self.assertNotIn('abc', c.pending_calls)
+
+    def test_incremental_iterator(self):
+        c1, c2 = self.setup_back_to_back(True)
+        c1.rpc.streaming_burst = 200000
+        result = c2.call_sync('test.iterator', 200000)
+        self.assertEqual(list(result), [i * 2 for i in range(200000)])
+
+    def test_compact_results(self):
+        c1, c2 = self.setup_back_to_back(True)
+        rows = [{'id': i, 'name': 'item{0}'.format(i), 'props': {'a': i}} for i in range(10)]
+        result = c2.call_sync('test.echo', rows, compact=True)
+        self.assertEqual(result, rows)
+        self.assertIsInstance(result[0], Record)
+        self.assertIs(type(result[0]), type(result[1]))
+        self.assertIs(type(result[0]['props']), type(result[1]['props']))
+        self.assertEqual(result[0].get('name'), 'item0')
+        self.assertIsInstance(copy.deepcopy(result[0]), dict)
+        self.assertEqual(json.loads(dumps(result)), rows)
+
+        result = c2.call_sync('test.iterator', 10, compact=True)
+        self.assertEqual(list(result), [i * 2 for i in range(10)])
+
+    def test_compact_entity_subscriber(self):
+        c1, c2 = self.setup_back_to_back(True)
+        c1.register_service('entities', EntityService())
+        subscriber = EntitySubscriber(c2, 'entities', compact=True)
+        subscriber.start()
+        self.assertTrue(subscriber.ready.wait(5))
+
+        self.assertEqual(subscriber.query(('id', '=', 'a')), [EntityService.rows[0]])
+        self.assertEqual(subscriber.viewport(('props.size', '>', 1)), [EntityService.rows[1]])
+        entity = subscriber.get('b')
+        self.assertIs(type(entity), dict)
+        entity['name'] = 'renamed'
+
+    def test_fd_placeholders(self):
+        c = Client()
+        fds = [FileDescriptor(i) for i in (10, 11, 12)]
+        args = [fds[0], {'nested': [fds[1], {'deep': fds[2]}]}]
+        message, collected = c.pack('rpc', 'call', args)
+
+        self.assertEqual(collected, fds)
+        self.assertIs(args[0], fds[0])
+
+        received = []
+        c.on_rpc_call = lambda id, data: received.append(data)
+        c.on_message(message, fds=[20, 21, 22])
+        self.assertEqual(received[0][0].fd, 20)
+        self.assertEqual(received[0][1]['nested'][0].fd, 21)
+        self.assertEqual(received[0][1]['nested'][1]['deep'].fd, 22)
+
+    def test_exec_and_wait_for_event(self):
+        c1, c2 = self.setup_back_to_back()
+        result = c2.exec_and_wait_for_event(
+            'test.event',
+            lambda args: args['value'] == 2,
+            lambda: [c1.emit_event('test.event', {'value': i}) for i in range(3)],
+            timeout=10
+        )
+
+        self.assertTrue(result)
+        self.assertEqual(c2.event_waiters, {})
+        self.assertTrue(c2.test_or_wait_for_event('test.event', lambda args: False, lambda: True))
+
+        result = c2.exec_and_wait_for_event(
+            'test.*',
+            lambda args: args['value'] == 1,
+            lambda: [c1.emit_event('test.other', {'value': i}) for i in range(3)],
+            timeout=10
+        )
+
+        self.assertTrue(result)
+        self.assertEqual(dict(c2.event_waiters), {})
+
+    def test_event_waiter_failed_subscribe(self):
+        c1, c2 = self.setup_back_to_back()
+        c1.on_events_subscribe = lambda id, masks: c1.send_error(id, errno.EPERM, 'Not permitted', masks[0])
+
+        start = time.monotonic()
+        self.assertFalse(c2.exec_and_wait_for_event('test.event', lambda args: True, lambda: None, timeout=10))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(c2.subscriptions.masks, set())
+        self.assertEqual(c2.subscriptions.subscribed, set())
+        self.assertEqual(c2.event_waiters, {})
+
+        waiter = c2.add_event_waiter('test.event', lambda args: True)
+        self.assertFalse(waiter.wait(10))
+        self.assertEqual(waiter.error.code, errno.EPERM)
+        c2.remove_event_waiter(waiter)
+        self.assertEqual(c2.event_waiters, {})
+
+    def test_subscription_refcount(self):
+        sent = []
+        c = Client()
+        c.send = lambda namespace, name, args=None, id=None: sent.append((name, set(args)))
+        c.subscriptions.delay = None
+
+        handlers = [lambda args: None for _ in range(3)]
+        for h in handlers:
+            c.register_event_handler('test.event', h)
+
+        for h in handlers:
+            c.unregister_event_handler('test.event', h)
+
+        self.assertEqual(sent, [('subscribe', {'test.event'}), ('unsubscribe', {'test.event'})])
+
+    def test_subscription_batching(self):
+        sent = []
+        c = Client()
+        c.send_raw = lambda data, fds=None: sent.append(json.loads(data))
+        c.register_event_handler('test.a', lambda args: None)
+        c.register_event_handler('test.b', lambda args: None)
+        self.assertEqual(sent, [])
+
+        c.send('rpc', 'call', {'method': 'test.trigger', 'args': []})
+        self.assertEqual([(i['namespace'], i['name']) for i in sent], [('events', 'subscribe'), ('rpc', 'call')])
+        self.assertEqual(set(sent[0]['args']), {'test.a', 'test.b'})
+        self.assertFalse(c.subscriptions.pending)
+
+    def test_event_router(self):
+        router = EventRouter()
+        exact, wildcard = object(), object()
+        router.add('task.created', exact)
+        router.add('task.*', wildcard)
+
+        self.assertEqual(router.route('task.created'), (exact, wildcard))
+        self.assertEqual(router.route('task.updated'), (wildcard,))
+        self.assertEqual(router.route('disk.changed'), ())
+
+        router.remove('task.*', wildcard)
+        self.assertEqual(router.route('task.updated'), ())
+
+        c = Client()
+        c.event_handlers['task.*'] = [wildcard]
+        self.assertEqual(c.event_router.route('task.updated'), (wildcard,))
+        c.event_handlers['task.*'].append(exact)
+        self.assertEqual(c.event_router.route('task.updated'), (wildcard, exact))
+        del c.event_handlers['task.*']
+        self.assertEqual(c.event_router.route('task.updated'), ())
+        self.assertEqual(dict(c.event_handlers), {})
+
+    def test_lazy_decode(self):
+        c = Client()
+        c.lazy_decode = True
+        sent, errors = [], []
+        c.send_raw = lambda data, fds=None: sent.append(data)
+        c.on_error(lambda *args: errors.append(args))
+
+        c.send_event('disk.changed', {'id': 'ada0'}, 5, 'abc')
+        envelope = peek_envelope(sent.pop())
+        self.assertEqual(envelope, ('events', 'event', None, 'disk.changed', 5, 'abc'))
+
+        # Arguments that fail to decode show that nothing past the envelope was looked at
+        garbage = '{"namespace": "events", "name": "event", "id": null, "args": {"name": "disk.changed", ' \
+                  '"seqno": 6, "epoch": "abc", "args": {'
+        c.on_message(garbage.encode('utf-8'))
+        self.assertEqual(sent, [])
+        self.assertEqual((c.event_seqno, c.event_epoch), (6, 'abc'))
+
+        c.on_message(b'{"namespace": "rpc", "name": "response", "id": "123", "args": [')
+        self.assertEqual(sent, [])
+        self.assertEqual(errors, [(ClientError.SPURIOUS_RPC_RESPONSE, '123')])
+
+        c.event_router.add('disk.*', lambda args: None)
+        c.on_message(garbage.encode('utf-8'))
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(json.loads(sent[0])['name'], 'error')
+
+    def test_lazy_decode_overridden_events(self):
+        received = []
+
+        class PluginConnection(ServerConnection):
+            def on_events_event(self, id, data):
+                received.append(data['name'])
+
+        self.assertFalse(Client().lazy_decode)
+        conn = PluginConnection(Server())
+        conn.lazy_decode = True
+        conn.send_raw = lambda data, fds=None: None
+        conn.on_message(b'{"namespace": "events", "name": "event", "id": null, '
+                        b'"args": {"name": "plugin.changed", "seqno": 1, "epoch": "abc", "args": {}}}')
+        self.assertEqual(received, ['plugin.changed'])
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -26,14 +26,28 @@
 #####################################################################
 
 import os
+import sys
 import time
+import errno
+import array
 import socket
 import unittest
 import threading
 import logging
+import contextlib
+import paramiko
 from freenas.dispatcher.rpc import RpcService, RpcContext
 from freenas.dispatcher.client import Client
-from freenas.dispatcher.server import Server
+from freenas.dispatcher.server import Server, ServerConnection
+from freenas.dispatcher.bridge import Bridge
+from freenas.dispatcher.transport import (
+    FrameReader, OutboundQueue, HEADER, READ_BUFFER_SIZE, SHM_DESCRIPTORS, ShmRing, ShmChannel,
+    sendmsg_all, connect_parallel, interleave_addresses, create_shm, _ssh_pool
+)
+from ws4py.websocket import WebSocket
+from wsgiref.simple_server import make_server
+from ws4py.server.wsgirefserver import WebSocketWSGIRequestHandler, WSGIServer
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
 
 
 class TestService(RpcService):
@@ -43,8 +57,93 @@ class TestService(RpcService):
     def hello(self, arg):
         return 'Hello World, {0}'.format(arg)
 
+    def echo(self, arg):
+        return arg
+
+
+class WebSocketConnection(WebSocket):
+    server = None
+
+    def opened(self):
+        self.conn = self.server.on_connection(self)
+        self.conn.on_open()
+
+    def send(self, payload, binary=False):
+        # Called both by ws4py and as the dispatcher transport, with the fds list in place of binary
+        super(WebSocketConnection, self).send(payload, binary=not isinstance(payload, str))
+
+    def received_message(self, message):
+        self.conn.on_message(message.data)
+
+    def closed(self, code, reason=None):
+        self.conn.on_close(reason)
+
+
+class SSHServer(paramiko.ServerInterface):
+    """ Runs the dispatcher in place of the transport catcher, one per channel. """
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username in ('root', 'guest') and password == 'secret':
+            self.username = username
+            return paramiko.AUTH_SUCCESSFUL
+
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        if self.username == 'guest':
+            # What the transport catcher answers to users not allowed to use it
+            channel.sendall(HEADER.pack(0xbadbeef0, 0))
+            return True
+
+        a, b = socket.socketpair()
+        server = Client()
+        server.standalone_server = True
+        server.enable_server()
+        server.register_service('test', TestService())
+        server.connect('fd://{0}'.format(a.detach()))
+
+        def pump(recv, send):
+            with contextlib.suppress(OSError, EOFError):
+                while True:
+                    data = recv(65536)
+                    if not data:
+                        break
+
+                    send(data)
+
+            with contextlib.suppress(OSError, EOFError):
+                channel.close()
+
+            with contextlib.suppress(OSError):
+                b.shutdown(socket.SHUT_RDWR)
+
+        threading.Thread(target=pump, args=(channel.recv, b.sendall), daemon=True).start()
+        threading.Thread(target=pump, args=(b.recv, channel.sendall), daemon=True).start()
+        return True
+
 
 class TestClientServer(unittest.TestCase):
+    def start_tcp_server(self, server, scheme='tcp', **options):
+        server.rpc = RpcContext()
+        server.start('{0}://127.0.0.1:0'.format(scheme), transport_options=options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        while not server.transport.sockfd:
+            time.sleep(0.01)
+
+        return 'tcp://127.0.0.1:{0}'.format(server.transport.sockfd.getsockname()[1])
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+        return condition()
+
     def test_unix_server(self):
         sockpath = os.path.join(os.getcwd(), 'test.{0}.sock'.format(os.getpid()))
         sockurl = 'unix://' + sockpath
@@ -69,6 +168,66 @@ class TestClientServer(unittest.TestCase):
         server.close()
         os.unlink(sockpath)
 
+    def test_shm_server(self):
+        sockpath = os.path.join(os.getcwd(), 'test.shm.{0}.sock'.format(os.getpid()))
+        sockurl = 'shm://' + sockpath
+
+        context = RpcContext()
+        context.register_service('test', TestService)
+        server = Server()
+        server.rpc = context
+        server.start(sockurl)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        while not os.path.exists(sockpath):
+            time.sleep(0.1)
+
+        client = Client()
+        client.connect(sockurl, ring_size=65536)
+        self.assertTrue(client.connected)
+        self.assertEqual(client.call_sync('test.hello', 'freenas'), 'Hello World, freenas')
+
+        # Messages larger than the rings go through them piecewise
+        payload = 'x' * (1024 * 1024)
+        self.assertEqual(client.call_sync('test.echo', payload), payload)
+
+        client.disconnect()
+        server.close()
+        os.unlink(sockpath)
+
+    def test_shm_channel(self):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        fds = [create_shm(4096) for _ in range(2)]
+        left = ShmChannel(a, ShmRing(fds[0], 4096), ShmRing(fds[1], 4096))
+        right = ShmChannel(b, ShmRing(fds[1], 4096), ShmRing(fds[0], 4096))
+        for i in fds:
+            os.close(i)
+
+        r, w = os.pipe()
+        left.write(ShmChannel.frame(b'first'))
+        left.write(ShmChannel.frame(b'second', 1), [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [w]))])
+
+        reader = FrameReader(right)
+        self.assertEqual(HEADER.unpack(reader.read_header()[0]), (0xdeadbeef, 5))
+        self.assertEqual(reader.read(5), b'first')
+        self.assertEqual(HEADER.unpack(reader.read_header()[0]), (SHM_DESCRIPTORS, 1))
+        received = right.take_fds(1)
+        self.assertEqual(HEADER.unpack(reader.read_header()[0]), (0xdeadbeef, 6))
+        self.assertEqual(reader.read(6), b'second')
+        os.write(received[0], b'!')
+        self.assertEqual(os.read(r, 1), b'!')
+
+        # Frames wrap around the end of the ring
+        data = os.urandom(3000)
+        for i in range(5):
+            left.write([data])
+            self.assertEqual(reader.read(3000), data)
+
+        for i in (r, w, received[0]):
+            os.close(i)
+
+        a.close()
+        b.close()
+
     def test_back_to_back(self):
         a, b = socket.socketpair()
         self.assertGreaterEqual(a.fileno(), 0)
@@ -91,6 +250,566 @@ class TestClientServer(unittest.TestCase):
         c1.disconnect()
         b.close()
 
+    def test_fd_transport(self):
+        a, b = socket.socketpair()
+
+        c1 = Client()
+        c1.standalone_server = True
+        c1.enable_server()
+        c1.register_service('test', TestService())
+        c1.connect('fd://{0}'.format(a.detach()))
+
+        c2 = Client()
+        c2.connect('fd://{0}'.format(b.detach()))
+
+        # Small frames arriving back to back are parsed out of a single read
+        results = []
+        callers = [
+            threading.Thread(target=lambda i=i: results.append(c2.call_sync('test.echo', i)))
+            for i in range(20)
+        ]
+
+        for i in callers:
+            i.start()
+
+        for i in callers:
+            i.join()
+
+        self.assertEqual(sorted(results), list(range(20)))
+        payload = 'x' * (READ_BUFFER_SIZE * 3)
+        self.assertEqual(c2.call_sync('test.echo', payload), payload)
+
+        c2.disconnect()
+        self.assertTrue(self.wait_for(lambda: not c1.connected))
+
+    def test_fd_bridge(self):
+        a1, b1 = socket.socketpair()
+        a2, b2 = socket.socketpair()
+
+        bridge = Bridge()
+        bridge.start('fd://{0}'.format(a1.detach()), 'fd://{0}'.format(a2.detach()))
+
+        c1 = Client()
+        c1.standalone_server = True
+        c1.enable_server()
+        c1.register_service('test', TestService())
+        c1.connect('fd://{0}'.format(b1.detach()))
+
+        c2 = Client()
+        c2.connect('fd://{0}'.format(b2.detach()))
+        self.assertEqual(c2.call_sync('test.hello', 'freenas'), 'Hello World, freenas')
+
+        c2.disconnect()
+        c1.disconnect()
+
+    def test_frame_reader(self):
+        a, b = socket.socketpair()
+        r, w = os.pipe()
+        frames = [b'{}', b'x' * 100, b'with fd', b'y' * (READ_BUFFER_SIZE * 3), b'last']
+        ancbufsize = socket.CMSG_SPACE(4)
+
+        def send():
+            for i in frames:
+                ancdata = []
+                if i == b'with fd':
+                    ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [w])))
+
+                sendmsg_all(a, [HEADER.pack(0xdeadbeef, len(i)), i], ancdata)
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+
+        reader = FrameReader(b, ancbufsize)
+        for i in frames:
+            header, ancdata = reader.read_header()
+            magic, length = HEADER.unpack(header)
+            self.assertEqual((magic, length), (0xdeadbeef, len(i)))
+            self.assertEqual(reader.read(length), i)
+            self.assertEqual(len(ancdata), 1 if i == b'with fd' else 0)
+            for level, type, data in ancdata:
+                os.close(array.array('i', data)[0])
+
+        sender.join()
+        a.close()
+        self.assertEqual(reader.read_header(), (b'', ()))
+        b.close()
+        os.close(r)
+        os.close(w)
+
+    def test_outbound_coalescing(self):
+        writes = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def write(buffers, ancdata):
+            writes.append((buffers, ancdata))
+            if len(writes) == 1:
+                blocked.set()
+                release.wait()
+
+        queue = OutboundQueue(write)
+        queue.put([b'a'])
+        writer = threading.Thread(target=queue.flush)
+        writer.start()
+        self.assertTrue(blocked.wait(5))
+
+        # While a write is in progress, senders return right after queueing
+        done = []
+        for i in (b'b', b'c', b'd'):
+            queue.put([i], [('anc', i)] if i == b'c' else None, lambda i=i: done.append(i))
+            queue.flush()
+
+        release.set()
+        writer.join()
+        self.assertEqual(writes, [
+            ([b'a'], None),
+            ([b'b'], None),
+            ([b'c', b'd'], [('anc', b'c')])
+        ])
+        self.assertEqual(done, [b'b', b'c', b'd'])
+        self.assertFalse(queue.writing)
+
+    def test_outbound_overflow(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        overflows = []
+
+        def write(buffers, ancdata):
+            release.wait()
+
+        def blocked_queue(policy):
+            queue = OutboundQueue(write, 8, policy, lambda: overflows.append(policy))
+            writer = threading.Thread(target=queue.send, args=([b'block'],))
+            writer.start()
+            self.assertTrue(self.wait_for(lambda: queue.writing))
+            self.assertTrue(queue.offer([b'aaaa'], 'a'))
+            self.assertTrue(queue.offer([b'bbbb'], 'b'))
+            return queue, writer
+
+        queue, writer = blocked_queue('drop')
+        self.assertFalse(queue.offer([b'cccc'], 'a'))
+        self.assertEqual(queue.stats['dropped'], 1)
+
+        queue, writer = blocked_queue('conflate')
+        self.assertTrue(queue.offer([b'aaaaaa'], 'a'))
+        self.assertFalse(queue.offer([b'cccc'], 'c'))
+        self.assertEqual([i[0] for i in queue.frames], [[b'aaaaaa'], [b'bbbb']])
+        self.assertEqual(queue.stats['conflated'], 1)
+        self.assertEqual(queue.stats['high_water'], 10)
+
+        queue, writer = blocked_queue('disconnect')
+        self.assertFalse(queue.offer([b'cccc']))
+        self.assertFalse(queue.offer([b'dddd']))
+        self.assertEqual(overflows, ['disconnect'])
+
+        # Frames that cannot be dropped close the connection whatever the policy
+        queue, writer = blocked_queue('drop')
+        self.assertFalse(queue.offer([b'cccc'], droppable=False))
+        self.assertEqual(overflows, ['disconnect', 'drop'])
+
+        release.set()
+        writer.join()
+        self.assertTrue(self.wait_for(lambda: not queue.writing and queue.size == 0))
+
+    def test_slow_subscriber(self):
+        server = Server()
+        url = self.start_tcp_server(server, send_buffer_limit=1024 * 1024, overflow_policy='drop')
+        fast, slow = Client(), Client()
+        received = []
+        fast.connect(url)
+        slow.connect(url)
+        fast.on_event(lambda name, args: received.append(args['n']))
+        fast.subscribe_events('test.*')
+        slow.subscribe_events('test.*')
+        self.assertTrue(self.wait_for(lambda: all(i.event_masks for i in server.connections)))
+
+        # The slow client stops reading, so its socket buffer and then its send buffer fill up
+        stuck = threading.Event()
+        slow.on_message = lambda *args, **kwargs: stuck.wait()
+        payload = 'x' * 65536
+        started = time.monotonic()
+        for i in range(200):
+            server.broadcast_event('test.event', {'n': i, 'payload': payload})
+            if i % 5 == 4:
+                # Keep pace with the fast client only
+                self.assertTrue(self.wait_for(lambda: len(received) == i + 1))
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(received, list(range(200)))
+
+        stats = [i.send_buffer_stats for i in server.connections]
+        self.assertEqual(sorted(i['dropped'] > 0 for i in stats), [False, True])
+        self.assertLessEqual(max(i['high_water'] for i in stats), 1024 * 1024)
+
+        stuck.set()
+        fast.disconnect()
+        slow.disconnect()
+
+    def test_tcp_options(self):
+        server = Server()
+        url = self.start_tcp_server(server, backlog=64, keepalive=True, keepalive_idle=30, rcvbuf=256 * 1024)
+        client = Client()
+        client.connect(url, connect_timeout=5, keepalive=True)
+        self.assertTrue(self.wait_for(lambda: len(server.connections) == 1))
+
+        for sock in (client.transport.socket, server.connections[0].transport.connfd):
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.assertEqual(server.connections[0].transport.connfd.getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_KEEPIDLE
+            ), 30)
+
+        client.disconnect()
+
+    def test_max_frame_size(self):
+        server = Server()
+        url = self.start_tcp_server(server, max_frame_size=2 * 1024 * 1024)
+        server.rpc.register_service('test', TestService)
+        client = Client()
+        client.connect(url)
+        payload = 'x' * (1024 * 1024 + 1)
+        self.assertEqual(client.call_sync('test.echo', payload), payload)
+        client.disconnect()
+
+        # The connection is closed as soon as the header comes in, without waiting for the body
+        sock = socket.create_connection(('127.0.0.1', server.transport.sockfd.getsockname()[1]))
+        sock.sendall(HEADER.pack(0xdeadbeef, 0xffffffff))
+        sock.settimeout(5)
+        self.assertEqual(sock.recv(1), b'')
+        sock.close()
+
+        a, b = socket.socketpair()
+        client = Client()
+        client.connect('fd://{0}'.format(b.detach()), max_frame_size=1024)
+        a.sendall(HEADER.pack(0xdeadbeef, 1025))
+        self.assertTrue(self.wait_for(lambda: not client.connected))
+        a.close()
+
+    def test_ssh_connection_sharing(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(4)
+        host_key = paramiko.ECDSAKey.generate()
+        transports = []
+
+        def serve():
+            while True:
+                sock, addr = listener.accept()
+                transport = paramiko.Transport(sock)
+                transport.add_server_key(host_key)
+                transport.start_server(server=SSHServer())
+                transports.append(transport)
+
+        threading.Thread(target=serve, daemon=True).start()
+        url = 'ssh://root@127.0.0.1:{0}'.format(listener.getsockname()[1])
+
+        # Clients after the first one only open a channel on the existing connection
+        clients = [Client() for _ in range(3)]
+        for i in clients:
+            i.connect(url, password='secret', look_for_keys=False)
+            self.assertEqual(i.call_sync('test.hello', 'freenas'), 'Hello World, freenas')
+
+        self.assertEqual(len(transports), 1)
+        self.assertNotIn('secret', repr(list(_ssh_pool.entries)))
+        self.assertEqual(i.call_sync('test.echo', 'x' * 200000), 'x' * 200000)
+
+        # Different credentials never share a connection
+        with self.assertRaises(paramiko.AuthenticationException):
+            Client().connect(url, password='wrong', look_for_keys=False)
+
+        self.assertEqual(len(transports), 2)
+
+        # The connection stays up until the last client is gone
+        clients[0].disconnect()
+        self.assertEqual(clients[1].call_sync('test.hello', 'freenas'), 'Hello World, freenas')
+        for i in clients[1:]:
+            i.disconnect()
+
+        self.assertEqual(_ssh_pool.entries, {})
+        self.assertTrue(self.wait_for(lambda: not transports[0].is_active()))
+
+        # A refusal from the catcher is raised, not taken for a dropped connection
+        errors = []
+        excepthook, threading.excepthook = threading.excepthook, lambda args: errors.append(args.exc_type)
+        try:
+            c = Client()
+            c.connect(url.replace('root', 'guest'), password='secret', look_for_keys=False)
+            self.assertTrue(self.wait_for(lambda: errors))
+        finally:
+            threading.excepthook = excepthook
+
+        self.assertEqual(errors, [PermissionError])
+        self.assertFalse(c.connected)
+        listener.close()
+
+    def test_connect_parallel(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        refused = closed.getsockname()
+        closed.close()
+
+        v4 = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '')
+        v6 = (socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, '')
+        self.assertEqual(
+            interleave_addresses([v6 + (1,), v6 + (2,), v4 + (3,)]),
+            [v6 + (1,), v4 + (3,), v6 + (2,)]
+        )
+
+        # A failed attempt moves on to the next address right away
+        sock = connect_parallel([v4 + (refused,), v4 + (listener.getsockname(),)], timeout=5, delay=10)
+        self.assertEqual(sock.getpeername(), listener.getsockname())
+        self.assertTrue(sock.getblocking())
+        sock.close()
+
+        with self.assertRaises(OSError) as cm:
+            connect_parallel([v4 + (refused,)], timeout=5)
+
+        self.assertEqual(cm.exception.errno, errno.ECONNREFUSED)
+        listener.close()
+
+    def test_send_timeout(self):
+        a, b = socket.socketpair()
+        chunk = b'x' * 65536
+
+        # The peer does not read, so the socket buffer fills up and the send times out
+        started = time.monotonic()
+        with self.assertRaises(OSError) as cm:
+            while True:
+                sendmsg_all(a, [chunk], timeout=0.2)
+
+        self.assertEqual(cm.exception.errno, errno.ETIMEDOUT)
+        self.assertLess(time.monotonic() - started, 5)
+
+        # A reader draining the buffer lets a large send complete within the deadline
+        drained = threading.Event()
+
+        def drain():
+            b.settimeout(0.1)
+            while not drained.is_set():
+                with contextlib.suppress(socket.timeout):
+                    b.recv(1024 * 1024)
+
+        threading.Thread(target=drain, daemon=True).start()
+        sendmsg_all(a, [chunk * 64], timeout=5)
+        drained.set()
+        a.close()
+        b.close()
+
+    def test_event_filter(self):
+        conn = ServerConnection(Server())
+        conn.on_events_subscribe(None, [
+            'task.*',
+            {'mask': 'disk.*', 'filter': [('id', '=', 'ada0')]}
+        ])
+
+        self.assertTrue(conn.match_event('task.created', {'id': 1}))
+        self.assertTrue(conn.match_event('disk.changed', {'id': 'ada0'}))
+        self.assertFalse(conn.match_event('disk.changed', {'id': 'ada1'}))
+        self.assertFalse(conn.match_event('disk.changed', None))
+
+        conn.on_events_unsubscribe(None, ['disk.*'])
+        self.assertTrue(conn.match_event('disk.changed', {'id': 'ada0'}))
+
+        conn.on_events_unsubscribe(None, [{'mask': 'disk.*', 'filter': [('id', '=', 'ada0')]}])
+        self.assertFalse(conn.match_event('disk.changed', {'id': 'ada0'}))
+
+    def test_event_filter_malformed(self):
+        conn = ServerConnection(Server())
+        errors = []
+        conn.send_error = lambda id, code, message, extra=None: errors.append(code)
+        conn.on_events_subscribe(None, [
+            {'mask': 'disk.*', 'filter': 5},
+            {'mask': 'pool.*', 'filter': ['id']},
+            {'mask': 'task.*', 'filter': [('id', '=', 1)]}
+        ])
+
+        self.assertEqual(errors, [errno.EINVAL, errno.EINVAL])
+        self.assertEqual([mask for mask, _ in conn.event_filters.values()], ['task.*'])
+        self.assertFalse(conn.match_event('disk.changed', {'id': 'ada0'}))
+        self.assertTrue(conn.match_event('task.created', {'id': 1}))
+
+    def test_ws_binary_frames(self):
+        server = Server()
+        server.rpc = RpcContext()
+        server.rpc.register_service('test', TestService)
+        handler = type('Handler', (WebSocketConnection,), {'server': server})
+        httpd = make_server(
+            '127.0.0.1', 0,
+            server_class=WSGIServer,
+            handler_class=WebSocketWSGIRequestHandler,
+            app=WebSocketWSGIApplication(handler_cls=handler)
+        )
+
+        httpd.initialize_websockets_manager()
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+        client = Client()
+        client.connect('ws://127.0.0.1:{0}'.format(httpd.server_port), features=['compression', 'attachments'])
+        value = {'blob': os.urandom(4096), 'rows': [{'id': i, 'name': 'item{0}'.format(i)} for i in range(500)]}
+        self.assertEqual(client.call_sync('test.echo', value), value)
+        self.assertEqual(client.features, {'compression', 'attachments'})
+        self.assertEqual(client.call_sync('test.echo', value), value)
+        self.assertGreater(client.compression.frames_received, 0)
+
+        client.disconnect()
+        httpd.server_close()
+
+    def test_reactor_server(self):
+        server = Server()
+        url = self.start_tcp_server(server, 'tcp+reactor', io_threads=1)
+        server.rpc.register_service_instance('test', TestService())
+        threads = threading.active_count()
+
+        clients = []
+        for i in range(10):
+            client = Client()
+            client.connect(url)
+            clients.append(client)
+
+        # Every client has a reader thread of its own, the server side connections none
+        self.assertTrue(self.wait_for(lambda: len(server.connections) == 10))
+        self.assertLessEqual(threading.active_count() - threads, 10)
+
+        payload = 'x' * (READ_BUFFER_SIZE * 4)
+        results = []
+        callers = [
+            threading.Thread(target=lambda c=c: results.append(c.call_sync('test.echo', payload)))
+            for c in clients
+        ]
+
+        for i in callers:
+            i.start()
+
+        for i in callers:
+            i.join()
+
+        self.assertEqual(results, [payload] * 10)
+        self.assertEqual(clients[0].call_sync('test.hello', 'reactor'), 'Hello World, reactor')
+
+        for i in clients:
+            i.disconnect()
+
+        self.assertTrue(self.wait_for(lambda: not server.connections))
+
+    def test_filtered_subscriptions(self):
+        server = Server()
+        client = Client()
+        client.connect(self.start_tcp_server(server))
+        received = []
+        client.on_event(lambda name, args: received.append(args['id']))
+
+        client.subscribe_events('disk.*', filter=[('id', '=', 'ada0')])
+        client.subscribe_events('disk.*', filter=[('id', '=', 'ada1')])
+        handler = client.register_event_handler('disk.*', lambda args: None)
+        client.subscriptions.flush()
+        self.assertTrue(self.wait_for(lambda: len(server.connections) == 1 and len(server.connections[0].event_filters) == 2))
+
+        client.unregister_event_handler('disk.*', handler)
+        client.subscriptions.flush()
+        self.assertTrue(self.wait_for(lambda: not server.connections[0].event_masks))
+
+        for i in ('ada0', 'ada1', 'ada2'):
+            server.broadcast_event('disk.changed', {'id': i})
+
+        self.assertTrue(self.wait_for(lambda: len(received) == 2))
+        self.assertEqual(received, ['ada0', 'ada1'])
+
+        client.unsubscribe_events('disk.*', filter=[('id', '=', 'ada0')])
+        self.assertTrue(self.wait_for(lambda: len(server.connections[0].event_filters) == 1))
+        client.disconnect()
+
+    def test_resubscribe_on_reconnect(self):
+        server = Server()
+        url = self.start_tcp_server(server)
+        client = Client()
+        client.connect(url)
+        client.register_event_handler('test.*', lambda args: None)
+        client.subscriptions.flush()
+        self.assertTrue(self.wait_for(lambda: server.connections and server.connections[0].event_masks == {'test.*'}))
+
+        client.disconnect()
+        self.assertTrue(self.wait_for(lambda: not server.connections))
+        client.connect(url)
+        self.assertTrue(self.wait_for(lambda: len(server.connections) == 1))
+        self.assertTrue(self.wait_for(lambda: server.connections[0].event_masks == {'test.*'}))
+        client.disconnect()
+
+    def test_resume_events(self):
+        server = Server()
+        url = self.start_tcp_server(server)
+        for i in range(3):
+            server.broadcast_event('test.event', {'n': i})
+
+        received = []
+        client = Client()
+        client.connect(url)
+        client.on_event(lambda name, args: received.append(args['n']))
+        client.resume_events('test.*', since=1, epoch=server.event_epoch)
+        self.assertTrue(self.wait_for(lambda: received == [1, 2]))
+        self.assertEqual((client.event_seqno, client.event_epoch), (3, server.event_epoch))
+
+        server.broadcast_event('test.event', {'n': 3})
+        self.assertTrue(self.wait_for(lambda: received == [1, 2, 3]))
+        since = client.event_seqno
+        client.disconnect()
+
+        # Same sequence numbers, but from a restarted server
+        restarted = Server()
+        url = self.start_tcp_server(restarted)
+        for i in range(6):
+            restarted.broadcast_event('test.event', {'n': i})
+
+        resynced = []
+        client = Client()
+        client.connect(url)
+        client.on_resync(lambda: resynced.append(client.event_seqno))
+        client.resume_events('test.*', since=since, epoch=server.event_epoch)
+        self.assertTrue(self.wait_for(lambda: resynced == [6]))
+        self.assertEqual(client.event_epoch, restarted.event_epoch)
+        client.disconnect()
+
+    def test_event_replay(self):
+        server = Server(replay_size=3)
+        for i in range(5):
+            server.broadcast_event('test.event', {'n': i})
+
+        self.assertEqual([i[0] for i in server.replay_events(3)], [4, 5])
+        self.assertEqual(server.replay_events(5), [])
+        self.assertIsNone(server.replay_events(1))
+        self.assertIsNone(server.replay_events(6))
+
+    def test_broadcast_order(self):
+        server = Server()
+        conn = ServerConnection(server)
+        conn.event_masks = {'test.*'}
+        received = []
+        conn.offer = lambda namespace, name, args, key=None: received.append(args['seqno']) or True
+        server.connections.append(conn)
+
+        def broadcast():
+            for i in range(200):
+                server.broadcast_event('test.event', {'n': i})
+
+        # Switching threads as often as possible opens up the gaps between numbering and sending
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=broadcast) for _ in range(4)]
+            for i in threads:
+                i.start()
+
+            for i in threads:
+                i.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(received, list(range(1, 801)))
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)